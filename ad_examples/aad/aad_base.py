@@ -62,6 +62,88 @@ def estimate_qtau(samples, model, opts, lo=-1.0, hi=1.0):
     return qval, qmin, qmax
 
 
+class ScoreRanking(object):
+    """Scores of all instances for one weight vector, ranked lazily
+
+    The scores x.dot(w) are computed once. Only as long a prefix of the
+    decreasing order is sorted as has been requested (np.argpartition
+    followed by a sort of the prefix). Ties are broken by the instance
+    index so that a longer prefix always extends a shorter one.
+
+    The object can be used in place of the array of ordered indexes, e.g.,
+    by the query models: indexing extends the sorted prefix as required.
+
+    Attributes:
+        x: np.ndarray or csr_matrix
+        w: np.array
+            copy of the weights with which the scores were computed
+        scores: np.array
+    """
+    def __init__(self, x, w, scores):
+        self.x = x
+        self.w = np.copy(w)
+        self.scores = scores
+        self._ordered = np.zeros(0, dtype=int)
+        self._quantiles = {}
+        self.min_prefix = 1000
+
+    def is_valid(self, x, w):
+        return self.x is x and np.array_equal(self.w, w)
+
+    def get_top(self, k):
+        """Returns the indexes of the k highest scores in decreasing order of score"""
+        n = len(self.scores)
+        k = min(k, n)
+        if k > len(self._ordered):
+            # grow geometrically (and by at least min_prefix) so that
+            # repeated requests for a few more instances remain cheap
+            k_new = min(n, max(k, 2 * len(self._ordered), self.min_prefix))
+            if k_new < n:
+                kth = np.argpartition(-self.scores, k_new - 1)[k_new - 1]
+                idxs = np.where(self.scores >= self.scores[kth])[0]
+            else:
+                idxs = np.arange(n)
+            ordered = idxs[np.argsort(-self.scores[idxs], kind="mergesort")]
+            self._ordered = ordered[0:k_new]
+        return self._ordered[0:k]
+
+    def get_ranked_index(self, rank):
+        """Returns the index of the instance at position rank (0-based) in decreasing order of score"""
+        return self.get_top(rank + 1)[rank]
+
+    def get_quantile(self, q):
+        if q not in self._quantiles:
+            self._quantiles[q] = quantile(self.scores, q)
+        return self._quantiles[q]
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self.scores))
+            return self.get_top(max(start, stop))[key]
+        key_arr = np.asarray(key)
+        if key_arr.size == 0:
+            return self._ordered[key_arr.astype(int)]
+        key_max = np.max(key_arr)
+        if np.min(key_arr) < 0:
+            key_max = len(self.scores) - 1
+        return self.get_top(key_max + 1)[key]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.get_top(len(self.scores)), dtype=dtype)
+
+    def __getstate__(self):
+        # the data is not saved along with a model; the ranking is recomputed when needed
+        state = self.__dict__.copy()
+        state["x"] = None
+        state["scores"] = np.zeros(0, dtype=float)
+        state["_ordered"] = np.zeros(0, dtype=int)
+        state["_quantiles"] = {}
+        return state
+
+
 class MetricsStructure(object):
     def __init__(self, train_aucs=None, test_aucs=None, train_precs=None, test_precs=None,
                  train_aprs=None, test_aprs=None, train_n_at_top=None, test_n_at_top=None,
@@ -123,6 +205,14 @@ class Aad(object):
         self.w = None
         self.qval = None
 
+        # ScoreRanking for the most recent (x, w)
+        self.score_ranking = None
+
+        # number of weight updates since the weights were initialized, and
+        # the time taken (secs) by the most recent update
+        self.n_weight_updates = 0
+        self.weight_update_time = 0.
+
         # quick lookup of the uniform weight vector.
         # IMPORTANT: Treat this as readonly once set in fit()
         self.w_unif_prior = None
@@ -133,6 +223,13 @@ class Aad(object):
             return len(self.w)
         return None
 
+    def close_workers(self):
+        """Shuts down the worker processes, if any, used by the detector
+
+        The detector remains usable; the workers are restarted when needed.
+        """
+        pass
+
     def get_uniform_weights(self):
         m = self.get_num_members()
         if m is None:
@@ -167,6 +264,7 @@ class Aad(object):
             self.w = self.get_zero_weights()
         else:
             self.w = self.get_random_weights(samples=samples)
+        self.n_weight_updates = 0
 
     def get_score(self, x, w=None):
         if w is None:
@@ -187,14 +285,27 @@ class Aad(object):
     def supports_streaming(self):
         return False
 
+    def get_score_ranking(self, x, w=None):
+        """Returns the (cached) ScoreRanking of x for weights w
+
+        The scores are recomputed only when either x or w changes.
+        """
+        if w is None:
+            w = self.w
+        if self.score_ranking is None or not self.score_ranking.is_valid(x, w):
+            self.score_ranking = ScoreRanking(x, w, self.get_score(x, w))
+        return self.score_ranking
+
     def get_tau_ranked_instance(self, x, w, tau_rank):
-        s = self.get_score(x, w)
-        ps = order(s, decreasing=True)[tau_rank]
+        ps = self.get_score_ranking(x, w).get_ranked_index(tau_rank)
         return matrix(x[ps, :], nrow=1)
 
     def get_top_quantile(self, x, w, topK):
         # IMPORTANT: qval will be computed using the linear dot product
         # s = self.get_score(x, w)
+        if self.ensemble_score == ENSEMBLE_SCORE_LINEAR:
+            s = self.get_score_ranking(x, w)
+            return s.get_quantile((1.0 - (topK * 1.0 / float(nrow(x)))) * 100.0)
         s = x.dot(w)
         return quantile(s, (1.0 - (topK * 1.0 / float(nrow(x)))) * 100.0)
 
@@ -296,30 +407,56 @@ class Aad(object):
                                                 sigma2=opts.priorsigma2, prior_influence=prior_influence)
             else:
                 raise ValueError("Only linear loss supported")
-        if False:
-            w_new = sgd(w, x[hf, :], y[hf], if_f, if_g,
-                        learning_rate=0.001, max_epochs=1000, eps=1e-5,
-                        shuffle=True, rng=self.random_state)
-        elif False:
-            w_new = sgdMomentum(w, x[hf, :], y[hf], if_f, if_g,
-                                learning_rate=0.001, max_epochs=1000,
-                                shuffle=True, rng=self.random_state)
-        elif True:
+
+        def if_fg(w, x, y):
+            # loss and gradient with a single evaluation of x.dot(w)
+            if linear:
+                return aad_loss_and_gradient_linear(w, x, y, self.qval, in_constr_set=in_constr_set, x_tau=x_tau,
+                                                    Ca=opts.Ca, Cn=opts.Cn, Cx=opts.Cx,
+                                                    withprior=opts.withprior, w_prior=w_prior,
+                                                    sigma2=opts.priorsigma2, prior_influence=prior_influence)
+            else:
+                raise ValueError("Only linear loss supported")
+        max_epochs = opts.sgd_max_epochs
+        if opts.sgd_warm_start_epochs > 0 and self.n_weight_updates > 0:
+            # w is the solution of the previous feedback iteration, and most
+            # iterations add only one label; hence, fewer epochs suffice.
+            max_epochs = min(max_epochs, opts.sgd_warm_start_epochs)
+
+        tm = Timer()
+        x_hf, y_hf = x[hf, :], y[hf]
+        if opts.sgd_optimizer == SGD_PLAIN:
+            w_new = sgd(w, x_hf, y_hf, if_f, if_g,
+                        learning_rate=opts.sgd_learning_rate, max_epochs=max_epochs, eps=opts.sgd_eps,
+                        shuffle=True, rng=self.random_state, f_grad=if_fg)
+        elif opts.sgd_optimizer == SGD_MOMENTUM:
+            w_new = sgdMomentum(w, x_hf, y_hf, if_f, if_g,
+                                learning_rate=opts.sgd_learning_rate, max_epochs=max_epochs, eps=opts.sgd_eps,
+                                shuffle=True, rng=self.random_state, f_grad=if_fg,
+                                avg_loss_window=opts.sgd_loss_window)
+        elif opts.sgd_optimizer == SGD_RMSPROP:
             # sgdRMSProp seems to run fastest and achieve performance close to best
             # NOTE: this was an observation on ANNThyroid_1v3 and toy2 datasets
-            w_new = sgdRMSProp(w, x[hf, :], y[hf], if_f, if_g,
-                               learning_rate=0.001, max_epochs=1000,
-                               shuffle=True, rng=self.random_state)
-        elif False:
+            w_new = sgdRMSProp(w, x_hf, y_hf, if_f, if_g,
+                               learning_rate=opts.sgd_learning_rate, max_epochs=max_epochs, eps=opts.sgd_eps,
+                               shuffle=True, rng=self.random_state, f_grad=if_fg,
+                               avg_loss_window=opts.sgd_loss_window)
+        elif opts.sgd_optimizer == SGD_ADAM:
             # sgdAdam seems to get best performance while a little slower than sgdRMSProp
             # NOTE: this was an observation on ANNThyroid_1v3 and toy2 datasets
-            w_new = sgdAdam(w, x[hf, :], y[hf], if_f, if_g,
-                            learning_rate=0.001, max_epochs=1000,
-                            shuffle=True, rng=self.random_state)
+            w_new = sgdAdam(w, x_hf, y_hf, if_f, if_g,
+                            learning_rate=opts.sgd_learning_rate, max_epochs=max_epochs, eps=opts.sgd_eps,
+                            shuffle=True, rng=self.random_state, f_grad=if_fg,
+                            avg_loss_window=opts.sgd_loss_window)
+        elif opts.sgd_optimizer == SGD_RMSPROP_NESTEROV:
+            w_new = sgdRMSPropNestorov(w, x_hf, y_hf, if_f, if_g,
+                                       learning_rate=opts.sgd_learning_rate, max_epochs=max_epochs, eps=opts.sgd_eps,
+                                       shuffle=True, rng=self.random_state,
+                                       avg_loss_window=opts.sgd_loss_window)
         else:
-            w_new = sgdRMSPropNestorov(w, x[hf, :], y[hf], if_f, if_g,
-                                       learning_rate=0.001, max_epochs=1000,
-                                       shuffle=True, rng=self.random_state)
+            raise ValueError("Invalid sgd optimizer: %s" % str(opts.sgd_optimizer))
+        self.n_weight_updates += 1
+        self.weight_update_time = tm.elapsed()
         w_len = w_new.dot(w_new)
         # logger.debug("w_len: %f" % w_len)
         if np.isnan(w_len):
@@ -413,7 +550,10 @@ class Aad(object):
 
             metrics.queried = xis  # xis keeps growing with each feedback iteration
 
-            order_anom_idxs, anom_score = self.order_by_score(x, self.w)
+            # the query models only look at the top few ranked instances; hence,
+            # the order is computed lazily for only as many as are accessed
+            order_anom_idxs = self.get_score_ranking(x, self.w)
+            anom_score = order_anom_idxs.scores
 
             xi_ = qstate.get_next_query(maxpos=n, ordered_indexes=order_anom_idxs,
                                         queried_items=xis,
@@ -446,8 +586,10 @@ class Aad(object):
 
             qstate.update_query_state()
 
+            weight_update_time = 0.
             if not opts.do_not_update_weights:
                 self.update_weights(x, y, ha=ha, hn=hn, opts=opts, tau_score=est_tau_val)
+                weight_update_time = self.weight_update_time
 
             if self.event_listener is not None:
                 self.event_listener(event_type=EVT_AFTER_FEEDBACK, x=x, y=y,
@@ -458,8 +600,8 @@ class Aad(object):
             if np.mod(i, 1) == 0:
                 endtime_iter = timer()
                 tdiff = difftime(endtime_iter, starttime_iter, units="secs")
-                logger.debug("Completed [%s] fid %d rerun %d feedback %d in %f sec(s)" %
-                             (opts.dataset, opts.fid, opts.runidx, i, tdiff))
+                logger.debug("Completed [%s] fid %d rerun %d feedback %d in %f sec(s) (weight update: %f sec(s))" %
+                             (opts.dataset, opts.fid, opts.runidx, i, tdiff, weight_update_time))
 
         return metrics
 
@@ -145,76 +145,80 @@ def aad_batch():
             # fit the model
             event_listener = AadListenerForRules(X_train, labels)
             model = get_aad_model(X_train, opts, random_state, event_listener=event_listener)
-            model.fit(X_train)
-
-            if is_forest_detector(opts.detector_type) and \
-                    opts.forest_score_type == ORIG_TREE_SCORE_TYPE:
-                orig_num_seen = evaluate_forest_original(X_train, labels, opts.budget, model, x_new=None)
-                tmp = np.zeros((1, 2+orig_num_seen.shape[1]), dtype=orig_num_seen.dtype)
-                tmp[0, 0:2] = [opts.fid, runidx]
-                tmp[0, 2:tmp.shape[1]] = orig_num_seen[0, :]
-                all_orig_num_seen = rbind(all_orig_num_seen, tmp)
-                logger.debug(tm_run.message("Original detector runidx: %d" % runidx))
-                continue
-
-            if is_forest_detector(opts.detector_type):
-                logger.debug("total #nodes: %d" % (len(model.all_regions)))
-
-            X_train_new = model.transform_to_ensemble_features(X_train, dense=dense, norm_unit=opts.norm_unit)
-
-            if False and opts.norm_unit:
-                norms = X_train_new.power(2).sum(axis=1)
-                logger.debug("norms:\n%s" % str(list(norms.T)))
-
-            baseline_w = model.get_uniform_weights()
-
-            agg_scores = model.get_score(X_train_new, baseline_w)
-            if False and is_forest_detector(opts.detector_type):
-                original_scores = 0.5 - model.decision_function(X_train)
-                queried = np.argsort(-original_scores)
-                n_found = np.cumsum(labels[queried[np.arange(opts.budget)]])
-                logger.debug("#anomalies found by original detector:\n%s" % str(list(n_found)))
-
-            if baseline_query_indexes_only:
-                baseline_query_info.append(get_queried_indexes(agg_scores, labels, opts))
-                continue
-
-            ensemble = Ensemble(X_train, labels, X_train_new, baseline_w,
-                                agg_scores=agg_scores, original_indexes=np.arange(X_train.shape[0]),
-                                auc=0.0, model=None)
-
-            # model.init_weights(init_type=opts.init, samples=X_train_new)
-            model.init_weights(init_type=opts.init, samples=None)
-
-            metrics = model.aad_learn_ensemble_weights_with_budget(ensemble, opts)
-
-            if metrics is not None:
-                num_seen, num_seen_baseline, queried_indexes, queried_indexes_baseline = \
-                    summarize_ensemble_num_seen(ensemble, metrics, fid=opts.fid)
-                all_num_seen = rbind(all_num_seen, num_seen)
-                all_num_seen_baseline = rbind(all_num_seen_baseline, num_seen_baseline)
-                all_queried_indexes = rbind(all_queried_indexes, queried_indexes)
-                all_queried_indexes_baseline = rbind(all_queried_indexes_baseline, queried_indexes_baseline)
-                logger.debug("baseline: \n%s" % str([v for v in num_seen_baseline[0, :]]))
-                logger.debug("num_seen: \n%s" % str([v for v in num_seen[0, :]]))
-
-                if False:
-                    debug_qvals(X_train_new, model, metrics, args.resultsdir, opts)
-            else:
-                queried = np.argsort(-agg_scores)
-                n_found = np.cumsum(labels[queried[np.arange(60)]])
-                all_baseline = all_baseline + ",".join([str(v) for v in n_found]) + os.linesep
-
-                orig_iforest_scores = model.decision_function(X_train)  # smaller is more anomalous
-                queried = np.argsort(orig_iforest_scores)
-                n_found = np.cumsum(labels[queried[np.arange(60)]])
-                all_orig_iforest = all_orig_iforest + ",".join([str(v) for v in n_found]) + os.linesep
-
-            event_listener.output_all_data(opts)
-            logger.debug(tm_run.message("Completed runidx: %d" % runidx))
-
-            if runidx == 1 and False:
-                plot_tsne_queries(X_train, labels, ensemble, metrics, opts)
+            try:
+                model.fit(X_train)
+
+                if is_forest_detector(opts.detector_type) and \
+                        opts.forest_score_type == ORIG_TREE_SCORE_TYPE:
+                    orig_num_seen = evaluate_forest_original(X_train, labels, opts.budget, model, x_new=None)
+                    tmp = np.zeros((1, 2+orig_num_seen.shape[1]), dtype=orig_num_seen.dtype)
+                    tmp[0, 0:2] = [opts.fid, runidx]
+                    tmp[0, 2:tmp.shape[1]] = orig_num_seen[0, :]
+                    all_orig_num_seen = rbind(all_orig_num_seen, tmp)
+                    logger.debug(tm_run.message("Original detector runidx: %d" % runidx))
+                    continue
+
+                if is_forest_detector(opts.detector_type):
+                    logger.debug("total #nodes: %d" % (len(model.all_regions)))
+
+                X_train_new = model.transform_to_ensemble_features(X_train, dense=dense, norm_unit=opts.norm_unit)
+
+                if False and opts.norm_unit:
+                    norms = X_train_new.power(2).sum(axis=1)
+                    logger.debug("norms:\n%s" % str(list(norms.T)))
+
+                baseline_w = model.get_uniform_weights()
+
+                agg_scores = model.get_score(X_train_new, baseline_w)
+                if False and is_forest_detector(opts.detector_type):
+                    original_scores = 0.5 - model.decision_function(X_train)
+                    queried = np.argsort(-original_scores)
+                    n_found = np.cumsum(labels[queried[np.arange(opts.budget)]])
+                    logger.debug("#anomalies found by original detector:\n%s" % str(list(n_found)))
+
+                if baseline_query_indexes_only:
+                    baseline_query_info.append(get_queried_indexes(agg_scores, labels, opts))
+                    continue
+
+                ensemble = Ensemble(X_train, labels, X_train_new, baseline_w,
+                                    agg_scores=agg_scores, original_indexes=np.arange(X_train.shape[0]),
+                                    auc=0.0, model=None)
+
+                # model.init_weights(init_type=opts.init, samples=X_train_new)
+                model.init_weights(init_type=opts.init, samples=None)
+
+                metrics = model.aad_learn_ensemble_weights_with_budget(ensemble, opts)
+
+                if metrics is not None:
+                    num_seen, num_seen_baseline, queried_indexes, queried_indexes_baseline = \
+                        summarize_ensemble_num_seen(ensemble, metrics, fid=opts.fid)
+                    all_num_seen = rbind(all_num_seen, num_seen)
+                    all_num_seen_baseline = rbind(all_num_seen_baseline, num_seen_baseline)
+                    all_queried_indexes = rbind(all_queried_indexes, queried_indexes)
+                    all_queried_indexes_baseline = rbind(all_queried_indexes_baseline, queried_indexes_baseline)
+                    logger.debug("baseline: \n%s" % str([v for v in num_seen_baseline[0, :]]))
+                    logger.debug("num_seen: \n%s" % str([v for v in num_seen[0, :]]))
+
+                    if False:
+                        debug_qvals(X_train_new, model, metrics, args.resultsdir, opts)
+                else:
+                    queried = np.argsort(-agg_scores)
+                    n_found = np.cumsum(labels[queried[np.arange(60)]])
+                    all_baseline = all_baseline + ",".join([str(v) for v in n_found]) + os.linesep
+
+                    orig_iforest_scores = model.decision_function(X_train)  # smaller is more anomalous
+                    queried = np.argsort(orig_iforest_scores)
+                    n_found = np.cumsum(labels[queried[np.arange(60)]])
+                    all_orig_iforest = all_orig_iforest + ",".join([str(v) for v in n_found]) + os.linesep
+
+                event_listener.output_all_data(opts)
+                logger.debug(tm_run.message("Completed runidx: %d" % runidx))
+
+                if runidx == 1 and False:
+                    plot_tsne_queries(X_train, labels, ensemble, metrics, opts)
+            finally:
+                # the workers are restarted if the model is used again by the tests below
+                model.close_workers()
 
             if not run_tests:
                 metrics = None  # release memory
@@ -239,8 +243,12 @@ def aad_batch():
             write_baseline_query_indexes(baseline_query_info, opts)
 
     if run_tests:
-        aad_unit_tests_battery(X_train, labels, model, metrics, opts,
-                               args.resultsdir, dataset_name=args.dataset)
+        try:
+            aad_unit_tests_battery(X_train, labels, model, metrics, opts,
+                                   args.resultsdir, dataset_name=args.dataset)
+        finally:
+            if model is not None:
+                model.close_workers()
 
 
 if __name__ == "__main__":
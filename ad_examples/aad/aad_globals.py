@@ -1,6 +1,7 @@
 from argparse import ArgumentParser
 from copy import copy
 from ..common.utils import *
+from ..common.set_cover import *
 
 # ==============================
 # Initialization Types
@@ -153,6 +154,18 @@ OPTIMLIB_CVXOPT = 'cvxopt'
 # ------------------------------
 
 
+# ==============================
+# SGD optimizers for the AAD weight updates
+# ------------------------------
+SGD_PLAIN = "sgd"
+SGD_MOMENTUM = "momentum"
+SGD_RMSPROP = "rmsprop"
+SGD_ADAM = "adam"
+SGD_RMSPROP_NESTEROV = "nesterov"
+sgd_optimizer_types = [SGD_PLAIN, SGD_MOMENTUM, SGD_RMSPROP, SGD_ADAM, SGD_RMSPROP_NESTEROV]
+# ------------------------------
+
+
 def get_aad_option_list():
     parser = ArgumentParser()
     parser.add_argument("--filedir", action="store", default="",
@@ -250,6 +263,19 @@ def get_aad_option_list():
                         help="File path to debug logs")
     parser.add_argument("--optimlib", type=str, default=OPTIMLIB_SCIPY, required=False,
                         help="optimization library to use")
+    parser.add_argument("--sgd_optimizer", type=str, default=SGD_RMSPROP, required=False,
+                        help="SGD variant for the weight updates (%s)" % "|".join(sgd_optimizer_types))
+    parser.add_argument("--sgd_learning_rate", action="store", type=float, default=0.001,
+                        help="Learning rate for the SGD weight updates")
+    parser.add_argument("--sgd_max_epochs", action="store", type=int, default=1000,
+                        help="Maximum number of epochs for each SGD weight update")
+    parser.add_argument("--sgd_eps", action="store", type=float, default=1e-6,
+                        help="Convergence tolerance on the loss for the SGD weight updates")
+    parser.add_argument("--sgd_loss_window", action="store", type=int, default=20,
+                        help="SGD stops early if the average loss over this many epochs changes by less than sgd_eps")
+    parser.add_argument("--sgd_warm_start_epochs", action="store", type=int, default=0,
+                        help="If > 0, weight updates after the first one start from the previous "
+                             "solution and run at most these many epochs")
     parser.add_argument("--op", type=str, default="nop", required=False,
                         help="name of operation")
     parser.add_argument("--cachetype", type=str, default="pydata", required=False,
@@ -281,7 +307,8 @@ def get_aad_option_list():
     parser.add_argument("--ifor_add_leaf_nodes_only", action="store_true", default=True,
                         help="Whether to include only leaf node regions only or intermediate node regions as well.")
     parser.add_argument("--tree_update_type", action="store", type=int, default=0,  # 0 - TREE_UPD_OVERWRITE
-                        help="Type of update to Tree node counts (applies to HS Trees and RS Forest only). " +
+                        help="Type of update to Tree node counts (applies to HS Trees and RS Forest only) " +
+                             "and to LODA histogram counts. " +
                              "0 - overwrite with new counts, 1 - average of previous and current counts.")
     parser.add_argument("--modelfile", action="store", default="",
                         help="Model file path in case the model needs to be saved or loaded. " +
@@ -324,6 +351,9 @@ def get_aad_option_list():
 
     parser.add_argument("--streaming", action="store_true", default=False,
                         help="Whether to run the algorithm in streaming setting")
+    parser.add_argument("--stream_chunksize", action="store", type=int, default=0,
+                        help="If > 0, the streaming data file is read in chunks of these many rows " +
+                             "instead of being loaded entirely into memory")
     parser.add_argument("--stream_window", action="store", type=int, default=512,
                         help="Number of instances to hold in buffer before updating the model")
     parser.add_argument("--max_windows", action="store", type=int, default=30,
@@ -371,6 +401,13 @@ def get_aad_option_list():
     parser.add_argument("--describe_volume_p", action="store", type=int, default=1,
                         help="Exponent for region volume while computing descriptions. " +
                              "Higher power encourages selection of smaller volumes")
+    parser.add_argument("--describe_solver", action="store", type=str, default=SET_COVER_ILP,
+                        help="Solver for selecting the compact set of regions that cover the anomalies (%s). "
+                             "greedy and lp are fast approximations; ilp is exact but may be slow "
+                             "for many instances" % "|".join(set_cover_solvers))
+    parser.add_argument("--describe_ilp_time_limit", action="store", type=float, default=0,
+                        help="Time limit (seconds) for the ilp solver; the greedy solution is used "
+                             "if the ilp does not find a solution in time. 0 implies no limit")
 
     parser.add_argument("--query_module_name", action="store", type=str, default="aad.query_model_other",
                         help="Module/package name of the custom query model to use. " +
@@ -472,6 +509,12 @@ class AadOpts(object):
         self.query_search_depth = args.query_search_depth
         self.query_euclidean_dist_type = args.query_euclidean_dist_type
         self.optimlib = args.optimlib
+        self.sgd_optimizer = args.sgd_optimizer
+        self.sgd_learning_rate = args.sgd_learning_rate
+        self.sgd_max_epochs = args.sgd_max_epochs
+        self.sgd_eps = args.sgd_eps
+        self.sgd_loss_window = args.sgd_loss_window
+        self.sgd_warm_start_epochs = args.sgd_warm_start_epochs
         self.exclude = None
         self.keep = args.keep
         self.norm_unit = args.norm_unit
@@ -520,6 +563,7 @@ class AadOpts(object):
 
         self.streaming = args.streaming
         self.stream_window = args.stream_window
+        self.stream_chunksize = args.stream_chunksize
         self.max_windows = args.max_windows
         self.min_feedback_per_window = args.min_feedback_per_window
         self.max_feedback_per_window = args.max_feedback_per_window
@@ -538,6 +582,8 @@ class AadOpts(object):
         self.describe_anomalies = args.describe_anomalies
         self.describe_n_top = args.describe_n_top
         self.describe_volume_p = args.describe_volume_p
+        self.describe_solver = args.describe_solver
+        self.describe_ilp_time_limit = args.describe_ilp_time_limit
 
         self.query_module_name = args.query_module_name
         self.query_class_name = args.query_class_name
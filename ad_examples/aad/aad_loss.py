@@ -1,7 +1,118 @@
 import numpy as np
+from scipy import sparse
 from ..common.utils import *
 
 
+def get_aad_hinge_masks(s, yi, qval, in_constr_set=None, tau_val=None):
+    """
+    Identifies the labeled instances which violate the AAD hinge constraints
+
+    :param s: numpy.array
+        scores of the labeled instances
+    :param yi: numpy.array
+        labels (1: anomaly, 0: nominal)
+    :param qval: float
+        tau-th quantile value
+    :param in_constr_set: numpy.array
+        1 for instances included in the tau-relative constraints
+    :param tau_val: float
+        score of the tau-th ranked instance
+    :return: tuple
+        n_anom, n_noml, and the boolean masks (anomalies below qval,
+        nominals above qval, anomalies below tau_val, nominals above tau_val).
+        The masks are None if the corresponding constraint is not applicable.
+    """
+    is_anom = yi == 1
+    is_noml = yi == 0
+    n_anom = int(np.sum(is_anom))
+    n_noml = len(yi) - n_anom
+
+    anom_q = noml_q = anom_tau = noml_tau = None
+    if qval is not None:
+        anom_q = np.logical_and(is_anom, s < qval)
+        noml_q = np.logical_and(is_noml, s >= qval)
+
+    if tau_val is not None:
+        # loss =
+        #   Cx * (x_tau - xi).w  if yi = 1 and (x_tau - xi).w > 0
+        #   Cx * (xi - x_tau).w  if y1 = 0 and (xi - x_tau).w > 0
+        if in_constr_set is not None:
+            # in_constr_set might have entries beyond the labeled instances
+            in_set = np.asarray(in_constr_set[0:len(yi)]) == 1
+            is_anom = np.logical_and(is_anom, in_set)
+            is_noml = np.logical_and(is_noml, in_set)
+        anom_tau = np.logical_and(is_anom, s < tau_val)
+        noml_tau = np.logical_and(is_noml, s >= tau_val)
+
+    return n_anom, n_noml, anom_q, noml_q, anom_tau, noml_tau
+
+
+def _aad_loss_from_scores(w, s, yi, qval, in_constr_set=None, tau_val=None,
+                          Ca=1.0, Cn=1.0, Cx=1.0,
+                          withprior=False, w_prior=None, sigma2=1.0, prior_influence=1.0):
+    n_anom, n_noml, anom_q, noml_q, anom_tau, noml_tau = get_aad_hinge_masks(s, yi, qval, in_constr_set, tau_val)
+
+    loss_a = 0  # loss w.r.t w for anomalies
+    loss_n = 0  # loss w.r.t w for nominals
+    if anom_q is not None:
+        loss_a += Ca * np.sum(qval - s[anom_q])
+        loss_n += Cn * np.sum(s[noml_q] - qval)
+    if anom_tau is not None:
+        # add loss relative to tau-th ranked instance
+        loss_a += Cx * np.sum(tau_val - s[anom_tau])
+        loss_n += Cx * np.sum(s[noml_tau] - tau_val)
+
+    loss = (loss_a / max(1, n_anom)) + (loss_n / max(1, n_noml))
+
+    if withprior and w_prior is not None:
+        w_diff = w - w_prior
+        loss += (1. * prior_influence / (2. * sigma2)) * (w_diff.dot(w_diff))
+
+    return loss
+
+
+def _aad_loss_gradient_from_scores(w, s, xi, yi, qval, in_constr_set=None, x_tau=None, tau_val=None,
+                                   Ca=1.0, Cn=1.0, Cx=1.0,
+                                   withprior=False, w_prior=None, sigma2=1.0, prior_influence=1.0):
+    n_anom, n_noml, anom_q, noml_q, anom_tau, noml_tau = get_aad_hinge_masks(s, yi, qval, in_constr_set, tau_val)
+
+    norm_a = 1. / max(1, n_anom)
+    norm_n = 1. / max(1, n_noml)
+
+    # The gradient is a weighted sum of the rows of xi (and x_tau). We first
+    # accumulate the weight of each row and then compute the sum with one product.
+    row_coefs = np.zeros(len(yi), dtype=float)
+    tau_coef = 0.
+    if anom_q is not None:
+        # loss_a = loss_a - Ca * xi[i, :]; loss_n = loss_n + Cn * xi[i, :]
+        row_coefs[anom_q] -= Ca * norm_a
+        row_coefs[noml_q] += Cn * norm_n
+    if anom_tau is not None:
+        # loss_gradient =
+        #   Cx * (x_tau - xi)  if yi = 1 and (x_tau - xi).w > 0
+        #   Cx * (xi - x_tau)  if y1 = 0 and (xi - x_tau).w > 0
+        row_coefs[anom_tau] -= Cx * norm_a
+        row_coefs[noml_tau] += Cx * norm_n
+        tau_coef = Cx * (np.sum(anom_tau) * norm_a - np.sum(noml_tau) * norm_n)
+
+    grad = np.asarray(xi.T.dot(row_coefs), dtype=float).reshape(-1)
+    if tau_coef != 0:
+        grad += tau_coef * np.asarray(x_tau.todense() if sparse.issparse(x_tau) else x_tau,
+                                      dtype=float).reshape(-1)
+
+    if withprior and w_prior is not None:
+        w_diff = w - w_prior
+        grad += (1. * prior_influence / sigma2) * w_diff
+
+    return grad
+
+
+def _get_tau_val(x_tau, w):
+    if x_tau is None:
+        return None
+    return x_tau.dot(w)[0]
+
+
 def aad_loss_linear(w, xi, yi, qval, in_constr_set=None, x_tau=None,
                     Ca=1.0, Cn=1.0, Cx=1.0,
                     withprior=False, w_prior=None, sigma2=1.0, prior_influence=1.0):
@@ -29,52 +140,11 @@ def aad_loss_linear(w, xi, yi, qval, in_constr_set=None, x_tau=None,
     :return:
     """
     s = xi.dot(w)
-
-    loss_a = 0  # loss w.r.t w for anomalies
-    loss_n = 0  # loss w.r.t w for nominals
-    n_anom = 0
-    n_noml = 0
-    tau_rel_loss = None
-    if x_tau is not None:
-        tau_rel_loss = x_tau.dot(w)
-    for i in range(len(yi)):
-        lbl = yi[i]
-
-        if lbl == 1:
-            n_anom += 1
-        else:
-            n_noml += 1
-
-        if qval is not None:
-            if lbl == 1 and s[i] < qval:
-                loss_a += Ca * (qval - s[i])
-            elif lbl == 0 and s[i] >= qval:
-                loss_n += Cn * (s[i] - qval)
-            else:
-                # no loss
-                pass
-
-        if tau_rel_loss is not None and (in_constr_set is None or in_constr_set[i] == 1):
-            # add loss relative to tau-th ranked instance
-            # loss =
-            #   Cx * (x_tau - xi).w  if yi = 1 and (x_tau - xi).w > 0
-            #   Cx * (xi - x_tau).w  if y1 = 0 and (xi - x_tau).w > 0
-            tau_val = tau_rel_loss[0]
-            if lbl == 1 and s[i] < tau_val:
-                loss_a += Cx * (tau_val - s[i])
-            elif lbl == 0 and s[i] >= tau_val:
-                loss_n += Cx * (s[i] - tau_val)
-            else:
-                # no loss
-                pass
-
-    loss = (loss_a / max(1, n_anom)) + (loss_n / max(1, n_noml))
-
-    if withprior and w_prior is not None:
-        w_diff = w - w_prior
-        loss += (1. * prior_influence / (2. * sigma2)) * (w_diff.dot(w_diff))
-
-    return loss
+    return _aad_loss_from_scores(w, s, yi, qval, in_constr_set=in_constr_set,
+                                 tau_val=_get_tau_val(x_tau, w),
+                                 Ca=Ca, Cn=Cn, Cx=Cx,
+                                 withprior=withprior, w_prior=w_prior,
+                                 sigma2=sigma2, prior_influence=prior_influence)
 
 
 def aad_loss_gradient_linear(w, xi, yi, qval, in_constr_set=None, x_tau=None,
@@ -87,86 +157,32 @@ def aad_loss_gradient_linear(w, xi, yi, qval, in_constr_set=None, x_tau=None,
         else:
             jacobian( score_loss + 1/(2*sigma2) * (w - w_prior)^2 )
     """
-
-    m = ncol(xi)
-
-    grad = np.zeros(m, dtype=float)
-
     s = xi.dot(w)
+    return _aad_loss_gradient_from_scores(w, s, xi, yi, qval, in_constr_set=in_constr_set,
+                                          x_tau=x_tau, tau_val=_get_tau_val(x_tau, w),
+                                          Ca=Ca, Cn=Cn, Cx=Cx,
+                                          withprior=withprior, w_prior=w_prior,
+                                          sigma2=sigma2, prior_influence=prior_influence)
 
-    loss_a = rep(0, m)  # the derivative of loss w.r.t w for anomalies
-    loss_n = rep(0, m)  # the derivative of loss w.r.t w for nominals
-    n_anom = 0
-    n_noml = 0
-    anom_idxs = list()
-    noml_idxs = list()
-    anom_tau_idxs = list()
-    noml_tau_idxs = list()
-
-    tau_score = None
-    if x_tau is not None:
-        tau_score = x_tau.dot(w)
-
-    for i in range(len(yi)):
-        lbl = yi[i]
 
-        if lbl == 1:
-            n_anom += 1
-        else:
-            n_noml += 1
-
-        if qval is not None:
-            if lbl == 1 and s[i] < qval:
-                # loss_a[:] = loss_a - Ca * xi[i, :]
-                anom_idxs.append(i)
-            elif lbl == 0 and s[i] >= qval:
-                # loss_n[:] = loss_n + Cn * xi[i, :]
-                noml_idxs.append(i)
-            else:
-                # no loss
-                pass
-
-        # add loss-gradient relative to tau-th ranked instance
-        if x_tau is not None and (in_constr_set is None or in_constr_set[i] == 1):
-            # add loss-gradient relative to tau-th ranked instance
-            # loss =
-            #   Cx * (x_tau - xi).w  if yi = 1 and (x_tau - xi).w > 0
-            #   Cx * (xi - x_tau).w  if y1 = 0 and (xi - x_tau).w > 0
-            # loss_gradient =
-            #   Cx * (x_tau - xi)  if yi = 1 and (x_tau - xi).w > 0
-            #   Cx * (xi - x_tau)  if y1 = 0 and (xi - x_tau).w > 0
-            tau_val = tau_score[0]
-            if lbl == 1 and s[i] < tau_val:
-                # loss_a[:] = loss_a + Cx * (x_tau - xi[i, :])
-                anom_tau_idxs.append(i)
-            elif lbl == 0 and s[i] >= tau_val:
-                # loss_n[:] = loss_n + Cx * (xi[i, :] - x_tau)
-                noml_tau_idxs.append(i)
-            else:
-                # no loss
-                pass
-
-    anom_idxs = np.array(anom_idxs, dtype=int)
-    noml_idxs = np.array(noml_idxs, dtype=int)
-    anom_tau_idxs = np.array(anom_tau_idxs, dtype=int)
-    noml_tau_idxs = np.array(noml_tau_idxs, dtype=int)
-
-    if len(anom_idxs) > 0:
-        loss_a[:] = -Ca * np.sum(xi[anom_idxs], axis=0)
-    if len(anom_tau_idxs) > 0:
-        loss_a[:] = loss_a + Cx * (len(anom_tau_idxs) * x_tau - np.sum(xi[anom_tau_idxs], axis=0))
-
-    if len(noml_idxs) > 0:
-        loss_n[:] = Cn * np.sum(xi[noml_idxs], axis=0)
-    if len(noml_tau_idxs) > 0:
-        loss_n[:] = loss_n + Cx * (np.sum(xi[noml_tau_idxs], axis=0) - len(noml_tau_idxs) * x_tau)
-
-    grad[0:m] = (loss_a / max(1, n_anom)) + (loss_n / max(1, n_noml))
-
-    if withprior and w_prior is not None:
-        prior_mul = max(1., n_anom + n_noml)
-        w_diff = w - w_prior
-        grad[0:m] += (1. * prior_influence / sigma2) * w_diff
-
-    return grad
+def aad_loss_and_gradient_linear(w, xi, yi, qval, in_constr_set=None, x_tau=None,
+                                 Ca=1.0, Cn=1.0, Cx=1.0,
+                                 withprior=False, w_prior=None, sigma2=1.0, prior_influence=1.0):
+    """
+    Computes both the AAD loss and its jacobian with a single evaluation of xi.dot(w)
 
+    :return: float, numpy.array
+        same values as (aad_loss_linear(...), aad_loss_gradient_linear(...))
+    """
+    s = xi.dot(w)
+    tau_val = _get_tau_val(x_tau, w)
+    loss = _aad_loss_from_scores(w, s, yi, qval, in_constr_set=in_constr_set, tau_val=tau_val,
+                                 Ca=Ca, Cn=Cn, Cx=Cx,
+                                 withprior=withprior, w_prior=w_prior,
+                                 sigma2=sigma2, prior_influence=prior_influence)
+    grad = _aad_loss_gradient_from_scores(w, s, xi, yi, qval, in_constr_set=in_constr_set,
+                                          x_tau=x_tau, tau_val=tau_val,
+                                          Ca=Ca, Cn=Cn, Cx=Cx,
+                                          withprior=withprior, w_prior=w_prior,
+                                          sigma2=sigma2, prior_influence=prior_influence)
+    return loss, grad
@@ -24,6 +24,11 @@ class StreamingAnomalyDetector(object):
         unlabeled: InstanceList
         buffer: InstanceList
             test set from stream
+        buffer_hist: RegionHistogram
+            Region counts of the instances in buffer. Maintained as instances
+            are added when KL-divergence is checked for forest-based models.
+        current_dists: np.array
+            Reference region distributions for the KL-divergence check
         initial_labeled: InstanceList
         initial_anomalies: InstanceList
         initial_nominals: InstanceList
@@ -40,6 +45,7 @@ class StreamingAnomalyDetector(object):
         self.n_prelabeled_instances = 0
 
         self.buffer = None
+        self.buffer_hist = None
 
         self.initial_labeled, self.initial_anomalies, self.initial_nominals = \
             self.get_initial_labeled(labeled_x, labeled_y, labeled_ids)
@@ -64,9 +70,7 @@ class StreamingAnomalyDetector(object):
         if is_forest_detector(self.opts.detector_type):
             # initialize the baseline instance distributions required for evaluating KL-divergence
             all_instances = self._get_all_instances()
-            self.current_dists = self.model.get_node_sample_distributions(all_instances.x)
-
-            kl_trees, self.kl_q_alpha = self.model.get_KL_divergence_distribution(all_instances.x, alpha=self.kl_alpha)
+            kl_trees = self.reset_reference_distributions(all_instances.x)
             logger.debug("kl kl_q_alpha: %s (alpha=%0.2f), kl mean: %f, kl_trees:\n%s" %
                          (str(list(self.kl_q_alpha)), self.kl_alpha, np.mean(kl_trees), str(list(kl_trees))))
 
@@ -215,6 +219,7 @@ class StreamingAnomalyDetector(object):
 
     def reset_buffer(self):
         self.buffer = None
+        self.buffer_hist = None
 
     def add_to_buffer(self, instances):
         if self.buffer is not None:
@@ -222,6 +227,49 @@ class StreamingAnomalyDetector(object):
                                       instances.ids, instances.x_transformed)
         else:
             self.buffer = instances
+        if is_forest_detector(self.opts.detector_type) and self.opts.check_KL_divergence:
+            # only the new instances are passed through the trees
+            if self.buffer_hist is None:
+                self.buffer_hist = self.model.get_region_histogram()
+            self.model.add_to_region_histogram(self.buffer_hist, instances.x)
+
+    def reset_reference_distributions(self, x, hist=None):
+        """ Sets the reference region distributions and KL-divergence thresholds from x
+
+        :param x: np.ndarray
+        :param hist: RegionHistogram
+            Region counts of x for the current trees. If None, x is passed
+            through the trees once.
+        :return: np.array
+            KL-divergence of each tree between the two halves of x
+        """
+        if hist is None:
+            hist = self.model.get_region_histogram(x)
+        self.current_dists = hist.get_distribution()
+        kl_trees, self.kl_q_alpha = self.model.get_KL_divergence_distribution(x, alpha=self.kl_alpha, hist=hist)
+        return kl_trees
+
+    def get_buffer_KL_divergence(self):
+        """ Checks the KL-divergence of the buffer from the reference distributions
+
+        The region counts of the buffer are maintained as instances arrive.
+        Hence, this is cheap and may be called at a finer granularity than
+        the stream window, e.g., after every few instances read with
+        get_next_from_stream(n). Note that the thresholds were set with
+        halves of a full window; KL-divergence estimated from far fewer
+        instances tends to be larger.
+
+        :return: np.array, np.array, bool
+            KL-divergence of each tree, the trees whose KL-divergence exceeds
+            their threshold, and whether sufficient trees exceed the threshold
+            for the model to be updated
+        """
+        kl_trees, _ = self.model.get_KL_divergence_distribution(self.buffer.x, p=self.current_dists,
+                                                                hist=self.buffer_hist)
+        replace_trees_by_kl = self.model.get_trees_to_replace(kl_trees, self.kl_q_alpha)
+        n_threshold = int(2 * self.kl_alpha * self.model.clf.n_estimators)
+        drifted = self.model.clf.n_estimators > 0 and len(replace_trees_by_kl) >= n_threshold
+        return kl_trees, replace_trees_by_kl, drifted
 
     def move_buffer_to_unlabeled(self):
         if self.opts.retention_type == STREAM_RETENTION_OVERWRITE:
@@ -320,32 +368,40 @@ class StreamingAnomalyDetector(object):
                             min_samples_required, self.min_samples_for_update, self.opts.stream_window//2))
         else:
             tm = Timer()
-            n_trees = self.model.clf.n_estimators
+            # KL-divergence is checked for forests only; LODA has no trees
+            # and its histograms are always updated
+            is_forest = is_forest_detector(self.opts.detector_type)
+            check_KL_divergence = is_forest and self.opts.check_KL_divergence
+            n_trees = self.model.clf.n_estimators if is_forest else 0
             n_threshold = int(2 * self.kl_alpha * n_trees)
             replace_trees_by_kl = None
 
-            if self.opts.check_KL_divergence:
-                kl_trees, _ = self.model.get_KL_divergence_distribution(self.buffer.x, p=self.current_dists)
-                replace_trees_by_kl = self.model.get_trees_to_replace(kl_trees, self.kl_q_alpha)
+            if check_KL_divergence:
+                kl_trees, replace_trees_by_kl, _ = self.get_buffer_KL_divergence()
                 logger.debug("kl kl_q_alpha: %s (alpha=%0.2f), kl_trees:\n%s\n(#replace: %d): %s" %
                              (str(list(self.kl_q_alpha)), self.kl_alpha, str(list(kl_trees)), len(replace_trees_by_kl), str(list(replace_trees_by_kl))))
 
             n_replace = 0 if replace_trees_by_kl is None else len(replace_trees_by_kl)
 
             # check whether conditions for tree-replacement are satisfied.
-            do_replace = not self.opts.check_KL_divergence or (n_trees > 0 and n_replace >= n_threshold)
+            do_replace = not check_KL_divergence or (n_trees > 0 and n_replace >= n_threshold)
             if do_replace:
                 self.model.update_model_from_stream_buffer(replace_trees=replace_trees_by_kl)
-                if is_forest_detector(self.opts.detector_type):
-                    self.current_dists = self.model.get_node_sample_distributions(self.buffer.x)
-                    kl_trees, self.kl_q_alpha = self.model.get_KL_divergence_distribution(self.buffer.x, alpha=self.kl_alpha)
+                if is_forest:
+                    # the trees have changed; pass the buffer through them once
+                    self.buffer_hist = None
+                    hist = self.model.get_region_histogram(self.buffer.x)
+                    if self.opts.check_KL_divergence:
+                        self.buffer_hist = hist
+                    kl_trees = self.reset_reference_distributions(self.buffer.x, hist=hist)
                     logger.debug("kl kl_q_alpha: %s, kl_trees:\n%s" % (str(list(self.kl_q_alpha)), str(list(kl_trees))))
                 model_updated = True
 
             logger.debug(tm.message(
                 "Model%s updated; n_replace: %d, n_threshold: %d, kl_q_alpha: %s (check_KL: %s, alpha: %0.2f)" %
                 (" not" if not do_replace else "", n_replace, n_threshold,
-                 str(list(self.kl_q_alpha)), str(self.opts.check_KL_divergence), self.kl_alpha)
+                 str(list(self.kl_q_alpha)) if is_forest else str(self.kl_q_alpha),
+                 str(self.opts.check_KL_divergence), self.kl_alpha)
             ))
 
         if transform:
@@ -832,9 +888,12 @@ def aad_stream():
 
     np.random.seed(opts.randseed)
 
-    X_full, y_full = read_data_as_matrix(opts)
-
-    logger.debug("loaded file: (%s) %s" % (str(X_full.shape), opts.datafile))
+    X_full, y_full = None, None
+    if opts.stream_chunksize <= 0:
+        X_full, y_full = read_data_as_matrix(opts)
+        logger.debug("loaded file: (%s) %s" % (str(X_full.shape), opts.datafile))
+    else:
+        logger.debug("streaming file in chunks of %d: %s" % (opts.stream_chunksize, opts.datafile))
     logger.debug("results dir: %s" % opts.resultsdir)
 
     all_num_seen = None
@@ -849,62 +908,71 @@ def aad_stream():
         tm_run = Timer()
         opts.set_multi_run_options(opts.fid, runidx)
 
-        stream = DataStream(X_full, y_full, IdServer(initial=0))
+        if X_full is None:
+            stream = CsvDataStream(opts.datafile, chunksize=opts.stream_chunksize, header=opts.header,
+                                   labelindex=opts.labelindex - 1, startcol=opts.startcol - 1,
+                                   id_server=IdServer(initial=0))
+        else:
+            stream = DataStream(X_full, y_full, IdServer(initial=0))
         # from aad.malware_aad import MalwareDataStream
         # stream = MalwareDataStream(X_full, y_full, IdServer(initial=0))
 
         sad = prepare_stream_anomaly_detector(stream, opts)
 
-        if sad.unlabeled is None:
-            logger.debug("No instances to label")
-            continue
-
-        iter = 0
-        seen = np.zeros(0, dtype=int)
-        n_unlabeled = np.zeros(0, dtype=int)
-        seen_baseline = np.zeros(0, dtype=int)
-        queried = np.zeros(0, dtype=int)
-        stream_window_tmp = np.zeros(0, dtype=int)
-        stream_window_baseline = np.zeros(0, dtype=int)
-        stop_iter = False
-        while not stop_iter:
-            iter += 1
-
-            tm = Timer()
-            seen_, seen_baseline_, queried_, queried_baseline_, n_unlabeled_ = sad.run_feedback()
-
-            # gather metrics...
-            seen = append(seen, seen_)
-            n_unlabeled = append(n_unlabeled, n_unlabeled_)
-            seen_baseline = append(seen_baseline, seen_baseline_)
-            queried = append(queried, queried_)
-            stream_window_tmp = append(stream_window_tmp, np.ones(len(seen_)) * iter)
-            stream_window_baseline = append(stream_window_baseline, np.ones(len(seen_baseline_)) * iter)
-
-            # get the next window of data from stream and transform features...
-            # Note: Since model update will automatically transform the data, we will
-            # not transform while reading from stream. If however, the model is not
-            # to be updated, then we transform the data while reading from stream
-            instances = sad.get_next_from_stream(sad.max_buffer,
-                                                 transform=(not opts.allow_stream_update))
-            if instances is None or iter >= opts.max_windows or len(queried) >= opts.budget:
-                if iter >= opts.max_windows:
-                    logger.debug("Exceeded %d iters; exiting stream read..." % opts.max_windows)
-                stop_iter = True
-            else:
-                model_updated = False
-                if opts.allow_stream_update:
-                    model_updated = sad.update_model_from_buffer(transform=True)
-
-                sad.move_buffer_to_unlabeled()
-
-                if model_updated:
-                    sad.update_weights_with_no_feedback()
-
-            logger.debug(tm.message("Stream window [%d]: algo [%d/%d]; baseline [%d/%d]; unlabeled anoms [%d]: " %
-                                    (iter, int(np.sum(seen)), len(seen),
-                                     int(np.sum(seen_baseline)), len(seen_baseline),
-                                     int(np.sum(sad.unlabeled.y)))))
+        try:
+            if sad.unlabeled is None:
+                logger.debug("No instances to label")
+                continue
+
+            iter = 0
+            seen = np.zeros(0, dtype=int)
+            n_unlabeled = np.zeros(0, dtype=int)
+            seen_baseline = np.zeros(0, dtype=int)
+            queried = np.zeros(0, dtype=int)
+            stream_window_tmp = np.zeros(0, dtype=int)
+            stream_window_baseline = np.zeros(0, dtype=int)
+            stop_iter = False
+            while not stop_iter:
+                iter += 1
+
+                tm = Timer()
+                seen_, seen_baseline_, queried_, queried_baseline_, n_unlabeled_ = sad.run_feedback()
+
+                # gather metrics...
+                seen = append(seen, seen_)
+                n_unlabeled = append(n_unlabeled, n_unlabeled_)
+                seen_baseline = append(seen_baseline, seen_baseline_)
+                queried = append(queried, queried_)
+                stream_window_tmp = append(stream_window_tmp, np.ones(len(seen_)) * iter)
+                stream_window_baseline = append(stream_window_baseline, np.ones(len(seen_baseline_)) * iter)
+
+                # get the next window of data from stream and transform features...
+                # Note: Since model update will automatically transform the data, we will
+                # not transform while reading from stream. If however, the model is not
+                # to be updated, then we transform the data while reading from stream
+                instances = sad.get_next_from_stream(sad.max_buffer,
+                                                     transform=(not opts.allow_stream_update))
+                if instances is None or iter >= opts.max_windows or len(queried) >= opts.budget:
+                    if iter >= opts.max_windows:
+                        logger.debug("Exceeded %d iters; exiting stream read..." % opts.max_windows)
+                    stop_iter = True
+                else:
+                    model_updated = False
+                    if opts.allow_stream_update:
+                        model_updated = sad.update_model_from_buffer(transform=True)
+
+                    sad.move_buffer_to_unlabeled()
+
+                    if model_updated:
+                        sad.update_weights_with_no_feedback()
+
+                logger.debug(tm.message("Stream window [%d]: algo [%d/%d]; baseline [%d/%d]; unlabeled anoms [%d]: " %
+                                        (iter, int(np.sum(seen)), len(seen),
+                                         int(np.sum(seen_baseline)), len(seen_baseline),
+                                         int(np.sum(sad.unlabeled.y)))))
+        finally:
+            # the worker processes and shared files are not needed beyond this run
+            sad.model.close_workers()
 
         # retained = int(np.sum(sad.unlabeled_y)) if sad.unlabeled_y is not None else 0
         # logger.debug("Final retained unlabeled anoms: %d" % retained)
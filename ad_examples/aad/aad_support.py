@@ -1,4 +1,6 @@
 import gzip
+from scipy import sparse
+from scipy.sparse import csr_matrix
 
 from ..common.utils import *
 from ..common.metrics import *
@@ -13,7 +15,8 @@ from .precomputed_aad import *
 
 def get_aad_model(x, opts, random_state=None, event_listener=None):
     if opts.detector_type == LODA:
-        model = AadLoda(sparsity=opts.sparsity, mink=opts.mink, maxk=opts.maxk)
+        model = AadLoda(sparsity=opts.sparsity, mink=opts.mink, maxk=opts.maxk,
+                        update_type=opts.tree_update_type, n_jobs=opts.n_jobs)
     elif is_forest_detector(opts.detector_type):
         model = AadForest(n_estimators=opts.forest_n_trees,
                           max_samples=min(opts.forest_n_samples, x.shape[0]),
@@ -111,68 +114,124 @@ def get_score_ranges(x, w):
     return qvals
 
 
+def get_linear_score_variances(x, w):
+    """ Returns the linear scores x.w and the variances of the products x_j * w_j for all rows of x
+
+    The variance of a row is computed over its non-zero features only.
+
+    :param x: sparse or dense matrix
+    :param w: np.array
+    :return: np.array, np.array
+        scores and variances; the variance is nan for rows without non-zero features
+    """
+    x = csr_matrix(x)
+    n = x.shape[0]
+    rows = np.repeat(np.arange(n, dtype=int), np.diff(x.indptr))
+    nonzero = x.data != 0
+    rows = rows[nonzero]
+    xw = x.data[nonzero] * w[x.indices[nonzero]]
+    counts = np.bincount(rows, minlength=n)
+    scores = np.bincount(rows, weights=xw, minlength=n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = scores / counts
+        vars = np.bincount(rows, weights=(xw - means[rows]) ** 2, minlength=n) / counts
+    return scores, vars
+
+
 def get_linear_score_variance(x, w):
-    indxs = x.nonzero()[1]  # column indexes
-    x_ = x[0, indxs].todense()
-    xw = np.array(x_) * w[indxs]
-    # xw = x_.reshape(-1, 1) * w[indxs]
-    # logger.debug("xw:\n%s" % str(list(xw)))
-    #xw = np.array(x[0, indxs].multiply(w[indxs]))
-    #xw_mean = xw.mean(axis=1)[0]
-    #xw_sq = xw ** 2
-    #var = xw_sq.mean(axis=1)[0] - xw_mean ** 2
-    var = np.var(xw)
-    score = np.sum(xw)
-    if False:
-        s = x.dot(w)
-        if s != score:
-            logger.debug("size of x: %s" % str(x.shape))
-            logger.debug("x_: %s" % str(list(x_)))
-            logger.debug("w : %s" % str(list(w[indxs])))
-            logger.debug("xw: %s" % str(list(xw)))
-            raise ArithmeticError("s=%f != score=%f" % (s, score))
-    return score, var
-
-
-def get_closest_indexes(inst, test_set, num=1, dest_set=None):
-    n = test_set.shape[0]
-    dists = np.zeros(n)
-    for i in np.arange(n):
-        ts = test_set[i, :]
-        if ts.shape[0] > 1:
-            # dense matrix
-            ts = matrix(ts, nrow=1)
-            diff = inst - ts
-            dist = np.sum(diff**2)
-        else:
-            # sparse matrix
-            diff = inst - ts
-            tmp = diff * diff.T
-            if tmp.shape[0] != 1:
-                raise ValueError("dot product is %s" % str(tmp.shape))
-            dist = tmp[0, 0]
-        dists[i] = dist
+    scores, vars = get_linear_score_variances(x, w)
+    return scores[0], vars[0]
+
+
+def get_row_squared_norms(x):
+    if sparse.issparse(x):
+        return np.asarray(x.multiply(x).sum(axis=1)).reshape(-1)
+    x = np.asarray(x)
+    return np.einsum('ij,ij->i', x, x)
+
+
+class RowSquaredNorms(object):
+    """ Caches the squared norms of the rows of an instance pool
+
+    The norms are recomputed only when a different pool is passed to get().
+    """
+    def __init__(self):
+        self.x = None
+        self.norms = None
+
+    def get(self, x):
+        if x is not self.x:
+            self.norms = get_row_squared_norms(x)
+            self.x = x
+        return self.norms
+
+
+def get_squared_distances(a, b, a_norms=None, b_norms=None):
+    """ Returns the pairwise squared Euclidean distances between rows of a and b
+
+    Computed as ||a||^2 + ||b||^2 - 2 a.b such that sparse rows need not be
+    subtracted from each other.
+
+    :return: np.ndarray
+        matrix of shape (a.shape[0], b.shape[0])
+    """
+    if a_norms is None:
+        a_norms = get_row_squared_norms(a)
+    if b_norms is None:
+        b_norms = get_row_squared_norms(b)
+    if sparse.issparse(a) or sparse.issparse(b):
+        ab = csr_matrix(a).dot(csr_matrix(b).T).toarray()
+    else:
+        ab = np.asarray(a).dot(np.asarray(b).T)
+    dists = a_norms.reshape(-1, 1) + b_norms.reshape(1, -1) - 2. * ab
+    return np.maximum(dists, 0.)
+
+
+def get_closest_indexes(inst, test_set, num=1, dest_set=None, test_norms=None):
+    if not sparse.issparse(inst):
+        inst = np.asarray(inst).reshape(1, -1)
+    dists = get_squared_distances(inst, test_set, b_norms=test_norms)[0]
     ordered = np.argsort(dists)[np.arange(num)]
     if False:
-        logger.debug("last ts:\n%s" % str(ts))
-        logger.debug("last diff:\n%s" % str(diff))
         logger.debug("ordered indexes: %s" % str(list(ordered)))
         logger.debug("dists: %s" % str(list(dists[ordered])))
-        # logger.debug("dists: %s" % str(list(dists)))
-        logger.debug("inst:\n%s" % str(inst))
-        logger.debug("points:\n%s" % str(test_set[ordered, :]))
-        ts = test_set[ordered[1], :]
-        ts = matrix(ts, nrow=1)
-        logger.debug("dist 2:\n%s" % str(np.sum((inst - ts)**2)))
     if dest_set is not None:
         for indx in ordered:
             dest_set.add(indx)
     return ordered
 
 
+def get_closest_indexes_batch(x, test_set, num=1, test_norms=None, max_cells=1e7):
+    """ Returns the indexes of test_set which are among the num closest to any row of x
+
+    The distances are computed in blocks of rows of x such that at most
+    max_cells distances are held in memory at a time.
+    """
+    if test_norms is None:
+        test_norms = get_row_squared_norms(test_set)
+    n_test = test_set.shape[0]
+    num = min(num, n_test)
+    block = max(1, int(max_cells // max(1, n_test)))
+    closest = list()
+    for start in range(0, x.shape[0], block):
+        dists = get_squared_distances(x[start:(start + block)], test_set, b_norms=test_norms)
+        if num < n_test:
+            closest.append(np.argpartition(dists, num - 1, axis=1)[:, 0:num].reshape(-1))
+        else:
+            closest.append(np.tile(np.arange(n_test, dtype=int), dists.shape[0]))
+    if len(closest) == 0:
+        return np.zeros(0, dtype=int)
+    return np.unique(np.concatenate(closest))
+
+
 def get_score_variances(x, w, n_test, ordered_indexes=None, queried_indexes=None,
                         test_indexes=None,
-                        eval_set=None, n_closest=9):
+                        eval_set=None, n_closest=9, eval_norms=None):
+    """ Returns the scores and their variances for the top ranked unqueried instances
+
+    :param eval_norms: RowSquaredNorms
+        Cache for the squared norms of the rows of eval_set
+    """
     if test_indexes is None:
         n_test = min(x.shape[0], n_test)
         top_ranked_indexes = ordered_indexes[np.arange(len(queried_indexes) + n_test)]
@@ -184,10 +243,7 @@ def get_score_variances(x, w, n_test, ordered_indexes=None, queried_indexes=None
         n_test = len(test)
 
     tm = Timer()
-    vars = np.zeros(len(test))
-    means = np.zeros(len(test))
-    for i, idx in enumerate(test):
-        means[i], vars[i] = get_linear_score_variance(x[idx], w)
+    means, vars = get_linear_score_variances(x[test], w)
     # logger.debug(tm.message("Time for score variance computation on test set:"))
 
     v_eval = None
@@ -196,13 +252,13 @@ def get_score_variances(x, w, n_test, ordered_indexes=None, queried_indexes=None
         tm = Timer()
         v_eval = np.zeros(eval_set.shape[0], dtype=float)
         m_eval = np.zeros(eval_set.shape[0], dtype=float)
-        closest_indexes = set()  # all indexes from test_set that are closest to any unlabeled instances
-        for i in range(n_test):
-            test_index = test[i]
-            get_closest_indexes(x[test_index, :], eval_set, num=n_closest, dest_set=closest_indexes)
+        test_norms = None if eval_norms is None else eval_norms.get(eval_set)
+        # all indexes from eval_set that are closest to any test instance
+        closest_indexes = get_closest_indexes_batch(x[test], eval_set, num=n_closest, test_norms=test_norms)
         logger.debug("# Closest: %d" % len(closest_indexes))
-        for i, idx in enumerate(closest_indexes):
-            m_eval[idx], v_eval[idx] = get_linear_score_variance(eval_set[idx, :], w)
+        if len(closest_indexes) > 0:
+            m_eval[closest_indexes], v_eval[closest_indexes] = \
+                get_linear_score_variances(eval_set[closest_indexes], w)
         logger.debug(tm.message("Time for score variance computation on eval set:"))
 
     return means, vars, test, v_eval, m_eval
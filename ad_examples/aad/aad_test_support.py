@@ -532,7 +532,8 @@ def plot_query_diversity(x, y, x_transformed, model, metrics, pdf_folder, opts):
     compact_region_idxs = get_compact_regions(x, model=model,
                                               instance_indexes=top_anomalous_instances,
                                               region_indexes=candidate_region_indexes,
-                                              volumes=volumes, p=p)
+                                              volumes=volumes, p=p, solver=opts.describe_solver,
+                                              time_limit=opts.describe_ilp_time_limit)
     # logger.debug("#compact_region_idxs:%d\n%s" % (len(compact_region_idxs), str(list(compact_region_idxs))))
 
     # get the region memberships of the top anomalous instances
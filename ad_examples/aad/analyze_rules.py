@@ -9,7 +9,7 @@ from .aad_ruleset_support import *
 from .anomaly_dataset_support import dataset_configs, dataset_feature_names
 
 
-def load_rules(x, y, meta, fileprefix, out_dir, opts, evaluate_f1=True):
+def load_rules(x, y, meta, fileprefix, out_dir, opts, evaluate_f1=True, cache=None):
     f1s = dict()
     precisions = dict()
     recalls = dict()
@@ -25,7 +25,7 @@ def load_rules(x, y, meta, fileprefix, out_dir, opts, evaluate_f1=True):
                 logger.debug("No rules found in iter %d of %s" % (iter, fileprefix))
             else:
                 if evaluate_f1:
-                    precision, recall, f1 = evaluate_ruleset(x, y, rules, average="binary")
+                    precision, recall, f1 = evaluate_ruleset(x, y, rules, average="binary", cache=cache)
                     logger.debug("Iter %d, F1 score: %f" % (iter, f1))
                 else:
                     precision = recall = f1 = 0.
@@ -97,6 +97,9 @@ def load_all_rule_data(x, y, meta, opts, evaluate_f1=True):
     acc_compact = []
     acc_bayesian = []
 
+    # rules repeat across feedback iterations and runs; evaluate each only once
+    rule_cache = RuleSatisfactionCache(x, y)
+
     for runidx in opts.get_runidxs():
         opts.set_multi_run_options(1, runidx)
 
@@ -113,12 +116,12 @@ def load_all_rule_data(x, y, meta, opts, evaluate_f1=True):
 
         logger.debug("\nLoading compact rules")
         compact_data = load_rules(x, y, meta, fileprefix_compact, out_dir=opts.resultsdir,
-                                  opts=opts, evaluate_f1=evaluate_f1)
+                                  opts=opts, evaluate_f1=evaluate_f1, cache=rule_cache)
         acc_compact.append(compact_data)
 
         logger.debug("\nLoading bayesian rules")
         bayesian_data = load_rules(x, y, meta, fileprefix_bayesian, out_dir=opts.resultsdir,
-                                   opts=opts, evaluate_f1=evaluate_f1)
+                                   opts=opts, evaluate_f1=evaluate_f1, cache=rule_cache)
         acc_bayesian.append(bayesian_data)
 
     logger.debug("Aggregated Top:")
@@ -37,6 +37,7 @@ class DecisionTreeAadWrapper(AadForest):
         self.max_depth = max_depth
         self.n_estimators = 1
         self.max_samples = x.shape[0]
+        self.n_jobs = 1
         self.tree_update_type = TREE_UPD_OVERWRITE
         self.tree_incremental_update_weight = None
         self.forest_replace_frac = None
@@ -58,6 +59,12 @@ class DecisionTreeAadWrapper(AadForest):
         # scores for each region
         self.d = None
 
+        # flattened representation of all trees; built lazily from the regions
+        self.compiled_forest = None
+        self.region_arrays = None
+        self.shared_compiled_forest = None
+        self.worker_pool = None
+
         self.decision_tree = DTClassifier.fit(x, y, self.max_depth)
 
         # anomalies are labeled '1'
@@ -85,6 +92,8 @@ class DecisionTreeAadWrapper(AadForest):
                 region_id += 1  # this will monotonously increase across trees
             self.all_node_regions.append(node_regions)
             # print "%d, #nodes: %d" % (i, len(regions))
+        self.compiled_forest = None
+        self.region_arrays = None
         self.d, _, _ = self.get_region_scores_wrapper()
         # self.w = self.get_uniform_weights()
         self.w_unif_prior = self.get_uniform_weights()
@@ -127,6 +136,7 @@ class RandomForestAadWrapper(DecisionTreeAadWrapper):
         self.max_depth = clf.max_depth
         self.n_estimators = len(clf.estimators_)
         self.max_samples = x.shape[0]
+        self.n_jobs = 1
         self.tree_update_type = TREE_UPD_OVERWRITE
         self.tree_incremental_update_weight = None
         self.forest_replace_frac = None
@@ -148,6 +158,12 @@ class RandomForestAadWrapper(DecisionTreeAadWrapper):
         # scores for each region
         self.d = None
 
+        # flattened representation of all trees; built lazily from the regions
+        self.compiled_forest = None
+        self.region_arrays = None
+        self.shared_compiled_forest = None
+        self.worker_pool = None
+
         self.clf = ClassifierForest(clf.estimators_)
         self._init_structures()
         self.init_weights(init_type=INIT_UNIF)
@@ -19,25 +19,46 @@ class IdServer(object):
 
 
 class DataStream(object):
+    """Streams instances from in-memory (or memory-mapped) arrays
+
+    A cursor marks the position of the next instance to be read. Reads
+    return views into X and y instead of copying the remaining data. Hence
+    X may also be a read-only np.memmap of data that does not fit in RAM;
+    only the instances of the current window are then paged in.
+
+    Attributes:
+        X: np.ndarray, np.memmap or csr_matrix
+        y: np.array
+        id_server: IdServer
+        cursor: int
+            index of the next instance to be read from X
+    """
     def __init__(self, X, y=None, id_server=None):
         self.X = X
         self.y = y
         self.id_server = id_server
+        self.cursor = 0
+
+    @staticmethod
+    def from_memmap(filename, shape, dtype=float, y=None, id_server=None, offset=0):
+        """Streams a (n x m) binary array stored in filename without loading it into memory"""
+        X = np.memmap(filename, dtype=dtype, mode="r", shape=tuple(shape), offset=offset)
+        return DataStream(X, y=y, id_server=id_server)
 
     def read_next_from_stream(self, n=1):
-        """Returns first n instances from X and removes these instances from X"""
-        n = min(n, self.X.shape[0])
+        """Returns next n instances from X and moves the cursor past them"""
+        n = min(n, self.X.shape[0] - self.cursor)
         # logger.debug("DataStream.read_next_from_stream n: %d" % n)
-        if n == 0:
+        if n <= 0:
             return None
-        mask = np.zeros(self.X.shape[0], dtype=bool)
-        mask[np.arange(n)] = True
-        instances = self.X[mask]
-        self.X = self.X[~mask]
+        start, end = self.cursor, self.cursor + n
+        self.cursor = end
+        instances = self.X[start:end]
+        if isinstance(instances, np.ndarray):
+            instances = np.asarray(instances)  # view as ndarray even if X is an np.memmap
         labels = None
         if self.y is not None:
-            labels = self.y[mask]
-            self.y = self.y[~mask]
+            labels = np.asarray(self.y[start:end])
         ids = None
         if self.id_server is not None:
             ids = self.id_server.get_next(n)
@@ -45,7 +66,82 @@ class DataStream(object):
         return InstanceList(instances, labels, ids)
 
     def empty(self):
-        return self.X is None or self.X.shape[0] == 0
+        return self.X is None or self.cursor >= self.X.shape[0]
+
+
+class GeneratorDataStream(DataStream):
+    """Streams instances from an iterable of data chunks
+
+    Only the chunks which overlap the requested window are held in memory
+    at any time. Windows which lie within a single chunk are returned as
+    views into the chunk.
+
+    Attributes:
+        chunks: iterator
+            yields either X or (X, y) where X is np.ndarray or csr_matrix
+    """
+    def __init__(self, chunks, id_server=None):
+        DataStream.__init__(self, X=None, y=None, id_server=id_server)
+        self.chunks = iter(chunks)
+        self.exhausted = False
+
+    def _fetch_next_chunk(self):
+        """Makes the next non-empty chunk the current X; returns False if there is none"""
+        while not self.exhausted:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.exhausted = True
+                break
+            X, y = chunk if isinstance(chunk, tuple) else (chunk, None)
+            if X is not None and X.shape[0] > 0:
+                self.X, self.y, self.cursor = X, y, 0
+                return True
+        self.X, self.y, self.cursor = None, None, 0
+        return False
+
+    def read_next_from_stream(self, n=1):
+        """Returns next n (or fewer if the stream ends) instances"""
+        parts = []
+        n_read = 0
+        while n_read < n:
+            if self.X is None or self.cursor >= self.X.shape[0]:
+                if not self._fetch_next_chunk():
+                    break
+            parts.append(DataStream.read_next_from_stream(self, n - n_read))
+            n_read += len(parts[-1])
+        if len(parts) == 0:
+            return None
+        instances = parts[0]
+        for part in parts[1:]:
+            # copies only the instances of this window
+            instances.add_instances(part.x, part.y, ids=part.ids)
+        return instances
+
+    def empty(self):
+        if self.X is not None and self.cursor < self.X.shape[0]:
+            return False
+        return not self._fetch_next_chunk()
+
+
+def get_csv_chunks(file, chunksize, header=None, labelindex=0, startcol=1):
+    """Reads the anomaly dataset CSV in chunks of chunksize rows
+
+    See dataframe_to_matrix() for the expected format.
+    """
+    for df in read_csv(file, header=header, sep=',', chunksize=chunksize):
+        yield dataframe_to_matrix(df, labelindex=labelindex, startcol=startcol)
+
+
+class CsvDataStream(GeneratorDataStream):
+    """Streams instances from a CSV file while reading at most chunksize rows at a time
+
+    Note: Both 'labelindex' and 'startcol' are 0-indexed (as in dataframe_to_matrix()).
+    """
+    def __init__(self, file, chunksize=10000, header=None, labelindex=0, startcol=1, id_server=None):
+        GeneratorDataStream.__init__(self, get_csv_chunks(file, chunksize, header=header,
+                                                          labelindex=labelindex, startcol=startcol),
+                                     id_server=id_server)
 
 
 class StreamingSupport(object):
@@ -7,6 +7,7 @@ from scipy.sparse import csr_matrix, vstack
 import logging
 
 from ..common.utils import *
+from ..common.parallel_utils import *
 from ..common.sgd_optimization import *
 from .aad_globals import *
 from .aad_base import *
@@ -34,6 +35,89 @@ class RegionData(object):
         return self.__str__()
 
 
+class RegionArrays(object):
+    """ Struct-of-arrays representation of the regions of all trees in a forest
+
+    The region attributes are stored as arrays indexed by the global region id.
+    The regions of tree i are in the slice [tree_offsets[i], tree_offsets[i+1]).
+
+    Note: After a stream update, node_samples holds the current counts while
+    RegionData.node_samples retains the counts at the time of region extraction.
+
+    Attributes:
+        tree_offsets: np.array(int)
+        node_ids: np.array(int)
+            node id (within its tree) for each region
+        path_length: np.array(int)
+        node_samples: np.array(float)
+        log_frac_vol: np.array(float)
+        regions: list of RegionData
+    """
+    def __init__(self, regions_in_forest):
+        n_regions = np.array([len(regions) for regions in regions_in_forest], dtype=int)
+        self.tree_offsets = np.zeros(len(n_regions) + 1, dtype=int)
+        np.cumsum(n_regions, out=self.tree_offsets[1:])
+        self.regions = [region for regions in regions_in_forest for region in regions]
+        self.node_ids, self.path_length, self.node_samples, self.log_frac_vol = get_region_arrays(self.regions)
+
+        # built lazily since these are required only for descriptions
+        self._bounds = None
+        self._volumes = None
+        self._volumes_feature_ranges = None
+
+    def get_bounds(self):
+        """ Returns the (n_regions, d, 2) array of [min, max] feature bounds of all regions """
+        if self._bounds is None:
+            n = len(self.regions)
+            d = 0 if n == 0 else len(self.regions[0].region)
+            self._bounds = np.zeros((n, d, 2), dtype=np.float64)
+            for i, region in enumerate(self.regions):
+                self._bounds[i] = [region.region[j] for j in range(d)]
+        return self._bounds
+
+    def get_volumes(self, feature_ranges):
+        """ Returns the volumes of all regions (as in forest_description.get_region_volumes)
+
+        The volumes are cached for the most recent feature_ranges.
+        """
+        if self._volumes is None or not np.array_equal(self._volumes_feature_ranges, feature_ranges):
+            bounds = self.get_bounds()
+            rmin = np.where(np.isinf(bounds[:, :, 0]), feature_ranges[:, 0], bounds[:, :, 0])
+            rmax = np.where(np.isinf(bounds[:, :, 1]), feature_ranges[:, 1], bounds[:, :, 1])
+            # If the range of a variable is a single value, we just ignore it.
+            region_ranges = np.where(rmax == rmin, 1.0, rmax - rmin).astype(np.float32)
+            self._volumes = np.prod(region_ranges, axis=1)
+            self._volumes_feature_ranges = np.array(feature_ranges, copy=True)
+        return self._volumes
+
+    def get_memberships(self, x, region_indexes, max_cells=10000000):
+        """ Returns the binary (instances x regions) matrix of region memberships
+
+        An instance belongs to a region if min <= x <= max for every feature,
+        same as is_in_region(). The comparisons are broadcast over blocks of
+        instances such that at most max_cells values are compared at a time.
+        """
+        bounds = self.get_bounds()[region_indexes]
+        x = np.asarray(x, dtype=np.float64)
+        n, n_regions = x.shape[0], len(region_indexes)
+        memberships = np.zeros((n, n_regions), dtype=int)
+        block = max(1, max_cells // max(1, n_regions * x.shape[1]))
+        for start in range(0, n, block):
+            xb = x[start:(start + block), np.newaxis, :]
+            inside = np.logical_and(bounds[np.newaxis, :, :, 0] <= xb, xb <= bounds[np.newaxis, :, :, 1])
+            memberships[start:(start + block)] = np.all(inside, axis=2)
+        return memberships
+
+
+def get_region_arrays(regions):
+    """ Returns the node ids, path lengths, node samples and log fractional volumes of regions """
+    node_ids = np.array([region.node_id for region in regions], dtype=int)
+    path_length = np.array([region.path_length for region in regions], dtype=int)
+    node_samples = np.array([region.node_samples for region in regions], dtype=np.float64)
+    log_frac_vol = np.array([region.log_frac_vol for region in regions], dtype=np.float64)
+    return node_ids, path_length, node_samples, log_frac_vol
+
+
 def is_forest_detector(detector_type):
     return (detector_type == AAD_IFOREST or
             detector_type == AAD_HSTREES or
@@ -70,6 +154,243 @@ def transform_features(x, all_regions, d):
     return x_new
 
 
+class CompiledForest(object):
+    """ Flattened representation of all trees of a forest
+
+    The node arrays (children_left, children_right, feature, threshold) of
+    all trees are concatenated into contiguous arrays. The child node ids
+    are offset such that they index into the concatenated arrays. Every
+    (instance, tree) pair can then be passed from root to leaf in one batched
+    traversal over the whole forest instead of tree-by-tree and instance-by-instance.
+
+    Attributes:
+        n_trees: int
+        tree_offsets: np.array(int)
+            tree_offsets[i] is the global index of the root of tree i
+        node_regions: np.array(int)
+            The global region id of each global node index; -1 if
+            the node does not correspond to any region.
+        max_depth: int
+            The maximum number of nodes below the root on any root-to-leaf path
+        x_dtype: numpy dtype
+            If not None, the instances will be cast to this type before
+            comparison with the thresholds. The scikit-learn trees compare
+            float32 values in their apply() method.
+    """
+    def __init__(self, estimators, all_node_regions, x_dtype=None):
+        self.n_trees = len(estimators)
+        self.x_dtype = x_dtype
+        node_counts = np.array([estimator.tree_.node_count for estimator in estimators], dtype=int)
+        self.tree_offsets = np.zeros(self.n_trees + 1, dtype=int)
+        np.cumsum(node_counts, out=self.tree_offsets[1:])
+        n_nodes = self.tree_offsets[-1]
+
+        self.children_left = np.zeros(n_nodes, dtype=int)
+        self.children_right = np.zeros(n_nodes, dtype=int)
+        self.feature = np.zeros(n_nodes, dtype=int)
+        self.threshold = np.zeros(n_nodes, dtype=np.float64)
+        self.node_regions = -np.ones(n_nodes, dtype=int)
+        for i, estimator in enumerate(estimators):
+            tree = estimator.tree_
+            start = self.tree_offsets[i]
+            end = self.tree_offsets[i + 1]
+            n_tree_nodes = end - start
+            left = np.asarray(tree.children_left[0:n_tree_nodes], dtype=int)
+            right = np.asarray(tree.children_right[0:n_tree_nodes], dtype=int)
+            self.children_left[start:end] = np.where(left == -1, -1, left + start)
+            self.children_right[start:end] = np.where(right == -1, -1, right + start)
+            self.feature[start:end] = tree.feature[0:n_tree_nodes]
+            self.threshold[start:end] = tree.threshold[0:n_tree_nodes]
+            node_regions = all_node_regions[i]
+            if len(node_regions) > 0:
+                node_ids = np.fromiter(node_regions.keys(), dtype=int, count=len(node_regions))
+                region_ids = np.fromiter(node_regions.values(), dtype=int, count=len(node_regions))
+                self.node_regions[node_ids + start] = region_ids
+        self.max_depth = self._get_max_depth()
+
+    def _get_max_depth(self):
+        depth = 0
+        nodes = self.tree_offsets[:-1]
+        while True:
+            nodes = nodes[self.children_left[nodes] != -1]
+            if len(nodes) == 0:
+                break
+            nodes = np.concatenate([self.children_left[nodes], self.children_right[nodes]])
+            depth += 1
+        return depth
+
+    def traverse(self, x, getpath=False):
+        """ Passes every (instance, tree) pair from root to leaf, one level at a time
+
+        The pair (i, t) of instance i and tree t has the index i * n_trees + t.
+
+        :param x: np.ndarray
+            Instances in original feature space
+        :param getpath: bool
+            Whether to return the pair indexes and the global node ids of all
+            nodes visited *after* the root.
+        :return: np.array(int), (np.array(int), np.array(int))
+            The global leaf node id for each pair, and the visited (pair, node)
+            indexes in the order of visit (None, None if getpath is False).
+        """
+        if self.x_dtype is not None:
+            x = x.astype(self.x_dtype)
+        n_pairs = x.shape[0] * self.n_trees
+        leaves = np.zeros(n_pairs, dtype=int)
+        pairs = np.arange(n_pairs, dtype=int)
+        nodes = np.tile(self.tree_offsets[:-1], x.shape[0])
+        path_pairs = [np.zeros(0, dtype=int)]
+        path_nodes = [np.zeros(0, dtype=int)]
+        while len(pairs) > 0:
+            is_leaf = np.logical_and(self.children_left[nodes] == -1, self.children_right[nodes] == -1)
+            leaves[pairs[is_leaf]] = nodes[is_leaf]
+            pairs = pairs[~is_leaf]
+            nodes = nodes[~is_leaf]
+            vals = get_feature_values(x, pairs // self.n_trees, self.feature[nodes])
+            nodes = np.where(vals <= self.threshold[nodes],
+                             self.children_left[nodes], self.children_right[nodes])
+            if getpath:
+                path_pairs.append(pairs)
+                path_nodes.append(nodes)
+        if getpath:
+            return leaves, (np.concatenate(path_pairs), np.concatenate(path_nodes))
+        return leaves, (None, None)
+
+    def get_regions(self, x, add_leaf_nodes_only=True):
+        """ Returns the region ids through which each (instance, tree) pair passes
+
+        The returned arrays are ordered by pair index, and for each pair, from root
+        to leaf. Since region ids increase along a path and across trees, this
+        implies that the region ids for each instance are in increasing order.
+
+        :param x: np.ndarray
+        :param add_leaf_nodes_only: bool
+            If True, only the leaf regions are returned. Else, all regions
+            on the path from root (excluding) to the leaf are returned.
+        :return: np.array(int), np.array(int)
+            pair indexes and corresponding region ids
+        """
+        if add_leaf_nodes_only:
+            leaves, _ = self.traverse(x, getpath=False)
+            return np.arange(len(leaves), dtype=int), self.node_regions[leaves]
+        _, (pairs, nodes) = self.traverse(x, getpath=True)
+        order = np.argsort(pairs, kind="mergesort")
+        return pairs[order], self.node_regions[nodes[order]]
+
+    def get_region_paths(self, x, add_leaf_nodes_only=True):
+        """ Returns the regions of each instance along with the lengths of the paths
+
+        :param x: np.ndarray
+        :param add_leaf_nodes_only: bool
+        :return: np.array(int), np.array(int), np.array(int)
+            the number of regions for each instance, the region ids (ordered
+            as in get_regions()), and the length of the tree path for each region id.
+        """
+        n = x.shape[0]
+        pairs, region_ids = self.get_regions(x, add_leaf_nodes_only)
+        path_lengths = np.bincount(pairs, minlength=n * self.n_trees)[pairs]
+        row_counts = np.bincount(pairs // self.n_trees, minlength=n)
+        return row_counts, region_ids, path_lengths
+
+
+class RegionHistogram(object):
+    """ Number of instances in each region of a forest, updated as instances are added
+
+    The region ids of each added instance are retained in the order in which
+    the instances were added. Hence, the counts over any subset of the
+    instances (e.g., the first half) can be computed later without passing
+    the instances through the trees again.
+
+    Attributes:
+        region_tree_sizes: np.array(int)
+            The number of regions in the tree that each region belongs to
+        counts: np.array(int)
+            Number of added instances in each region
+        n: int
+            Number of instances added
+    """
+    def __init__(self, region_tree_sizes):
+        self.region_tree_sizes = region_tree_sizes
+        self.counts = np.zeros(len(region_tree_sizes), dtype=int)
+        self.n = 0
+        self.region_ids = GrowableRows(np.zeros(0, dtype=int))
+        self.row_counts = GrowableRows(np.zeros(0, dtype=int))
+
+    def add(self, row_counts, region_ids):
+        """ Adds instances
+
+        :param row_counts: np.array(int)
+            Number of region ids of each new instance
+        :param region_ids: np.array(int)
+            Region ids of all new instances (ordered by instance)
+        """
+        self.counts += np.bincount(region_ids, minlength=len(self.counts))
+        self.n += len(row_counts)
+        self.region_ids.append(region_ids)
+        self.row_counts.append(row_counts)
+
+    def get_counts(self, rows=None):
+        """ Returns the region counts and the number of instances for a subset of the instances
+
+        :param rows: slice or np.array(int)
+            Positions of the instances in the order they were added.
+            All instances if None.
+        :return: np.array(int), int
+        """
+        if rows is None:
+            return self.counts, self.n
+        row_counts = self.row_counts.get()
+        offsets = np.zeros(self.n + 1, dtype=int)
+        np.cumsum(row_counts, out=offsets[1:])
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.n)
+            if step == 1:
+                region_ids = self.region_ids.get()[offsets[start]:offsets[max(start, stop)]]
+                return np.bincount(region_ids, minlength=len(self.counts)), max(0, stop - start)
+            rows = np.arange(start, stop, step)
+        lengths = row_counts[rows]
+        starts = np.repeat(offsets[rows] - np.cumsum(lengths) + lengths, lengths)
+        positions = starts + np.arange(np.sum(lengths), dtype=int)
+        region_ids = self.region_ids.get()[positions]
+        return np.bincount(region_ids, minlength=len(self.counts)), len(lengths)
+
+    def get_distribution(self, rows=None, delta=1e-16):
+        """ Returns the probability of each region within its tree for a subset of the instances
+
+        A small delta is added to each count to take care of zero counts.
+        """
+        counts, n = self.get_counts(rows)
+        delta_ = (delta * 1. / n)
+        dists = np.ones(len(self.counts), dtype=np.float32) * delta_
+        dists += counts
+        # for probabilities to add to 1.0
+        denom = n + delta_ * self.region_tree_sizes
+        return dists / denom.astype(np.float32)
+
+
+def forest_transform_block(args):
+    """ Computes the region paths for a block of rows in a worker process
+
+    The results are written into the shared arrays starting at the
+    offset nnz_start. Only the number of entries written is returned.
+    """
+    shared_forest, x, row_counts, indices, path_lengths, start, end, nnz_start, add_leaf_nodes_only = args
+    compiled_forest = shared_forest.get()
+    counts, region_ids, lengths = compiled_forest.get_region_paths(x.array[start:end], add_leaf_nodes_only)
+    nnz_end = nnz_start + len(region_ids)
+    row_counts.array[start:end] = counts
+    indices.array[nnz_start:nnz_end] = region_ids
+    path_lengths.array[nnz_start:nnz_end] = lengths
+    return len(region_ids)
+
+
+def forest_region_ids_block(args):
+    """ Returns the unique region ids for a block of rows in a worker process """
+    shared_forest, x, start, end, add_leaf_nodes_only = args
+    _, region_ids = shared_forest.get().get_regions(x.array[start:end], add_leaf_nodes_only)
+    return np.unique(region_ids)
+
+
 class AadForest(Aad, StreamingSupport):
 
     def __init__(self, n_estimators=10, max_samples=100, max_depth=10,
@@ -88,6 +409,7 @@ class AadForest(Aad, StreamingSupport):
 
         self.n_estimators = n_estimators
         self.max_samples = max_samples
+        self.n_jobs = n_jobs
         self.tree_update_type = tree_update_type
         self.tree_incremental_update_weight = tree_incremental_update_weight
         self.forest_replace_frac = forest_replace_frac
@@ -143,6 +465,16 @@ class AadForest(Aad, StreamingSupport):
         # scores for each region
         self.d = None
 
+        # flattened representation of all trees; built lazily from the regions
+        self.compiled_forest = None
+
+        # struct-of-arrays representation of all_regions; built lazily
+        self.region_arrays = None
+
+        # compiled_forest published to the worker processes of worker_pool
+        self.shared_compiled_forest = None
+        self.worker_pool = None
+
         # samples for each region
         # self.node_samples = None
 
@@ -184,6 +516,8 @@ class AadForest(Aad, StreamingSupport):
                 region_id += 1  # this will monotonously increase across trees
             self.all_node_regions.append(node_regions)
             # print "%d, #nodes: %d" % (i, len(regions))
+        self.compiled_forest = None
+        self.region_arrays = None
         self.d, _, _ = self.get_region_scores(self.all_regions)
         # self.w = self.get_uniform_weights()
         self.w_unif_prior = self.get_uniform_weights()
@@ -350,49 +684,49 @@ class AadForest(Aad, StreamingSupport):
 
     def get_region_scores(self, all_regions):
         """Larger values mean more anomalous"""
-        d = np.zeros(len(all_regions), dtype=np.float64)
-        node_samples = np.zeros(len(all_regions), dtype=np.float64)
-        frac_insts = np.zeros(len(all_regions), dtype=np.float64)
-        for i, region in enumerate(all_regions):
-            node_samples[i] = region.node_samples
-            frac_insts[i] = region.node_samples * 1.0 / self.max_samples
-            if self.score_type == IFOR_SCORE_TYPE_INV_PATH_LEN:
-                d[i] = 1. / region.path_length
-            elif self.score_type == IFOR_SCORE_TYPE_INV_PATH_LEN_EXP:
-                d[i] = 2 ** -region.path_length  # used this to run the first batch
-            elif self.score_type == IFOR_SCORE_TYPE_CONST:
-                d[i] = -1
-            elif self.score_type == IFOR_SCORE_TYPE_NEG_PATH_LEN:
-                d[i] = -region.path_length
-            elif self.score_type == HST_LOG_SCORE_TYPE:
-                # The original HS Trees scores are very large at the leaf nodes.
-                # This makes the gradient ill-behaved. We therefore use log-transform
-                # and the fraction of samples rather than the number of samples.
-                d[i] = -(np.log(frac_insts[i] + 1e-16) + (region.path_length * np.log(2.)))
-            elif self.score_type == HST_SCORE_TYPE:
-                # While the original uses the region.node_samples, we use the
-                # region.node_samples / total samples, hence the fraction of node samples.
-                # This transformation does not change the result.
-                d[i] = -frac_insts[i] * (2. ** region.path_length)
-                # d[i] = -region.node_samples * (2. ** region.path_length)
-                # d[i] = -region.node_samples * region.path_length
-                # d[i] = -np.log(region.node_samples + 1) + region.path_length
-            elif self.score_type == RSF_LOG_SCORE_TYPE:
-                # d[i] = -np.log(region.node_samples + 1) + region.log_frac_vol
-                d[i] = -np.log(frac_insts[i] + 1e-16) + region.log_frac_vol
-            elif self.score_type == RSF_SCORE_TYPE:
-                # This is the original RS Forest score: samples / frac_vol
-                d[i] = -region.node_samples * np.exp(-region.log_frac_vol)
-            else:
-                # if self.score_type == IFOR_SCORE_TYPE_NORM:
-                raise NotImplementedError("score_type %d not implemented!" % self.score_type)
-                # d[i] = frac_insts[i]  # RPAD-ish
-                # depth = region.path_length - 1
-                # node_samples_avg_path_length = region.score
-                # d[i] = (
-                #            depth + node_samples_avg_path_length
-                #        ) / (self.n_estimators * self._average_path_length(self.clf._max_samples))
-        return d, node_samples, frac_insts
+        _, path_length, node_samples, log_frac_vol = get_region_arrays(all_regions)
+        return self.get_region_scores_from_arrays(path_length, node_samples, log_frac_vol)
+
+    def get_region_scores_from_arrays(self, path_length, node_samples, log_frac_vol):
+        """Larger values mean more anomalous
+
+        Computes the scores for all regions at once from the region attribute arrays.
+
+        :param path_length: np.array(int)
+        :param node_samples: np.array(float)
+        :param log_frac_vol: np.array(float)
+        :return: np.array, np.array, np.array
+            region scores, node samples, and fraction of instances in each region
+        """
+        node_samples = np.asarray(node_samples, dtype=np.float64)
+        frac_insts = node_samples * 1.0 / self.max_samples
+        if self.score_type == IFOR_SCORE_TYPE_INV_PATH_LEN:
+            d = 1. / path_length
+        elif self.score_type == IFOR_SCORE_TYPE_INV_PATH_LEN_EXP:
+            d = 2. ** -path_length  # used this to run the first batch
+        elif self.score_type == IFOR_SCORE_TYPE_CONST:
+            d = -np.ones(len(path_length))
+        elif self.score_type == IFOR_SCORE_TYPE_NEG_PATH_LEN:
+            d = -path_length
+        elif self.score_type == HST_LOG_SCORE_TYPE:
+            # The original HS Trees scores are very large at the leaf nodes.
+            # This makes the gradient ill-behaved. We therefore use log-transform
+            # and the fraction of samples rather than the number of samples.
+            d = -(np.log(frac_insts + 1e-16) + (path_length * np.log(2.)))
+        elif self.score_type == HST_SCORE_TYPE:
+            # While the original uses the region.node_samples, we use the
+            # region.node_samples / total samples, hence the fraction of node samples.
+            # This transformation does not change the result.
+            d = -frac_insts * (2. ** path_length)
+        elif self.score_type == RSF_LOG_SCORE_TYPE:
+            d = -np.log(frac_insts + 1e-16) + log_frac_vol
+        elif self.score_type == RSF_SCORE_TYPE:
+            # This is the original RS Forest score: samples / frac_vol
+            d = -node_samples * np.exp(-log_frac_vol)
+        else:
+            # if self.score_type == IFOR_SCORE_TYPE_NORM:
+            raise NotImplementedError("score_type %d not implemented!" % self.score_type)
+        return np.asarray(d, dtype=np.float64), node_samples, frac_insts
 
     def get_score(self, x, w=None):
         """Higher score means more anomalous"""
@@ -436,14 +770,28 @@ class AadForest(Aad, StreamingSupport):
             partitions = np.array([self.n_estimators], dtype=int)
         return partitions
 
+    def get_region_arrays(self):
+        """ Returns the struct-of-arrays representation of all regions in the forest """
+        if self.region_arrays is None:
+            self.region_arrays = RegionArrays(self.regions_in_forest)
+        return self.region_arrays
+
     def update_region_scores(self):
+        """ Updates the region scores from the current node counts of the trees
+
+        Only the scores of trees whose node counts have changed are recomputed.
+        """
+        region_arrays = self.get_region_arrays()
         for i, estimator in enumerate(self.clf.estimators_):
-            tree = estimator.tree_
-            node_regions = self.all_node_regions[i]
-            for node_id in node_regions:
-                region_id = node_regions[node_id]
-                self.all_regions[region_id].node_samples = tree.n_node_samples[node_id]
-        self.d, _, _ = self.get_region_scores(self.all_regions)
+            start = region_arrays.tree_offsets[i]
+            end = region_arrays.tree_offsets[i + 1]
+            node_samples = estimator.tree_.n_node_samples[region_arrays.node_ids[start:end]]
+            if np.array_equal(node_samples, region_arrays.node_samples[start:end]):
+                continue
+            region_arrays.node_samples[start:end] = node_samples
+            self.d[start:end], _, _ = self.get_region_scores_from_arrays(region_arrays.path_length[start:end],
+                                                                          region_arrays.node_samples[start:end],
+                                                                          region_arrays.log_frac_vol[start:end])
 
     def update_model_from_stream_buffer(self, replace_trees=None):
         if self.detector_type == AAD_IFOREST or self.detector_type == AAD_MULTIVIEW_FOREST:
@@ -522,6 +870,8 @@ class AadForest(Aad, StreamingSupport):
         self.regions_in_forest = new_regions_in_forest
         self.all_regions = new_all_regions
         self.all_node_regions = new_all_node_regions
+        self.compiled_forest = None
+        self.region_arrays = None
         self.d = new_d
         self.w = new_w
         self.w_unif_prior = np.ones(len(self.w), dtype=self.w.dtype) * np.sqrt(1./len(self.w))
@@ -600,6 +950,8 @@ class AadForest(Aad, StreamingSupport):
         self.regions_in_forest = new_regions_in_forest
         self.all_regions = new_all_regions
         self.all_node_regions = new_all_node_regions
+        self.compiled_forest = None
+        self.region_arrays = None
         self.d = new_d
         self.w = new_w
         self.w_unif_prior = np.ones(n_regions, dtype=self.w.dtype) * np.sqrt(1./n_regions)
@@ -643,13 +995,25 @@ class AadForest(Aad, StreamingSupport):
         self._transform_to_region_features_with_lookup(x, x_new)
         return x_new
 
+    def get_compiled_forest(self):
+        """ Returns the flattened representation of all trees in the forest """
+        if self.compiled_forest is None:
+            x_dtype = None
+            if self.add_leaf_nodes_only and not all([isinstance(estimator.tree_, ArrTree)
+                                                     for estimator in self.clf.estimators_]):
+                # leaf nodes are otherwise looked up with scikit-learn apply()
+                x_dtype = np.float32
+            self.compiled_forest = CompiledForest(self.clf.estimators_, self.all_node_regions,
+                                                  x_dtype=x_dtype)
+        return self.compiled_forest
+
     def transform_to_region_features_sparse(self, x, norm_unit=False):
         """ Transforms from original feature space to IF node space
         
         The conversion to sparse vectors seems to take a lot of intermediate
         memory in python. This is why we are converting the vectors in smaller
-        batches. The transformation is a one-time task, hence not a concern in 
-        most cases.
+        batches. The batches are copied into a preallocated CSR matrix such that
+        the memory needed is bounded by the final matrix plus one batch.
         
         :param x: 
         :return: 
@@ -657,42 +1021,141 @@ class AadForest(Aad, StreamingSupport):
         # logger.debug("transforming to IF feature space...")
         n = x.shape[0]
         m = len(self.d)
-        batch_size = 10000
+        compiled_forest = self.get_compiled_forest()
+        if self.add_leaf_nodes_only:
+            # every instance lands in exactly one leaf of each tree
+            max_nnz = n * compiled_forest.n_trees
+        else:
+            # path lengths are usually much shorter than max_depth; hence
+            # the capacity is grown as the batches are appended
+            max_nnz = 0
+        x_new = CSRBuilder(m, max_rows=n, max_nnz=max_nnz, dtype=float)
+        if self._use_worker_pool(x):
+            batches = self._transform_to_region_features_parallel(x, norm_unit=norm_unit)
+        else:
+            batches = self._transform_to_region_features_batches(x, norm_unit=norm_unit)
+        for x_tmp_new in batches:
+            x_new.append(x_tmp_new)
+        return x_new.tocsr(trim=True)
+
+    def _transform_to_region_features_batches(self, x, norm_unit=False, batch_size=10000):
+        """ Generates the transformed instances batch-by-batch in the current process """
+        n = x.shape[0]
         start_batch = 0
         end_batch = min(start_batch + batch_size, n)
-        x_new = csr_matrix((0, m), dtype=float)
         while start_batch < end_batch:
             starttime = timer()
             x_tmp = matrix(x[start_batch:end_batch, :], ncol=x.shape[1])
-            x_tmp_new = lil_matrix((end_batch - start_batch, m), dtype=x_new.dtype)
-            for i, tree in enumerate(self.clf.estimators_):
-                n_tmp = x_tmp.shape[0]
-                node_regions = self.all_node_regions[i]
-                tree_paths = self.get_decision_path(x_tmp, tree)
-                for j in range(n_tmp):
-                    k = len(tree_paths[j])
-                    for node_idx in tree_paths[j]:
-                        region_id = node_regions[node_idx]
-                        x_tmp_new[j, region_id] = self.get_region_score_for_instance_transform(region_id, k)
+            x_tmp_new = self._transform_batch_to_region_features(x_tmp, norm_unit=norm_unit)
             if n >= 100000:
                 endtime = timer()
                 tdiff = difftime(endtime, starttime, units="secs")
                 logger.debug("processed %d/%d (%f); batch %d in %f sec(s)" %
                              (end_batch + 1, n, (end_batch + 1)*1./n, batch_size, tdiff))
-            if norm_unit:
-                norms = np.sqrt(x_tmp_new.power(2).sum(axis=1))
-                zero_idxs = np.where(norms == 0)[0]
-                if len(zero_idxs) > 0:
-                    # in order to avoid a divide by zero warning
-                    norms[zero_idxs] = 1
-                # logger.debug("norms before [%d/%d]:\n%s" % (start_batch, end_batch, str(list(norms.T))))
-                x_tmp_new = x_tmp_new.multiply(1/norms)
-                # norms = np.sqrt(x_tmp_new.power(2).sum(axis=1))
-                # logger.debug("norms after [%d/%d]:\n%s" % (start_batch, end_batch, str(list(norms.T))))
-            x_new = vstack([x_new, x_tmp_new.tocsr()])
+            yield x_tmp_new
             start_batch = end_batch
             end_batch = min(start_batch + batch_size, n)
-        return x_new
+
+    def _transform_to_region_features_parallel(self, x, norm_unit=False):
+        """ Generates the transformed instances computed by the worker pool
+
+        The rows are partitioned into blocks and one round of blocks (one
+        per worker) is processed at a time. The workers write their outputs
+        into shared arrays which are reused across rounds. Hence, the
+        intermediate memory is bounded by one round of blocks.
+        """
+        n = x.shape[0]
+        compiled_forest = self.get_compiled_forest()
+        shared_forest = self._get_shared_compiled_forest()
+        pool = self._get_worker_pool()
+        blocks = get_row_blocks(n, pool.n_jobs)
+        round_blocks = [blocks[i:(i + pool.n_jobs)] for i in range(0, len(blocks), pool.n_jobs)]
+        max_block_rows = max([end - start for start, end in blocks])
+        if self.add_leaf_nodes_only:
+            max_block_nnz = max_block_rows * compiled_forest.n_trees
+        else:
+            max_block_nnz = max_block_rows * compiled_forest.n_trees * compiled_forest.max_depth
+        x_shared = SharedArray.from_array(np.asarray(x, dtype=float))
+        row_counts = SharedArray((n,), dtype=int)
+        indices = SharedArray((pool.n_jobs * max_block_nnz,), dtype=int)
+        path_lengths = SharedArray((pool.n_jobs * max_block_nnz,), dtype=int)
+        try:
+            for blocks in round_blocks:
+                starttime = timer()
+                tasks = [(shared_forest, x_shared, row_counts, indices, path_lengths,
+                          start, end, i * max_block_nnz, self.add_leaf_nodes_only)
+                         for i, (start, end) in enumerate(blocks)]
+                nnzs = pool.map(forest_transform_block, tasks)
+                for i, (start, end) in enumerate(blocks):
+                    nnz_start = i * max_block_nnz
+                    nnz_end = nnz_start + nnzs[i]
+                    yield self._region_paths_to_csr(row_counts.array[start:end],
+                                                    indices.array[nnz_start:nnz_end],
+                                                    path_lengths.array[nnz_start:nnz_end],
+                                                    norm_unit=norm_unit)
+                if n >= 100000:
+                    tdiff = difftime(timer(), starttime, units="secs")
+                    logger.debug("processed %d/%d (%f) with %d jobs in %f sec(s)" %
+                                 (blocks[-1][1], n, blocks[-1][1]*1./n, pool.n_jobs, tdiff))
+        finally:
+            for shared in [x_shared, row_counts, indices, path_lengths]:
+                shared.close()
+
+    def _transform_batch_to_region_features(self, x, norm_unit=False):
+        """ Transforms a batch of instances to a CSR matrix in the region space
+
+        All trees are traversed together through the compiled forest and the
+        CSR data/indices/indptr arrays are filled directly from the regions visited.
+
+        :param x: np.ndarray
+        :param norm_unit: bool
+        :return: csr_matrix
+        """
+        row_counts, region_ids, path_lengths = self.get_compiled_forest().get_region_paths(
+            x, self.add_leaf_nodes_only)
+        return self._region_paths_to_csr(row_counts, region_ids, path_lengths, norm_unit=norm_unit)
+
+    def _region_paths_to_csr(self, row_counts, region_ids, path_lengths, norm_unit=False):
+        """ Builds the CSR matrix in region space from the output of CompiledForest.get_region_paths() """
+        n = len(row_counts)
+        data = np.asarray(self.get_region_score_for_instance_transform(region_ids, path_lengths),
+                          dtype=float)
+        if norm_unit:
+            rows = np.repeat(np.arange(n, dtype=int), row_counts)
+            norms = np.sqrt(np.bincount(rows, weights=data ** 2, minlength=n))
+            # in order to avoid a divide by zero warning
+            norms[norms == 0] = 1
+            data = data / norms[rows]
+        indptr = np.zeros(n + 1, dtype=int)
+        np.cumsum(row_counts, out=indptr[1:])
+        return csr_matrix((data, np.array(region_ids, dtype=int), indptr), shape=(n, len(self.d)))
+
+    def _use_worker_pool(self, x, min_rows=2000):
+        return self.n_jobs != 1 and x.shape[0] >= min_rows and not sparse.issparse(x)
+
+    def _get_worker_pool(self):
+        if self.worker_pool is None:
+            self.worker_pool = WorkerPool(self.n_jobs)
+        return self.worker_pool
+
+    def _get_shared_compiled_forest(self):
+        """ Publishes the compiled forest to the workers; republished only when rebuilt """
+        compiled_forest = self.get_compiled_forest()
+        if self.shared_compiled_forest is None or self.shared_compiled_forest.obj is not compiled_forest:
+            if self.shared_compiled_forest is not None:
+                self.shared_compiled_forest.close()
+            self.shared_compiled_forest = SharedObject(compiled_forest)
+        return self.shared_compiled_forest
+
+    def close_workers(self):
+        """ Shuts down the worker processes and releases the shared resources """
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+        if self.shared_compiled_forest is not None:
+            self.shared_compiled_forest.close()
+            self.shared_compiled_forest = None
+        if isinstance(self.clf, RandomSplitForest):
+            self.clf.close_workers()
 
     def _transform_to_region_features_with_lookup(self, x, x_new):
         """ Transforms from original feature space to IF node space
@@ -732,33 +1195,60 @@ class AadForest(Aad, StreamingSupport):
         Returns:
             np.array(int)
         """
-        n = x.shape[0]
-        all_regions = set()
-        for i, tree in enumerate(self.clf.estimators_):
-            tree_node_regions = self.all_node_regions[i]
-            for j in range(n):
-                tree_paths = self.get_decision_path(x[[j], :], tree)
-                instance_regions = [tree_node_regions[node_idx] for node_idx in tree_paths[0]]
-                all_regions.update(instance_regions)
-        return list(all_regions)
+        if not self._use_worker_pool(x):
+            _, region_ids = self.get_compiled_forest().get_regions(x, self.add_leaf_nodes_only)
+            return list(np.unique(region_ids))
+        shared_forest = self._get_shared_compiled_forest()
+        pool = self._get_worker_pool()
+        x_shared = SharedArray.from_array(np.asarray(x, dtype=float))
+        try:
+            tasks = [(shared_forest, x_shared, start, end, self.add_leaf_nodes_only)
+                     for start, end in get_row_blocks(x.shape[0], pool.n_jobs)]
+            region_ids = pool.map(forest_region_ids_block, tasks)
+        finally:
+            x_shared.close()
+        return list(np.unique(np.concatenate(region_ids)))
+
+    def get_instance_region_ids(self, x):
+        """ Returns the region ids of each instance in x
+
+        Args:
+            x: np.ndarray
+                instances in original feature space
+        Returns:
+            np.array(int), np.array(int)
+                instance index (row in x) and region id; ordered by instance index
+        """
+        compiled_forest = self.get_compiled_forest()
+        pairs, region_ids = compiled_forest.get_regions(x, self.add_leaf_nodes_only)
+        return pairs // compiled_forest.n_trees, region_ids
+
+    def get_region_histogram(self, x=None):
+        """ Returns a RegionHistogram over the regions of the current trees
+
+        :param x: np.ndarray
+            Instances to add to the histogram; can be added later
+            with add_to_region_histogram()
+        :return: RegionHistogram
+        """
+        tree_sizes = np.array([len(tree_node_regions) for tree_node_regions in self.all_node_regions], dtype=int)
+        hist = RegionHistogram(np.repeat(tree_sizes, tree_sizes))
+        if x is not None:
+            self.add_to_region_histogram(hist, x)
+        return hist
+
+    def add_to_region_histogram(self, hist, x):
+        """ Passes only the new instances x through the trees and adds them to hist """
+        if len(hist.counts) != len(self.d):
+            raise ValueError("Region histogram does not match the regions of the current trees")
+        row_counts, region_ids, _ = self.get_compiled_forest().get_region_paths(x, self.add_leaf_nodes_only)
+        hist.add(row_counts, region_ids)
 
     def get_node_sample_distributions(self, X, delta=1e-16):
         if X is None:
             logger.debug("WARNING: get_node_sample_distributions(): no instances found")
             return None
-        n = X.shape[0]
-        delta_ = (delta * 1. / n)
-        nodes = self.clf.get_node_ids(X, getleaves=self.add_leaf_nodes_only)
-        dists = np.ones(len(self.d), dtype=np.float32) * delta_  # take care of zero counts
-        start_region = 0
-        for i, tree_node_regions in enumerate(self.all_node_regions):
-            denom = n + delta_ * len(tree_node_regions)  # for probabilities to add to 1.0
-            tree_nodes = nodes[i]
-            for node in tree_nodes:
-                dists[tree_node_regions[node]] += 1.
-            dists[start_region:(start_region+len(tree_node_regions))] /= denom
-            start_region += len(tree_node_regions)
-        return dists
+        return self.get_region_histogram(X).get_distribution(delta=delta)
 
     def get_KL_divergence(self, p, q):
         """KL(p || q)"""
@@ -773,7 +1263,7 @@ class AadForest(Aad, StreamingSupport):
             start_region += n_regions
         return kl_trees, np.sum(kl_trees) / self.n_estimators
 
-    def get_KL_divergence_distribution(self, x, p=None, alpha=0.05, n_tries=10, simple=True):
+    def get_KL_divergence_distribution(self, x, p=None, alpha=0.05, n_tries=10, simple=True, hist=None):
         """ Gets KL divergence between a distribution 'p' and the tree distribution of data 'x'
 
         :param x: np.ndarray
@@ -783,28 +1273,25 @@ class AadForest(Aad, StreamingSupport):
         :param simple: bool
             True: Uses only one partition of the data: first half / last half
                   This also implies n_tries=1.
+        :param hist: RegionHistogram
+            Histogram to which x has been added. If provided, x is not
+            passed through the trees again. Else, x is passed only once.
         :return: np.array, float
         """
+        if hist is None:
+            hist = self.get_region_histogram(x)
         if simple:
             n_tries = 1
         kls = list()
         for i in range(n_tries):
-            all_i = np.arange(x.shape[0], dtype=int)
+            all_i = np.arange(hist.n, dtype=int)
             np.random.shuffle(all_i)
             h = int(len(all_i) // 2)
             if p is None:
-                if simple:
-                    x1 = x[:h, :]
-                else:
-                    x1 = x[all_i[:h], :]
-                p1 = self.get_node_sample_distributions(x1)
+                p1 = hist.get_distribution(slice(0, h) if simple else all_i[:h])
             else:
                 p1 = p
-            if simple:
-                x2 = x[h:, :]
-            else:
-                x2 = x[all_i[h:], :]
-            p2 = self.get_node_sample_distributions(x2)
+            p2 = hist.get_distribution(slice(h, hist.n) if simple else all_i[h:])
             kl_trees, _= self.get_KL_divergence(p1, p2)
             kls.append(kl_trees)
         kls = np.vstack(kls)
@@ -8,6 +8,7 @@ from ..common.expressions import get_feature_meta_default, convert_feature_range
 
 from ..bayesian_ruleset.bayesian_ruleset import BayesianRuleset
 
+from ..common.set_cover import *
 from .aad_globals import *
 from .aad_support import *
 
@@ -32,25 +33,15 @@ def get_region_indexes_for_instances(x, model=None, n_top=-1):
 
 
 def get_region_volumes(model, region_indexes, feature_ranges):
-    volumes = np.zeros(len(region_indexes), dtype=np.float32)
-    d = feature_ranges.shape[0]  # number of features
-    for i, ridx in enumerate(region_indexes):
-        region = model.all_regions[ridx].region
-        # logger.debug(str(region))
-        region_ranges = np.zeros(d, dtype=np.float32)
-        for j in range(feature_ranges.shape[0]):
-            rmin = feature_ranges[j][0] if np.isinf(region[j][0]) else region[j][0]
-            rmax = feature_ranges[j][1] if np.isinf(region[j][1]) else region[j][1]
-            # logger.debug("%d: %f, %f" % (j, rmin, rmax))
-            if rmax == rmin:
-                # logger.debug("%d: %f, %f" % (j, rmin, rmax))
-                # If the range of a variable is a single value, we just ignore it.
-                region_ranges[j] = 1.0
-            else:
-                region_ranges[j] = rmax - rmin
-        volumes[i] = np.prod(region_ranges)
+    """ Returns the volumes of the regions within the feature ranges
+
+    Infinite region bounds are replaced by the feature ranges. The volumes
+    of all regions are computed together and cached with the model's
+    region arrays, which are rebuilt whenever the forest regions change.
+    """
+    volumes = model.get_region_arrays().get_volumes(feature_ranges)
     # logger.debug("volumes:\n%s" % str(volumes))
-    return volumes
+    return volumes[np.asarray(region_indexes, dtype=int)]
 
 
 def get_instances_for_description(x=None, labels=None, metrics=None, instance_indexes=None):
@@ -109,16 +100,17 @@ def get_regions_for_description(x, instance_indexes=None, model=None, region_sco
         nwd = -model.d
     else:
         nwd = -np.multiply(model.w, model.d)
-    regions = set()
     if n_top < 0:
         n_top = len(nwd)
-    for i, inst in enumerate(instance_indexes):
-        inst_regs = np.array(model.get_region_ids(x[[inst], :]))
-        idxs = np.argsort(nwd[inst_regs])
-        ordered_inst_regs = inst_regs[idxs]
-        ordered_inst_regs = ordered_inst_regs[0:min(len(ordered_inst_regs), n_top)]
-        regions.update(ordered_inst_regs)
-    regions = list(regions)
+    # regions of all instances with a single pass through the forest
+    insts, inst_regs = model.get_instance_region_ids(x[instance_indexes, :])
+    # order the regions of each instance by score (ties by region id)
+    idxs = np.lexsort((inst_regs, nwd[inst_regs], insts))
+    insts, inst_regs = insts[idxs], inst_regs[idxs]
+    # rank of each region within its instance
+    starts = np.searchsorted(insts, insts, side="left")
+    ranks = np.arange(len(insts)) - starts
+    regions = np.unique(inst_regs[ranks < n_top])
     # logger.debug("selected regions: %d\n%s" % (len(regions), str(regions)))
     return np.array(regions, dtype=int)
 
@@ -146,30 +138,22 @@ def get_region_memberships(x, model=None,
     """
     if instance_indexes is None or len(instance_indexes) == 0:
         return None, None
-    nregions = len(region_indexes)
-    member_insts = list()
-    region_membership_indicators = list()
-    for i in instance_indexes:
-        inds = np.zeros(nregions, dtype=int)
-        for j, ridx in enumerate(region_indexes):
-            inds[j] = is_in_region(x[i, :], model.all_regions[ridx].region)
-        if np.sum(inds) > 0:
-            member_insts.append(i)
-            region_membership_indicators.append(np.reshape(inds, newshape=(1, nregions)))
-        else:
-            # logger.debug("No region selected for instance %d" % i)
-            pass
-    member_insts = np.array(member_insts, dtype=int)
-    # logger.debug("#region_indexes: %d, #instance_indexes: %d, #region_membership_indicators: %d" %
-    #              (len(region_indexes), len(instance_indexes), len(region_membership_indicators)))
-    if len(region_membership_indicators) > 0:
-        region_membership_indicators = np.vstack(region_membership_indicators)
+    instance_indexes = np.asarray(instance_indexes, dtype=int)
+    region_indexes = np.asarray(region_indexes, dtype=int)
+    memberships = model.get_region_arrays().get_memberships(x[instance_indexes, :], region_indexes)
+    is_member = np.sum(memberships, axis=1) > 0
+    member_insts = instance_indexes[is_member]
+    # logger.debug("#region_indexes: %d, #instance_indexes: %d, #member_insts: %d" %
+    #              (len(region_indexes), len(instance_indexes), len(member_insts)))
+    if len(member_insts) > 0:
+        region_membership_indicators = memberships[is_member]
     else:
         region_membership_indicators = None
     return member_insts, region_membership_indicators
 
 
-def get_compact_regions(x, model=None, instance_indexes=None, region_indexes=None, volumes=None, p=1):
+def get_compact_regions(x, model=None, instance_indexes=None, region_indexes=None, volumes=None, p=1,
+                        solver=SET_COVER_ILP, time_limit=None):
     """ Returns the most compact set of regions among region_indexes that contain the required instances
 
     :param x: np.ndarray
@@ -183,33 +167,23 @@ def get_compact_regions(x, model=None, instance_indexes=None, region_indexes=Non
     :param p: int
         Determines how much to penalize the size of the regions (based on their volumes).
         If this is large, then bigger regions will be strongly discouraged from getting selected.
+    :param solver: str
+        Set cover solver (see common.set_cover). 'ilp' is exact; 'greedy'
+        and 'lp' are fast approximations.
+    :param time_limit: float
+        Time limit (seconds) for the 'ilp' solver
     :return:
     """
-    import cvxopt
-    from cvxopt import glpk
-
     member_insts, member_inds = get_region_memberships(x, model=model,
                                                        instance_indexes=instance_indexes,
                                                        region_indexes=region_indexes)
     # logger.debug("anom indexes in selected regions (%d):\n%s" % (len(member_anoms), str(list(member_anoms))))
     # logger.debug("member_inds (%s):\n%s" % (str(member_inds.shape), str(member_inds)))
 
-    nvars = member_inds.shape[1]
-    glpk.options['msg_lev'] = 'GLP_MSG_OFF'
-
-    c = cvxopt.matrix([float(v**p) for v in volumes], tc='d')  # minimize total volume**p
-
-    # below states that each anomaly should be included in atleast one region
-    G = cvxopt.matrix(-member_inds, tc='d')
-    h = cvxopt.matrix([-1] * member_inds.shape[0], tc='d')
-
-    bin_vars = [i for i in range(nvars)]
-    (status, soln) = cvxopt.glpk.ilp(c, G, h, B=set(bin_vars))
-    # logger.debug("ILP status: %s" % status)
-    if soln is not None:
-        soln = np.reshape(np.array(soln), newshape=(nvars,))
-        # logger.debug("ILP solution:\n%s" % str(soln))
-        idxs = np.where(soln == 1)[0]
+    # minimize total volume**p such that each anomaly is included in atleast one region
+    costs = [float(v**p) for v in volumes]
+    idxs = solve_set_cover(costs, member_inds, solver=solver, time_limit=time_limit)
+    if idxs is not None:
         if False:
             logger.debug("\nregion_indexes: %d\n%s\nmember_insts: %d\n%s" %
                          (len(idxs), str(list(region_indexes[idxs])),
@@ -403,9 +377,6 @@ class CompactDescriber(InstancesDescriber):
             :return: np.array
                 Selected regions
             """
-        import cvxopt
-        from cvxopt import glpk
-
         m_positives, m_positive_inds = get_region_memberships(self.x, model=self.model,
                                                               instance_indexes=positive_indexes,
                                                               region_indexes=region_indexes)
@@ -425,9 +396,6 @@ class CompactDescriber(InstancesDescriber):
         # logger.debug("m_positive_inds (%s):\n%s" % (str(m_positive_inds.shape), str(m_positive_inds)))
         # logger.debug("m_negative_inds (%s):\n%s" % (str(m_negative_inds.shape), str(m_negative_inds)))
 
-        nvars = m_positive_inds.shape[1]
-        glpk.options['msg_lev'] = 'GLP_MSG_OFF'
-
         # minimize total volume and the number of negative examples, i.e.:
         #   (volume**p + n_negatives)
         # logger.debug("volumes:\n%s" % str(list(volumes)))
@@ -437,19 +405,12 @@ class CompactDescriber(InstancesDescriber):
                    + self.neg_penalty * np.multiply(n_negatives, volumes)
                    + complexities)
         # logger.debug("vol_neg:\n%s" % str(list(vol_neg)))
-        c = cvxopt.matrix([float(v) for v in vol_neg], tc='d')
-
-        # below states that each anomaly should be included in atleast one region
-        G = cvxopt.matrix(-m_positive_inds, tc='d')
-        h = cvxopt.matrix([-1] * m_positive_inds.shape[0], tc='d')
-
-        bin_vars = [i for i in range(nvars)]
-        (status, soln) = cvxopt.glpk.ilp(c, G, h, B=set(bin_vars))
-        # logger.debug("ILP status: %s" % status)
-        if soln is not None:
-            soln = np.reshape(np.array(soln), newshape=(nvars,))
-            # logger.debug("ILP solution:\n%s" % str(soln))
-            idxs = np.where(soln == 1)[0]
+
+        # each positive instance should be included in atleast one region
+        idxs = solve_set_cover(vol_neg, m_positive_inds,
+                               solver=self.opts.describe_solver,
+                               time_limit=self.opts.describe_ilp_time_limit)
+        if idxs is not None:
             if False:
                 logger.debug("\nregion_indexes: %d\n%s\nm_positives: %d\n%s" %
                              (len(idxs), str(list(region_indexes[idxs])),
@@ -484,7 +445,9 @@ class MinimumVolumeCoverDescriber(CompactDescriber):
         compact_region_idxs = get_compact_regions(self.x, model=self.model,
                                                   instance_indexes=instance_indexes,
                                                   region_indexes=region_indexes,
-                                                  volumes=volumes, p=self.opts.describe_volume_p)
+                                                  volumes=volumes, p=self.opts.describe_volume_p,
+                                                  solver=self.opts.describe_solver,
+                                                  time_limit=self.opts.describe_ilp_time_limit)
         regions = [self.model.all_regions[ridx].region for ridx in compact_region_idxs]
         rules, str_rules = self.convert_regions_to_rules(regions, region_indexes=compact_region_idxs)
         return compact_region_idxs, regions, rules
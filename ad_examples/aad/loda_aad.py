@@ -15,18 +15,37 @@ from .data_stream import StreamingSupport
 class AadLoda(Aad, StreamingSupport):
     """ Wrapper over LODA
 
+    The projection vectors are fixed once the model is fit. In the streaming
+    setting, the histograms along the projections are updated with the
+    instances from the stream buffer.
+
     Attributes:
          sparsity: float
          mink: int
          maxk: int
+         update_type: int
+            HIST_UPD_OVERWRITE or HIST_UPD_INCREMENTAL; same values as
+            TREE_UPD_OVERWRITE and TREE_UPD_INCREMENTAL
+         incremental_update_weight: float
+         adaptive_bins: bool
+            Whether the histogram ranges grow (by merging bins) to include
+            new instances from the stream
+         n_jobs: int
+            Number of processes for building the histograms in fit()
          loda_model: LodaResult
             The LODA model containing all projection vectors and histograms
     """
-    def __init__(self, sparsity=np.nan, mink=1, maxk=0, random_state=None):
+    def __init__(self, sparsity=np.nan, mink=1, maxk=0, random_state=None,
+                 update_type=HIST_UPD_OVERWRITE, incremental_update_weight=0.5,
+                 adaptive_bins=True, n_jobs=1):
         Aad.__init__(self, LODA, random_state=random_state)
         self.sparsity = sparsity
         self.mink = mink
         self.maxk = maxk
+        self.update_type = update_type
+        self.incremental_update_weight = incremental_update_weight
+        self.adaptive_bins = adaptive_bins
+        self.n_jobs = n_jobs
         self.loda_model = None
         self.m = None
 
@@ -35,14 +54,18 @@ class AadLoda(Aad, StreamingSupport):
         return self.m
 
     def fit(self, x):
-        self.loda_model = loda(x, self.sparsity, mink=self.mink, maxk=self.maxk)
+        self.loda_model = loda(x, self.sparsity, mink=self.mink, maxk=self.maxk, n_jobs=self.n_jobs)
         self.m = self.loda_model.pvh.pvh.w.shape[1]
+        self.loda_model.pvh.densities = StreamingHistogramDensities(
+            self.loda_model.pvh.pvh.hists, update_type=self.update_type,
+            incremental_update_weight=self.incremental_update_weight,
+            adaptive=self.adaptive_bins)
         w = np.ones(self.m, dtype=float)
         self.w = normalize(w)
         logger.debug("LODA m: %d" % self.m)
 
     def transform_to_ensemble_features(self, x, dense=False, norm_unit=False):
-        hpdfs = get_all_hist_pdfs(x, self.loda_model.pvh.pvh.w, self.loda_model.pvh.pvh.hists)
+        hpdfs = self.loda_model.pvh.get_all_hist_pdfs(x)
         nlls = -np.log(hpdfs)
         if norm_unit:
             norms = np.sqrt(np.power(nlls, 2).sum(axis=1))
@@ -54,11 +77,20 @@ class AadLoda(Aad, StreamingSupport):
         return nlls
 
     def supports_streaming(self):
-        return False
+        return True
 
     def add_samples(self, X, current=False):
-        logger.warning("Model does not support stream update. Retaining old model.")
+        """Incrementally updates the stream buffer (or the current) histogram counts"""
+        densities = self.loda_model.pvh.densities
+        densities.add_samples(X.dot(self.loda_model.pvh.pvh.w), current=current)
+        if current:
+            self.loda_model.pvh.pvh.hists = densities.get_histograms()
+
+    def update_model_from_stream_buffer(self, replace_trees=None):
+        """Updates the histograms from the stream buffer
 
-    def update_model_from_stream_buffer(self):
-        # LODA implementation currently does not support this
-        pass
+        :param replace_trees: ignored; the projections are never replaced
+        """
+        densities = self.loda_model.pvh.densities
+        densities.update_from_buffer()
+        self.loda_model.pvh.pvh.hists = densities.get_histograms()
@@ -15,8 +15,9 @@ class HistogramPDFs(object):
 
 def get_hpdfs_for_samples(allsamples, w, hists):
     samples_hpdfs = []
+    densities = HistogramDensities(hists)
     for i in range(len(allsamples)):
-        hpdfs = get_all_hist_pdfs(allsamples[i].fmat, w, hists)
+        hpdfs = densities.get_pdfs(allsamples[i].fmat.dot(w))
         nlls = -np.log(hpdfs)
         samples_hpdfs.append(HistogramPDFs(hpdfs=hpdfs, nlls=nlls))
     return samples_hpdfs
@@ -98,9 +98,10 @@ class QueryTopDiverseSubspace(Query):
                 # Filter only the labeled anomalies for diversity computation
                 queried_anom_indexes = np.where(ensemble.labels[queried_items] == 1)[0]
                 if len(queried_anom_indexes) > 0:
-                    if len(queried_anom_indexes) > 50:
+                    if self.opts.describe_solver == SET_COVER_ILP and len(queried_anom_indexes) > 50:
                         # The ILP to select compact regions could be expensive.
-                        # Therefore, take a subsample.
+                        # Therefore, take a subsample. The greedy/lp solvers
+                        # scale to all queried anomalies.
                         np.random.shuffle(queried_anom_indexes)
                         queried_anom_indexes = queried_anom_indexes[0:50]
                     instance_ids = append(instance_ids, queried_items[queried_anom_indexes])
@@ -111,7 +112,9 @@ class QueryTopDiverseSubspace(Query):
             # logger.debug("reg_idxs:%d\n%s" % (len(reg_idxs), str(list(reg_idxs))))
             compact_reg_idxs = get_compact_regions(ensemble.samples, instance_indexes=instance_ids,
                                                    region_indexes=reg_idxs, model=model, volumes=volumes,
-                                                   p=self.opts.describe_volume_p)
+                                                   p=self.opts.describe_volume_p,
+                                                   solver=self.opts.describe_solver,
+                                                   time_limit=self.opts.describe_ilp_time_limit)
             if True:
                 logger.debug("#reg_idxs:%d, #compact regions:%d, #queried_anoms: %d, p: %d, n_top: %d" %
                              (len(reg_idxs), len(compact_reg_idxs),
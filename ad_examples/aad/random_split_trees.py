@@ -26,12 +26,12 @@ from sklearn.ensemble.bagging import BaseBagging
 from sklearn.tree._tree import Tree
 from sklearn.ensemble import IsolationForest
 
-from multiprocessing import Pool
 
 from ..common.utils import *
+from ..common.parallel_utils import *
 from .data_stream import *
 
-__all__ = ["get_tree_partitions", "RandomSplitTree", "RandomSplitForest",
+__all__ = ["get_tree_partitions", "get_feature_values", "RandomSplitTree", "RandomSplitForest",
            "ArrTree", "HSSplitter", "HSTree", "HSTrees",
            "RSForestSplitter", "RSTree", "RSForest",
            "IForest", "StreamingSupport",
@@ -64,6 +64,19 @@ def get_tree_partitions(n_trees, n_views):
     return n_estimators_view
 
 
+def get_feature_values(X, rows, features):
+    """Returns the values X[rows[i], features[i]] as a flat array
+
+    :param X: matrix (might be sparse)
+    :param rows: np.array(int)
+    :param features: np.array(int)
+    :return: np.array
+    """
+    if issparse(X):
+        return np.asarray(X[rows, features]).reshape(-1)
+    return np.asarray(X)[rows, features]
+
+
 class SplitContext(object):
     def __init__(self, min_vals=None, max_vals=None, r=1.):
         self.min_vals = min_vals
@@ -321,23 +334,12 @@ class ArrTree(object):
         if self.node_count < 1:
             # no nodes; likely tree has not been constructed yet
             raise ValueError("Tree not constructed yet")
-        for i in np.arange(X.shape[0]):
-            node = 0  # start at root
-            while node >= 0:
-                if current:
-                    self.n_node_samples[node] += 1
-                else:
-                    self.n_node_samples_buffer[node] += 1
-                val = X[i, self.feature[node]]
-                if self.children_left[node] == -1 and self.children_right[node] == -1:
-                    # reached leaf
-                    # self.n_node_samples[node] += 1
-                    break
-                if val <= self.threshold[node]:
-                    next_node = self.children_left[node]
-                else:
-                    next_node = self.children_right[node]
-                node = next_node
+        _, (_, path_nodes) = self.traverse(X, getnodeinds=True)
+        counts = np.bincount(path_nodes, minlength=self.node_count)
+        if current:
+            self.n_node_samples[0:self.node_count] += counts
+        else:
+            self.n_node_samples_buffer[0:self.node_count] += counts
 
     def get_all_leaf_nodes(self):
         leaves = np.zeros(self.node_count, dtype=int)
@@ -386,34 +388,57 @@ class ArrTree(object):
         if self.node_count < 1:
             # no nodes; likely tree has not been constructed yet
             raise ValueError("Tree not constructed yet")
-        n = X.shape[0]
-        leaves = None
-        if getleaves:
-            leaves = np.zeros(n, dtype=int)
-        x_tmp = None
+        leaves, (path_rows, path_nodes) = self.traverse(X, getnodeinds=getnodeinds)
         if getnodeinds:
-            nodeinds = csr_matrix((0, self.node_count), dtype=float)
-            x_tmp = lil_matrix((n, self.node_count), dtype=nodeinds.dtype)
-        for i in np.arange(n):
-            node = 0  # start at root
-            while node >= 0:
-                if getnodeinds:
-                    x_tmp[i, node] = 1
-                v = X[i, self.feature[node]]
-                if self.children_left[node] == -1 and self.children_right[node] == -1:
-                    # reached leaf
-                    if getleaves:
-                        leaves[i] = node
-                    break
-                if v <= self.threshold[node]:
-                    next_node = self.children_left[node]
-                else:
-                    next_node = self.children_right[node]
-                node = next_node
+            n = X.shape[0]
+            # rows are visited level-by-level; a stable sort by row keeps the nodes
+            # of every row in root-to-leaf order, i.e., in increasing node ids.
+            order = np.argsort(path_rows, kind="mergesort")
+            indptr = np.zeros(n + 1, dtype=int)
+            np.cumsum(np.bincount(path_rows, minlength=n), out=indptr[1:])
+            nodeinds = csr_matrix((np.ones(len(order), dtype=float), path_nodes[order], indptr),
+                                  shape=(n, self.node_count))
+            return leaves if getleaves else None, nodeinds
+        return leaves if getleaves else None
+
+    def traverse(self, X, getnodeinds=False):
+        """Passes all instances from root to leaf, one tree level at a time.
+
+        All instances which have not yet reached a leaf are advanced together
+        by one level in every step. Hence, the number of python-level
+        iterations is bounded by the depth of the tree and not by the
+        number of instances.
+
+        :param X: matrix (might be sparse)
+            Input instances where each row is an instance
+        :param getnodeinds: boolean
+            If True, the (row, node) index pairs of all nodes through which
+            the instances pass will also be returned.
+        :return: np.array(int), (np.array(int), np.array(int))
+            The leaf node index for each instance, and the row and node
+            indexes of all visited nodes (None, None if getnodeinds is False).
+        """
+        n = X.shape[0]
+        leaves = np.zeros(n, dtype=int)
+        rows = np.arange(n, dtype=int)
+        nodes = np.zeros(n, dtype=int)  # start at root
+        path_rows = [np.zeros(0, dtype=int)]
+        path_nodes = [np.zeros(0, dtype=int)]
+        while len(rows) > 0:
+            if getnodeinds:
+                path_rows.append(rows)
+                path_nodes.append(nodes)
+            is_leaf = np.logical_and(self.children_left[nodes] == TREE_LEAF,
+                                     self.children_right[nodes] == TREE_LEAF)
+            leaves[rows[is_leaf]] = nodes[is_leaf]
+            rows = rows[~is_leaf]
+            nodes = nodes[~is_leaf]
+            vals = get_feature_values(X, rows, self.feature[nodes])
+            nodes = np.where(vals <= self.threshold[nodes],
+                             self.children_left[nodes], self.children_right[nodes])
         if getnodeinds:
-            nodeinds = x_tmp.tocsr()
-            return leaves, nodeinds
-        return leaves
+            return leaves, (np.concatenate(path_rows), np.concatenate(path_nodes))
+        return leaves, (None, None)
 
     def __repr__(self):
         s = ''
@@ -720,6 +745,12 @@ class RandomSplitForest(StreamingSupport):
         self.incremental_update_weight = incremental_update_weight
         self.estimators_ = None
 
+        # reused across calls to fit() and decision_function() when n_jobs != 1
+        self.worker_pool = None
+
+        # estimators_ published to the worker processes; reset whenever the trees change
+        self.shared_estimators = None
+
     def _set_oob_score(self, X, y):
         raise NotImplementedError("OOB score not supported by iforest")
 
@@ -729,17 +760,52 @@ class RandomSplitForest(StreamingSupport):
     def get_decision_function(self):
         raise NotImplementedError("get_decision_function() not implemented")
 
+    def _get_worker_pool(self):
+        if self.worker_pool is None:
+            self.worker_pool = WorkerPool(self.n_jobs)
+            # shut down the workers along with the forest if close_workers() is never called
+            register_cleanup(self, self.worker_pool.close)
+        return self.worker_pool
+
+    def _map(self, func, tasks):
+        """Applies func to each task in the worker pool, or in this process if n_jobs is 1"""
+        if self.n_jobs == 1:
+            return [func(task) for task in tasks]
+        return self._get_worker_pool().map(func, tasks)
+
+    def _get_shared_estimators(self):
+        if self.shared_estimators is None:
+            # the file is deleted by _reset_shared_estimators(), else by
+            # the finalizer of SharedObject once the forest is released
+            self.shared_estimators = SharedObject(self.estimators_)
+        return self.shared_estimators
+
+    def _reset_shared_estimators(self):
+        if self.shared_estimators is not None:
+            self.shared_estimators.close()
+            self.shared_estimators = None
+
+    def close_workers(self):
+        """Shuts down the worker processes and releases the shared resources"""
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+        self._reset_shared_estimators()
+
     def _fit(self, X, y, max_samples, max_depth, sample_weight=None):
         n_trees = self.n_estimators
-        n_pool = self.n_jobs
 
-        p = Pool(n_pool)
         rnd_int = self.random_state.randint(42)
         if isinstance(max_samples, str):
             max_samples = min(256, X.shape[0])
         logger.debug("max_samples: %d" % max_samples)
-        trees = p.map(self.get_fitting_function(),
-                      [(max_depth, X, max_samples, rnd_int + i, self.update_type, self.incremental_update_weight) for i in range(n_trees)])
+        X_shared = X if self.n_jobs == 1 or issparse(X) else SharedArray.from_array(X)
+        try:
+            trees = self._map(self.get_fitting_function(),
+                              [(max_depth, X_shared, max_samples, rnd_int + i,
+                                self.update_type, self.incremental_update_weight) for i in range(n_trees)])
+        finally:
+            if isinstance(X_shared, SharedArray):
+                X_shared.close()
         return trees
 
     def fit(self, X, y=None, sample_weight=None):
@@ -774,6 +840,7 @@ class RandomSplitForest(StreamingSupport):
 
         self.max_samples_ = n_samples
 
+        self._reset_shared_estimators()
         self.estimators_ = self._fit(X, y, self.max_samples,
                                      max_depth=self.max_depth,
                                      sample_weight=sample_weight)
@@ -790,29 +857,40 @@ class RandomSplitForest(StreamingSupport):
         raise NotImplementedError("predict() is not supported for RandomTrees")
 
     def decision_function(self, X):
-        """Average anomaly score of X of the base classifiers."""
-        scores = np.zeros((1, X.shape[0]))
+        """Average anomaly score of X of the base classifiers.
+
+        With n_jobs != 1, the trees are partitioned among the workers of a
+        persistent pool. The trees are published to the workers once and
+        stay resident until they change; X is shared through a memory-mapped file.
+        """
         tm = Timer()
-        if True:
-            n_pool = self.n_jobs
-            p = Pool(n_pool)
-            hst_scores = p.map(self.get_decision_function(), [(X, hst, i) for i, hst in enumerate(self.estimators_)])
+        n_trees = len(self.estimators_)
+        if self.n_jobs == 1 or issparse(X):
+            hst_scores = [forest_decision((X, self.estimators_, 0, n_trees, self.get_decision_function()))]
         else:
-            hst_scores = list()
-            for tree_id, hst in enumerate(self.estimators_):
-                tm_tree = Timer()
-                hst_scores.append(hst.decision_function(X))
-                logger.debug(tm_tree.message("completed Tree[%d] decision function" % tree_id))
+            pool = self._get_worker_pool()
+            tree_blocks = get_row_blocks(n_trees, pool.n_jobs, min_rows=1, max_rows=n_trees)
+            estimators = self._get_shared_estimators()
+            X_shared = SharedArray.from_array(X)
+            try:
+                hst_scores = pool.map(forest_decision,
+                                      [(X_shared, estimators, start, end, self.get_decision_function())
+                                       for start, end in tree_blocks])
+            finally:
+                X_shared.close()
         logger.debug(tm.message("completed Trees decision_function"))
+        scores = np.zeros(X.shape[0], dtype=float)
         for s in hst_scores:
             scores += s
-        scores /= len(hst_scores)
-        return scores.reshape((scores.shape[1],))
+        scores /= n_trees
+        return scores
 
     def supports_streaming(self):
         return True
 
     def add_samples(self, X, current=True):
+        if current:
+            self._reset_shared_estimators()
         for tree in self.estimators_:
             tree.tree_.add_samples(X, current)
 
@@ -843,6 +921,7 @@ class RandomSplitForest(StreamingSupport):
             The indexes of trees to be replaced
         :return:
         """
+        self._reset_shared_estimators()
         for tree in self.estimators_:
             tree.tree_.update_model_from_stream_buffer()
 
@@ -981,6 +1060,8 @@ class HSTrees(RandomSplitForest):
 def hstree_fit(args):
     max_depth = args[0]
     X = args[1]
+    if isinstance(X, SharedArray):
+        X = X.array
     max_samples = args[2]
     rnd = args[3]
     update_type = args[4]
@@ -1009,6 +1090,23 @@ def hstree_decision(args):
     return scores
 
 
+def forest_decision(args):
+    """Sum of the decision function over the trees [start, end) for all rows of X
+
+    X might be a SharedArray and the trees might be a SharedObject when called
+    in a worker process.
+    """
+    X, estimators, start, end, decision_function = args
+    if isinstance(X, SharedArray):
+        X = X.array
+    if isinstance(estimators, SharedObject):
+        estimators = estimators.get()
+    scores = np.zeros(X.shape[0], dtype=float)
+    for i in range(start, end):
+        scores += decision_function((X, estimators[i], i))
+    return scores
+
+
 class RSForestSplitter(HSSplitter):
     """
     Attributes:
@@ -1113,6 +1211,8 @@ class RSForest(RandomSplitForest):
 def rsforest_fit(args):
     max_depth = args[0]
     X = args[1]
+    if isinstance(X, SharedArray):
+        X = X.array
     max_samples = args[2]
     rnd = args[3]
     update_type = args[4]
@@ -114,6 +114,8 @@ def test_kl_data_drift():
                              (window, str(list(replace_trees_by_kl)) if replace_trees_by_kl is not None else None))
             trees_replaced.append(0)
 
+    model.close_workers()
+
     if args.plot:
         legend_datasets = None
         # legend_datasets = ['ann_thyroid_1v3', 'weather']
@@ -89,6 +89,8 @@ def test_aad_rules(opts):
     meta = get_feature_meta_default(x, y, feature_names=feature_names, label_name="label")
     logger.debug(meta)
 
+    rule_cache = RuleSatisfactionCache(x, y)
+
     file_path_compact = os.path.join(opts.resultsdir, "%s_compact_rules.txt" % opts.dataset)
     file_path_top = os.path.join(opts.resultsdir, "%s_top_rules.txt" % opts.dataset)
     file_path_bayesian = os.path.join(opts.resultsdir, "%s_bayesian_rules.txt" % opts.dataset)
@@ -106,7 +108,7 @@ def test_aad_rules(opts):
 
         describer = CompactDescriber(x, y, model, opts, sample_negative=True)
         _, _, rules = describer.describe(np.array(queried, dtype=np.int32))
-        precision, recall, f1 = evaluate_ruleset(x, y, rules, average="binary")
+        precision, recall, f1 = evaluate_ruleset(x, y, rules, average="binary", cache=rule_cache)
         logger.debug("precision: %f, recall: %f, f1: %f" % (precision, recall, f1))
 
         # we will recompute the Bayesian ruleset every time just for DEBUG
@@ -151,8 +153,8 @@ def test_aad_rules(opts):
 
     save_strings_to_file(str_rules_bayesian, file_path_bayesian)
 
-    _, _, f1_compact = evaluate_ruleset(x, y, rules_compact, average="weighted")
-    _, _, f1_bayesian = evaluate_ruleset(x, y, rules_bayesian, average="weighted")
+    _, _, f1_compact = evaluate_ruleset(x, y, rules_compact, average="weighted", cache=rule_cache)
+    _, _, f1_bayesian = evaluate_ruleset(x, y, rules_bayesian, average="weighted", cache=rule_cache)
     print("F1 scores: compact descriptions: %f; bayesian: %f" % (f1_compact, f1_bayesian))
 
     if x.shape[1] == 2 and opts.plot2D:
@@ -1,6 +1,10 @@
 import numpy.random as rnd
 from sklearn import manifold
 from sklearn.ensemble import IsolationForest
+from sklearn.neighbors import NearestNeighbors
+from scipy import sparse
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import splu, cg
 
 from ..common.gen_samples import *
 
@@ -19,10 +23,23 @@ class LabelDiffusion(object):
     IMPORTANT: The results from Python's Scikit-Learn MDS API are significantly
     different (and sub-optimal) from R. Strongly recommend R's isoMDS for the last
     step of converting pair-wise distances to 2D coordinates.
+
+    The affinity matrix W is a sparse symmetric kNN graph. The diffusion
+    matrix A = (I - alpha*S)^-1 is never inverted explicitly; only the
+    required columns are obtained by solving (I - alpha*S) X = E either
+    with a sparse LU factorization (solver='splu') or with conjugate
+    gradients (solver='cg'), block_size columns at a time.
+
+    Attributes:
+        B: scipy.sparse.csc_matrix
+            I - alpha*S, where S = D^-1/2 W D^-1/2
+        diag_: np.array
+            Diagonal of A, used to normalize the diffusion
     """
     def __init__(self, n_neighbors=10, k2=0.5, alpha=0.99,
                  n_components=2, eigen_solver='auto',
-                 tol=0., max_iter=None, n_jobs=1, metric=True):
+                 tol=0., max_iter=None, n_jobs=1, metric=True,
+                 solver="splu", block_size=1000):
         self.n_neighbors = n_neighbors
         self.k2 = k2
         self.alpha = alpha
@@ -32,53 +49,108 @@ class LabelDiffusion(object):
         self.max_iter = max_iter
         self.n_jobs = n_jobs
         self.metric = metric
+        self.solver = solver
+        self.block_size = block_size
 
         self.alphas_ = None
         self.lambdas_ = None
 
-    def fit_transform(self, x_in):
-        n = nrow(x_in)
-        x = normalize_and_center_by_feature_range(x_in)
-        dists = np.zeros(shape=(n, n), dtype=float)
-        for i in range(n):
-            for j in range(i, n):
-                dists[i, j] = euclidean_dist(x[i, :], x[j, :])
-                dists[j, i] = dists[i, j]
+        self.B = None
+        self.lu_ = None
+        self.diag_ = None
 
-        logger.debug(dists[0, 0:10])
-
-        neighbors = np.zeros(shape=(n, self.n_neighbors), dtype=int)
-        for i in range(n):
-            neighbors[i, :] = np.argsort(dists[i, :])[0:self.n_neighbors]
+    def get_knn_graph(self, x):
+        """ Returns the sparse symmetric affinity matrix of the kNN graph of x """
+        n = nrow(x)
+        nn = NearestNeighbors(n_neighbors=min(self.n_neighbors, n), n_jobs=self.n_jobs)
+        dists, neighbors = nn.fit(x).kneighbors(x)
 
         logger.debug(neighbors[0, 0:10])
 
-        W = np.zeros(shape=(n, n))
-        for i in range(n):
-            for j in neighbors[i, :]:
-                # diagonal elements of W will be zeros
-                if i != j:
-                    W[i, j] = np.exp(-(dists[i, j] ** 2) / self.k2)
-                    W[j, i] = W[i, j]
-
-        D = W.sum(axis=1)
-        # logger.debug(str(list(D[0:10])))
+        rows = np.repeat(np.arange(n), neighbors.shape[1])
+        cols = neighbors.reshape(-1)
+        vals = np.exp(-(dists.reshape(-1) ** 2) / self.k2)
+        keep = rows != cols  # diagonal elements of W will be zeros
+        W = csr_matrix((vals[keep], (rows[keep], cols[keep])), shape=(n, n))
+        # W[i, j] = W[j, i] is set if either is among the neighbors of the other
+        return W.maximum(W.T)
 
-        iDroot = np.diag(np.sqrt(D) ** (-1))
-
-        S = iDroot.dot(W.dot(iDroot))
-        # logger.debug("S: %s" % str(list(S[0, 0:10])))
+    def fit(self, x_in):
+        n = nrow(x_in)
+        x = normalize_and_center_by_feature_range(x_in)
+        W = self.get_knn_graph(x)
 
-        B = np.eye(n) - self.alpha * S
-        # logger.debug("B: %s" % str(list(B[0, 0:10])))
+        D = np.asarray(W.sum(axis=1)).reshape(-1)
+        # logger.debug(str(list(D[0:10])))
 
-        A = np.linalg.inv(B)
-        tdA = np.diag(np.sqrt(np.diag(A)) ** (-1))
-        A = tdA.dot(A.dot(tdA))
+        iDroot = sparse.diags(np.sqrt(D) ** (-1))
+
+        S = iDroot.dot(W).dot(iDroot)
+
+        self.B = sparse.csc_matrix(sparse.identity(n) - self.alpha * S)
+        self.lu_ = splu(self.B) if self.solver == "splu" else None
+        self.diag_ = None
+        return self
+
+    def _solve(self, rhs):
+        """ Returns X such that B X = rhs """
+        if self.lu_ is not None:
+            return self.lu_.solve(rhs)
+        X = np.zeros(rhs.shape, dtype=float)
+        tol = self.tol if self.tol > 0 else 1e-10
+        for j in range(rhs.shape[1]):
+            # B is symmetric positive definite since alpha < 1
+            X[:, j], info = cg(self.B, rhs[:, j], tol=tol, maxiter=self.max_iter)
+            if info > 0:
+                logger.debug("cg did not converge for column %d in %d iterations" % (j, info))
+        return X
+
+    def get_diffusion(self, indexes):
+        """ Returns the columns A[:, indexes] of the diffusion matrix A = (I - alpha*S)^-1 """
+        n = self.B.shape[0]
+        A = np.zeros((n, len(indexes)), dtype=float)
+        for start in range(0, len(indexes), self.block_size):
+            block = indexes[start:(start + self.block_size)]
+            rhs = np.zeros((n, len(block)), dtype=float)
+            rhs[block, np.arange(len(block))] = 1.
+            A[:, start:(start + len(block))] = self._solve(rhs)
+        return A
+
+    def get_diffusion_diagonal(self):
+        """ Returns the diagonal of A computed block-by-block """
+        if self.diag_ is None:
+            n = self.B.shape[0]
+            self.diag_ = np.zeros(n, dtype=float)
+            for start in range(0, n, self.block_size):
+                block = np.arange(start, min(start + self.block_size, n))
+                self.diag_[block] = self.get_diffusion(block)[block, np.arange(len(block))]
+        return self.diag_
+
+    def get_dissimilarities(self, indexes=None):
+        """ Returns the columns of 1 - A_norm where A_norm[i, j] = A[i, j] / sqrt(A[i, i] * A[j, j])
+
+        :param indexes: np.array(int)
+            Columns to return; all columns if None
+        :return: np.ndarray
+        """
+        if indexes is None:
+            indexes = np.arange(self.B.shape[0])
+            A = self.get_diffusion(indexes)
+            self.diag_ = np.array(np.diag(A))
+        else:
+            A = self.get_diffusion(indexes)
+        tdA = np.sqrt(self.get_diffusion_diagonal()) ** (-1)
+        A *= tdA.reshape(-1, 1)
+        A *= tdA[indexes].reshape(1, -1)
         # logger.debug("A: %s" % str(list(A[0, 0:10])))
 
         d = 1 - A
         # logger.debug("d: %s" % str(list(d[0, 0:10])))
+        return d
+
+    def fit_transform(self, x_in):
+        self.fit(x_in)
+        d = self.get_dissimilarities()
         # logger.debug("min(d): %f, max(d): %f" % (np.min(d), np.max(d)))
 
         mds = manifold.MDS(self.n_components,
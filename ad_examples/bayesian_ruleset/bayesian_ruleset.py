@@ -7,8 +7,10 @@ import numpy as np
 from numpy.random import random as np_random
 from random import sample
 
-from ..common.expressions import get_rule_satisfaction_matrix, get_feature_meta_default, \
-    convert_strings_to_conjunctive_rules, get_max_len_in_rules
+from ..common.expressions import get_feature_meta_default, \
+    convert_strings_to_conjunctive_rules, get_max_len_in_rules, \
+    RuleSatisfactionCache, unpack_rule_satisfaction_bitsets, \
+    pack_rule_satisfaction_matrix, count_rule_satisfaction_bitsets
 from ..common.utils import logger, get_command_args, configure_logger
 
 """
@@ -76,6 +78,103 @@ def find_lt(a, x):
         return 0
 
 
+class RuleCoverage(object):
+    """ Coverage of instances by a set of selected rules
+
+    The rule satisfaction matrix is stored as packed bit columns, i.e., one
+    row of bits per rule as in get_rule_satisfaction_bitsets(). As rules are added to or removed from the selected
+    set, the number of selected rules that each instance satisfies and the
+    confusion counts of the prediction 'satisfies at least one selected rule'
+    are updated in time proportional to the support of the changed rule.
+    Bitsets already computed for r_matrix (e.g., by RuleSatisfactionCache)
+    may be passed in so that r_matrix is not packed again.
+
+    Attributes:
+        n: int
+            number of instances
+        bitsets: np.ndarray(uint8)
+            matrix with one row per rule and ceil(n/8) columns
+        y: np.array
+        counts: np.array
+            number of selected rules that each instance satisfies
+        TP, FP, TN, FN: int
+            confusion counts of the selected rules
+    """
+    def __init__(self, r_matrix, y, rules=None, bitsets=None):
+        self.n = r_matrix.shape[0]
+        if bitsets is None:
+            bitsets = pack_rule_satisfaction_matrix(r_matrix)
+        self.bitsets = bitsets
+        self.y = np.asarray(y, dtype=np.int32)
+        self.pos_bits = np.packbits(self.y == 1)
+        self.supports = dict()
+        self.counts = np.zeros(self.n, dtype=np.int32)
+        n_pos = int(np.sum(self.y))
+        self.TP, self.FP, self.TN, self.FN = 0, 0, self.n - n_pos, n_pos
+        if rules is not None:
+            for rule in rules:
+                self.add_rule(rule)
+
+    def get_support(self, rule):
+        """ Returns the indexes of instances that satisfy the rule """
+        support = self.supports.get(rule)
+        if support is None:
+            support = np.where(np.unpackbits(self.bitsets[rule])[:self.n])[0]
+            self.supports[rule] = support
+        return support
+
+    def satisfies(self, i, rules=None):
+        """ Returns 0/1 for whether instance i satisfies each rule (all rules if None) """
+        if rules is None:
+            rules = slice(None)
+        return (self.bitsets[rules, i >> 3] >> (7 - (i & 7))) & 1
+
+    def _update_confusion(self, instances, sign):
+        n_pos = int(np.sum(self.y[instances]))
+        n_neg = len(instances) - n_pos
+        self.TP += sign * n_pos
+        self.FN -= sign * n_pos
+        self.FP += sign * n_neg
+        self.TN -= sign * n_neg
+
+    def add_rule(self, rule):
+        support = self.get_support(rule)
+        self._update_confusion(support[self.counts[support] == 0], 1)
+        self.counts[support] += 1
+
+    def remove_rule(self, rule):
+        support = self.get_support(rule)
+        self.counts[support] -= 1
+        self._update_confusion(support[self.counts[support] == 0], -1)
+
+    def get_confusion(self):
+        return self.TP, self.FP, self.TN, self.FN
+
+    def get_confusion_without(self, rule):
+        """ Returns the confusion counts if one instance of rule were removed from the selected rules """
+        support = self.get_support(rule)
+        lost = support[self.counts[support] == 1]
+        n_pos = int(np.sum(self.y[lost]))
+        n_neg = len(lost) - n_pos
+        return self.TP - n_pos, self.FP - n_neg, self.TN + n_neg, self.FN + n_pos
+
+    def get_yhat(self):
+        return np.asarray(self.counts > 0, dtype=np.int32)
+
+    def get_satisfied_counts(self, rules, uncovered_only=False):
+        """ Returns the number of positive and negative instances which satisfy each input rule
+
+        :param rules: list-like
+        :param uncovered_only: bool
+            If True, only the instances not covered by the selected rules are counted
+        """
+        bits = self.bitsets[rules]
+        if uncovered_only:
+            bits = bits & np.packbits(self.counts == 0)
+        pos = count_rule_satisfaction_bitsets(bits, self.pos_bits)
+        return pos, count_rule_satisfaction_bitsets(bits) - pos
+
+
 class BayesianRuleset(object):
     """ Implementation of Bayesian Rule Set mining By Tong Wang and Peter (Zhen) Li
 
@@ -120,6 +219,7 @@ class BayesianRuleset(object):
         self.rules = None
         self.rules_len = None
         self.supp = None
+        self.bitsets = None
 
         self.binary_input = False
         self.predicted_rules = []
@@ -170,10 +270,15 @@ class BayesianRuleset(object):
         # logger.debug("const_denominator: %s" % str(self.const_denominator))
         # logger.debug("P0: %s" % str(self.P0))
 
-    def compute_prob(self, r_matrix, y, rules):
-        yhat = self.check_satisfies_at_least_one_rule(r_matrix, rules)
-        self.yhat = yhat
-        TP, FP, TN, FN = get_confusion(yhat, y)
+    def compute_prob(self, r_matrix, y, rules, coverage=None):
+        """ Returns the confusion counts and the log-posterior terms of rules
+
+        :param coverage: RuleCoverage
+            If provided, the coverage of the instances by rules
+        """
+        if coverage is None:
+            coverage = RuleCoverage(r_matrix, y, rules)
+        TP, FP, TN, FN = coverage.get_confusion()
         # logger.debug("rules (%d): %s" % (len(rules), str(rules)))
         # logger.debug("rules_len: %s" % (str([self.rules_len[x] for x in rules])))
         Kn_count = list(np.bincount([self.rules_len[x] for x in rules], minlength=self.maxlen+1))
@@ -188,7 +293,7 @@ class BayesianRuleset(object):
         likelihood_2 = log_betabin(TN, FN+TN, self.alpha_2, self.beta_2)
         return [TP, FP, TN, FN], [prior_ChsRules, likelihood_1, likelihood_2]
 
-    def propose(self, rules_curr, y, r_matrix):
+    def propose(self, rules_curr, y, r_matrix, coverage=None):
         """ Propose a modification to the current set of rules
 
         :param rules_curr: np.array
@@ -196,20 +301,25 @@ class BayesianRuleset(object):
         :param y: np.array
         :param r_matrix: np.ndarray
             satisfaction matrix for all the rules in play
+        :param coverage: RuleCoverage
+            coverage of the instances by rules_curr; this is updated
+            along with rules_curr
         :return: np.array
             proposed set of rules
         """
 
+        if coverage is None:
+            coverage = RuleCoverage(r_matrix, y, rules_curr)
+
         # ex is an instance selected at random
         ex = None
 
-        yhat = self.check_satisfies_at_least_one_rule(r_matrix, rules_curr)
-        incorr = np.where(y != yhat)[0]
+        incorr = np.where(y != coverage.get_yhat())[0]
         rules_curr_len = len(rules_curr)
 
         move = ['clean']
         if len(incorr) > 0:
-            ex = sample(list(incorr), 1)[0]
+            ex = incorr[sample(range(len(incorr)), 1)[0]]
             t = np_random()
             if y[ex] == 1 or rules_curr_len == 1:
                 if t < 1.0 / 2 or rules_curr_len == 1:
@@ -227,23 +337,16 @@ class BayesianRuleset(object):
         if move[0] == 'cut':
             try:
                 if np_random() < self.propose_threshold:
-                    candidate = []
-                    for rule in rules_curr:
-                        if r_matrix[ex, rule]:
-                            candidate.append(rule)
+                    satisfied = coverage.satisfies(ex, rules_curr)
+                    candidate = [rule for rule, sat in zip(rules_curr, satisfied) if sat]
                     if len(candidate) == 0:
                         candidate = rules_curr
                     cut_rule = sample(candidate, 1)[0]
                 else:
                     p = []
-                    all_sum = np.zeros(r_matrix.shape[0], dtype=int)
-                    for rule in rules_curr:
-                        all_sum = all_sum + r_matrix[:, rule]
-
                     for ith_rule, rule in enumerate(rules_curr):
-                        yhat = (all_sum - r_matrix[:, rule]) > 0
-                        TP, FP, TN, FN = get_confusion(yhat, y)
-                        p.append(TP.astype(float) / (TP + FP + 1))
+                        TP, FP, TN, FN = coverage.get_confusion_without(rule)
+                        p.append(float(TP) / (TP + FP + 1))
                     p = [x - min(p) for x in p]
                     p = np.exp(p)
                     p = np.insert(p, 0, 0)
@@ -255,38 +358,39 @@ class BayesianRuleset(object):
                         index = find_lt(p, np_random())
                     cut_rule = rules_curr[index]
                 rules_curr.remove(cut_rule)
+                coverage.remove_rule(cut_rule)
                 move.remove('cut')
             except:
                 move.remove('cut')
 
         # 'add' a rule
         if len(move) > 0 and move[0] == 'add':
+            satisfied = coverage.satisfies(ex)
             if y[ex] == 1:
-                select = np.where((self.supp > self.C[-1]) & ~r_matrix[ex] > 0)[0]
+                select = np.where((self.supp > self.C[-1]) & (satisfied == 0))[0]
             else:
-                select = np.where((self.supp > self.C[-1]) & r_matrix[ex] > 0)[0]
+                select = np.where((self.supp > self.C[-1]) & (satisfied > 0))[0]
             if len(select) > 0:
                 if np_random() < self.propose_threshold:
                     add_rule = sample(select.tolist(), 1)[0]
                 else:
-                    Yhat_neg_index = np.where(~self.check_satisfies_at_least_one_rule(r_matrix, rules_curr))[0]
-                    # In case Yhat_neg_index is []
-                    if Yhat_neg_index.shape[0] == 0:
+                    # In case no instance is predicted negative
+                    if coverage.TN + coverage.FN == 0:
                         return rules_curr
-                    mat = r_matrix[Yhat_neg_index.reshape(-1, 1), select].transpose() & y[Yhat_neg_index].astype(int)
-                    TP = np.sum(mat, axis=1)
-                    FP = np.array(np.sum(r_matrix[Yhat_neg_index.reshape(-1, 1), select], axis=0) - TP)
+                    # confusion counts among the instances predicted negative
+                    TP, FP = coverage.get_satisfied_counts(select, uncovered_only=True)
                     p = (TP.astype(float) / (TP + FP + 1))
                     add_rule = select[sample(list(np.where(p == max(p))[0]), 1)[0]]
                 try:
                     if add_rule not in rules_curr:
                         rules_curr.append(add_rule)
+                        coverage.add_rule(add_rule)
                 except:
                     pass
 
         return rules_curr
 
-    def bayesian_pattern_based(self, y, r_matrix, init_rules):
+    def bayesian_pattern_based(self, y, r_matrix, init_rules, bitsets=None):
 
         # |A| : min((rule_space)/2,(rule_space+beta_l-alpha_l)/2)
         self.Asize = [[min(self.pattern_space[l] / 2,
@@ -299,6 +403,8 @@ class BayesianRuleset(object):
         T0 = 1000
 
         rules_curr = init_rules
+        # propose() modifies rules_curr in place; the coverage is updated along with it
+        coverage = RuleCoverage(r_matrix, y, rules_curr, bitsets=bitsets)
         pt_curr = -1000000000
         # now only consider 1 chain
         # it should have been maps[chain]
@@ -307,8 +413,8 @@ class BayesianRuleset(object):
                              []])
         alpha = np.inf
         for ith_iter in range(self.max_iter):
-            rules_new = self.propose(rules_curr, y, r_matrix)
-            cfmatrix, prob = self.compute_prob(r_matrix, y, rules_new)
+            rules_new = self.propose(rules_curr, y, r_matrix, coverage=coverage)
+            cfmatrix, prob = self.compute_prob(r_matrix, y, rules_new, coverage=coverage)
             T = T0 ** (1 - ith_iter / self.max_iter)
             pt_new = sum(prob)
             # logger.debug("pt_new: %f, pt_curr: %f, T: %f, float(pt_new - pt_curr): %f" %
@@ -348,14 +454,21 @@ class BayesianRuleset(object):
 
         return self.maps[0]
 
-    def screen_rules(self, x, y):
-        r_matrix = get_rule_satisfaction_matrix(x, y, self.rules)
-        # logger.debug(r_matrix.shape)
+    def screen_rules(self, x, y, cache=None):
+        """ Retains only the rules which cover enough positive instances
 
-        r_matrix_pos = r_matrix[np.where(y == 1)[0]]
-        # logger.debug(r_matrix_pos.shape)
+        :param x: np.ndarray
+        :param y: np.array
+        :param cache: RuleSatisfactionCache
+            If provided, must have been created for (x, y)
+        :return: np.ndarray
+            satisfaction matrix for the retained rules
+        """
+        if cache is None:
+            cache = RuleSatisfactionCache(x, y)
+        bitsets = cache.get_satisfaction_bitsets(self.rules)
 
-        TP = np.asarray(np.sum(r_matrix_pos, axis=0))
+        TP = count_rule_satisfaction_bitsets(bitsets, np.packbits(y == 1))
         # logger.debug(TP)
 
         # supp is threshold percentile of how TP a rule is
@@ -363,14 +476,13 @@ class BayesianRuleset(object):
         # logger.debug(supp_select)
 
         self.rules = [self.rules[ridx] for ridx in supp_select]
-        sub_r_matrix = r_matrix[:, supp_select]
-        # logger.debug(sub_r_matrix.shape)
+        self.bitsets = bitsets[supp_select]
 
         self.rules_len = [len(rule) for rule in self.rules]
-        self.supp = np.sum(sub_r_matrix, axis=0)
+        self.supp = count_rule_satisfaction_bitsets(self.bitsets)
         # logger.debug("rules_len: %s" % str(self.rules_len))
         # logger.debug("supp: %s" % str(self.supp))
-        return sub_r_matrix
+        return unpack_rule_satisfaction_bitsets(self.bitsets, x.shape[0])
 
     def greedy_init(self, r_matrix):
         """ Selects an initial set of rules greedily such that they cover most instances """
@@ -413,24 +525,26 @@ class BayesianRuleset(object):
         ret[np.where(count_sats > 0)[0]] = 1
         return ret
 
-    def fit(self, x, y, rules):
+    def fit(self, x, y, rules, cache=None):
         """ Fit model with training data
 
         :param x: np.ndarray
         :param y: np.array
         :param rules: list
             list of ConjunctiveRule
+        :param cache: RuleSatisfactionCache
+            If provided, must have been created for (x, y)
         :return: None
         """
         self.set_parameters(x)
         self.precompute(y)
         self.rules = rules
-        r_matrix = self.screen_rules(x, y)
+        r_matrix = self.screen_rules(x, y, cache=cache)
         if self.greedy_initialization:
             init = self.greedy_init(r_matrix)
         else:
             init = []
-        self.bayesian_pattern_based(y, r_matrix, init)
+        self.bayesian_pattern_based(y, r_matrix, init, bitsets=self.bitsets)
 
 
 def sanity_check_bayesian_ruleset(x, y, rules, meta):
@@ -221,6 +221,14 @@ class Expression(object):
         """
         pass
 
+    def evaluate_batch(self, insts, lbls, meta):
+        """Evaluates the expression for all rows of insts at once.
+
+        Returns a np.array with one value per row. The result is the
+        same as calling evaluate() on each row separately.
+        """
+        raise NotImplementedError("evaluate_batch() not implemented.")
+
     def compile(self, meta):
         """Resolves the variable and literal bindings such that
         the expression can be evaluated efficiently later.
@@ -295,6 +303,10 @@ class Literal(Term):
         # print(str(self) + ': ' + str(ret))
         return ret
 
+    def evaluate_batch(self, insts, lbls, meta):
+        # a scalar broadcasts against the columns it is compared with
+        return self.evaluate(None, None, meta)
+
     def ground(self, inst, lbl, meta):
         return repr(self.val)
 
@@ -352,6 +364,18 @@ class Var(Term):
         # print(str(self) + ': ' + str(ret))
         return None if self.vartype == DTYPE_CATEGORICAL and ret < 0 else ret
 
+    def evaluate_batch(self, insts, lbls, meta):
+        ret = None
+        if self.varindex == LABEL_VAR_INDEX:
+            ret = None if lbls is None else np.asarray(lbls)
+        elif self.vartype == DTYPE_CATEGORICAL and self.varindex >= 0:
+            ret = np.asarray(insts[:, self.varindex]).astype(int)
+        elif self.vartype == DTYPE_CONTINUOUS and self.varindex >= 0:
+            ret = insts[:, self.varindex]
+        if ret is None or (self.vartype == DTYPE_CATEGORICAL and np.any(ret < 0)):
+            raise ValueError('variable value for %s unbound' % str(self))
+        return ret
+
     def compile(self, meta):
         self.varindex = UNINITIALIZED_VAR_INDEX  # set to uninitialized first
         # print('Compiling Var ' + str(self.name))
@@ -464,6 +488,12 @@ class Cmp(BinaryPredicate):
                              % (str(self), str(inst)))
         return ret
 
+    def evaluate_batch(self, insts, lbls, meta):
+        e1 = self.p1.evaluate_batch(insts, lbls, meta)
+        e2 = self.p2.evaluate_batch(insts, lbls, meta)
+        ret = self.evaluateCmp(e1, e2)
+        return np.broadcast_to(ret, (insts.shape[0],)).astype(bool)
+
     def evaluateCmp(self, e1, e2):
         raise NotImplementedError('Comparison operator not implemented.')
 
@@ -591,6 +621,21 @@ class CmpGE(Cmp):
         return "CmpGE(" + str(self.p1) + ", " + str(self.p2) + ")" + self.get_str_weight()
 
 
+def evaluate_batch_where(predicate, mask, default, insts, lbls, meta):
+    """Evaluates predicate only for the rows where mask is True
+
+    The other rows retain their values from default.
+    Used to short-circuit And/Or over a batch of instances.
+    """
+    if np.all(mask):
+        return predicate.evaluate_batch(insts, lbls, meta)
+    ret = np.array(default, dtype=bool)
+    idxs = np.where(mask)[0]
+    if len(idxs) > 0:
+        ret[idxs] = predicate.evaluate_batch(insts[idxs], None if lbls is None else np.asarray(lbls)[idxs], meta)
+    return ret
+
+
 class Or(BinaryPredicate):
     def __init__(self, p1, p2, weight=DEFAULT_PREDICATE_WEIGHT):
         BinaryPredicate.__init__(self, p1=p1, p2=p2, weight=weight)
@@ -608,6 +653,11 @@ class Or(BinaryPredicate):
             raise ValueError('predicate value unbound for e2')
         return ret
 
+    def evaluate_batch(self, insts, lbls, meta):
+        # like evaluate(), e2 is evaluated only where e1 is False
+        e1 = self.p1.evaluate_batch(insts, lbls, meta)
+        return evaluate_batch_where(self.p2, ~e1, e1, insts, lbls, meta)
+
     def ground(self, inst, lbl, meta):
         return "(" + self.p1.ground(inst, lbl, meta) + " | " + self.p2.ground(inst, lbl, meta) + ")"
 
@@ -635,6 +685,11 @@ class And(BinaryPredicate):
             raise ValueError('predicate value unbound for e2')
         return ret
 
+    def evaluate_batch(self, insts, lbls, meta):
+        # like evaluate(), e2 is evaluated only where e1 is True
+        e1 = self.p1.evaluate_batch(insts, lbls, meta)
+        return evaluate_batch_where(self.p2, e1, e1, insts, lbls, meta)
+
     def ground(self, inst, lbl, meta):
         return "(" + self.p1.ground(inst, lbl, meta) + " & " + self.p2.ground(inst, lbl, meta) + ")"
 
@@ -657,6 +712,9 @@ class Not(UnaryPredicate):
             raise ValueError('predicate value unbound')
         return ret
 
+    def evaluate_batch(self, insts, lbls, meta):
+        return ~self.p.evaluate_batch(insts, lbls, meta)
+
     def ground(self, inst, lbl, meta):
         return "~(" + self.p.ground(inst, lbl, meta) + ")"
 
@@ -936,6 +994,22 @@ class ConjunctiveRule(object):
             i += 1
         return result
 
+    def get_satisfied_mask(self, insts, labels=None):
+        """ Returns a boolean array which is True for the insts that satisfy the rule
+
+        All rows are evaluated together one predicate at a time. Each
+        predicate is evaluated only on the rows which satisfied all the
+        previous predicates.
+
+        :param insts: np.ndarray
+        :param labels: np.array
+        :return: np.array(bool)
+        """
+        mask = np.ones(insts.shape[0], dtype=bool)
+        for predicate in self.predicates:
+            mask = evaluate_batch_where(predicate, mask, mask, insts, labels, self.meta)
+        return mask
+
     def where_satisfied(self, insts, labels=None):
         """ Returns all indexes of insts which satisfy the rule
 
@@ -943,11 +1017,7 @@ class ConjunctiveRule(object):
         :param labels: np.array
         :return: np.array
         """
-        satisfied = []
-        for i in range(insts.shape[0]):
-            if self.evaluate_inst(insts[i, :], None if labels is None else labels[i]):
-                satisfied.append(i)
-        return np.array(satisfied, dtype=np.int32)
+        return np.asarray(np.where(self.get_satisfied_mask(insts, labels))[0], dtype=np.int32)
 
     def _str_confusion_mat(self):
         if self.confusion_matrix is None:
@@ -1055,18 +1125,95 @@ def get_rule_satisfaction_matrix(x, y, rules):
     :param x: np.ndarray
     :param y: np.array
     :param rules: list
-    :param opts: AadOpts
     :return: np.ndarray
         matrix with x.shape[0] rows and len(rules) rows
     """
     satisfaction_matrix = np.zeros((x.shape[0], len(rules)), dtype=np.int32)
     for i, rule in enumerate(rules):
-        idxs = rule.where_satisfied(x, y)
-        satisfaction_matrix[idxs, i] = 1
+        satisfaction_matrix[:, i] = rule.get_satisfied_mask(x, y)
     return satisfaction_matrix
 
 
-def check_if_at_least_one_rule_satisfied(x, y, rules):
+def get_rule_satisfaction_bitsets(x, y, rules):
+    """ Returns the rule satisfaction matrix with instances packed as bits
+
+    :return: np.ndarray(uint8)
+        matrix with len(rules) rows and ceil(x.shape[0]/8) columns. Row i has
+        the packed bits of the instances that satisfy rules[i].
+    """
+    bitsets = np.zeros((len(rules), (x.shape[0] + 7) // 8), dtype=np.uint8)
+    for i, rule in enumerate(rules):
+        bitsets[i] = np.packbits(rule.get_satisfied_mask(x, y))
+    return bitsets
+
+
+def unpack_rule_satisfaction_bitsets(bitsets, n):
+    """ Converts bitsets from get_rule_satisfaction_bitsets() to the (n x #rules) 0/1 matrix """
+    return np.asarray(np.unpackbits(bitsets, axis=1)[:, 0:n].T, dtype=np.int32)
+
+
+def pack_rule_satisfaction_matrix(r_matrix):
+    """ Converts a (n x #rules) 0/1 matrix to bitsets as in get_rule_satisfaction_bitsets() """
+    return np.packbits(np.transpose(r_matrix) != 0, axis=1)
+
+
+# number of set bits in each byte value
+_popcount = np.array([bin(i).count("1") for i in range(256)], dtype=np.int32)
+
+
+def count_rule_satisfaction_bitsets(bitsets, mask=None):
+    """ Returns the number of instances that satisfy each rule
+
+    :param bitsets: np.ndarray(uint8)
+        bitsets as returned by get_rule_satisfaction_bitsets()
+    :param mask: np.array(uint8)
+        packed bits of a subset of instances. If provided, only
+        the instances in this subset are counted.
+    :return: np.array
+    """
+    if mask is not None:
+        bitsets = bitsets & mask
+    return np.sum(_popcount[bitsets], axis=1)
+
+
+class RuleSatisfactionCache(object):
+    """ Caches which instances of a fixed dataset satisfy which rules
+
+    Rules are identified by their string representation. Hence the same
+    rule parsed again (e.g., from a new set of candidate regions) is not
+    evaluated again.
+
+    Attributes:
+        x: np.ndarray
+        y: np.array
+        bitsets: dict
+            Maps str(rule) to the packed bits of the instances that satisfy the rule
+    """
+    def __init__(self, x, y=None):
+        self.x = x
+        self.y = y
+        self.bitsets = dict()
+
+    def get_satisfaction_bitsets(self, rules):
+        keys = [str(rule) for rule in rules]
+        new_rules = dict()
+        for key, rule in zip(keys, rules):
+            if key not in self.bitsets and key not in new_rules:
+                new_rules[key] = rule
+        if len(new_rules) > 0:
+            new_keys = list(new_rules.keys())
+            new_bitsets = get_rule_satisfaction_bitsets(self.x, self.y, [new_rules[key] for key in new_keys])
+            for key, bits in zip(new_keys, new_bitsets):
+                self.bitsets[key] = bits
+        if len(keys) == 0:
+            return np.zeros((0, (self.x.shape[0] + 7) // 8), dtype=np.uint8)
+        return np.vstack([self.bitsets[key] for key in keys])
+
+    def get_satisfaction_matrix(self, rules):
+        return unpack_rule_satisfaction_bitsets(self.get_satisfaction_bitsets(rules), self.x.shape[0])
+
+
+def check_if_at_least_one_rule_satisfied(x, y, rules, cache=None):
     """ For each input instance, check if it satisfies at least one rule
 
     Basically performs a disjunction of rules.
@@ -1076,19 +1223,34 @@ def check_if_at_least_one_rule_satisfied(x, y, rules):
     :param y: np.array
         This could be None if unsupervised and if it is not required to evaluate any rule
     :param rules: list of rules
+    :param cache: RuleSatisfactionCache
+        If provided, must have been created for (x, y). The rules
+        already evaluated by the cache are not evaluated again.
     :return: np.array
         Binary indicator for each instance
     """
-    sat_vec = np.zeros(x.shape[0], dtype=np.int32)
+    if cache is not None:
+        if len(rules) == 0:
+            return np.zeros(x.shape[0], dtype=np.int32)
+        bits = np.bitwise_or.reduce(cache.get_satisfaction_bitsets(rules), axis=0)
+        return np.asarray(np.unpackbits(bits)[0:x.shape[0]], dtype=np.int32)
+    sat_vec = np.zeros(x.shape[0], dtype=bool)
     for rule in rules:
-        idxs = rule.where_satisfied(x, y)
-        sat_vec[idxs] += 1
-    return np.minimum(sat_vec, 1)
+        # only the instances not yet covered by any rule need to be checked
+        idxs = np.where(~sat_vec)[0]
+        if len(idxs) == 0:
+            break
+        sat_vec[idxs] = rule.get_satisfied_mask(x[idxs], None if y is None else y[idxs])
+    return np.asarray(sat_vec, dtype=np.int32)
 
 
-def evaluate_ruleset(x, y, rules, average="binary"):
-    """ For each input instance, check if it satisfies at least one rule and computes F1 """
-    y_hat = check_if_at_least_one_rule_satisfied(x, y, rules)
+def evaluate_ruleset(x, y, rules, average="binary", cache=None):
+    """ For each input instance, check if it satisfies at least one rule and computes F1
+
+    :param cache: RuleSatisfactionCache
+        If provided, must have been created for (x, y)
+    """
+    y_hat = check_if_at_least_one_rule_satisfied(x, y, rules, cache=cache)
     precision, recall, f1, _ = precision_recall_fscore_support(y_true=y, y_pred=y_hat, average=average)
     return precision, recall, f1
 
@@ -1140,12 +1302,8 @@ def get_feature_meta_default(x, y, feature_names=None,
 
 
 def evaluate_instances_for_predicate(predicate, insts, labels, meta):
-    satisfied = []
-    for i in range(insts.shape[0]):
-        lbl = labels[i] if labels is not None else None
-        if predicate.evaluate(insts[i, :], lbl, meta):
-            satisfied.append(i)
-    return np.array(satisfied, dtype=np.int32)
+    satisfied = predicate.evaluate_batch(insts, labels, meta)
+    return np.asarray(np.where(satisfied)[0], dtype=np.int32)
 
 
 def test_rule_apis():
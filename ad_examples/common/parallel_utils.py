@@ -0,0 +1,212 @@
+import os
+import atexit
+import pickle
+import weakref
+import tempfile
+import logging
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+
+__all__ = ["get_shared_dir", "get_n_jobs", "get_row_blocks", "register_cleanup",
+           "SharedArray", "SharedObject", "WorkerPool"]
+
+
+"""
+Support for process pools which are reused across calls. Large inputs and
+outputs are exchanged with the worker processes through memory-mapped
+files (in /dev/shm when available) instead of pickling the arrays with
+every task.
+
+The files and processes are released by close(). In case close() is
+never called, they are released when their owner is garbage collected
+or, at the latest, when the interpreter exits.
+"""
+
+
+logger = logging.getLogger(__name__)
+
+# Objects published with SharedObject are loaded at most once per worker
+# process and retained here. Only the most recent few are kept.
+_worker_objects = OrderedDict()
+_max_worker_objects = 4
+
+
+def get_shared_dir():
+    """Returns the directory for memory-mapped files; prefers RAM-backed /dev/shm"""
+    shm = "/dev/shm"
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        return shm
+    return tempfile.gettempdir()
+
+
+def get_n_jobs(n_jobs):
+    """Returns the actual number of processes; n_jobs < 0 implies (cpu_count + 1 + n_jobs)"""
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max(1, cpu_count() + 1 + n_jobs)
+    return n_jobs
+
+
+def _remove_shared_file(filename, pid):
+    """Deletes the file, but only in the process which created it"""
+    if os.getpid() == pid and os.path.exists(filename):
+        os.remove(filename)
+
+
+def _shutdown_pool(pool):
+    pool.close()
+    pool.join()
+
+
+def register_cleanup(obj, func, *args):
+    """Calls func(*args) when obj is garbage collected or at exit, whichever is first
+
+    :return: callable
+        Runs the cleanup now; later calls (and the automatic one) do nothing.
+    """
+    if hasattr(weakref, "finalize"):
+        return weakref.finalize(obj, func, *args)
+    # python 2 has no weakref.finalize; the cleanup is deferred to exit
+    done = []
+
+    def cleanup():
+        if len(done) == 0:
+            done.append(True)
+            func(*args)
+    atexit.register(cleanup)
+    return cleanup
+
+
+def get_row_blocks(n, n_jobs, min_rows=1000, max_rows=10000):
+    """Partitions n rows into contiguous (start, end) blocks for n_jobs workers"""
+    rows = int(np.ceil(n * 1. / max(1, n_jobs)))
+    rows = max(min_rows, min(max_rows, rows))
+    return [(start, min(start + rows, n)) for start in range(0, n, rows)]
+
+
+class SharedArray(object):
+    """A numpy array backed by a memory-mapped file
+
+    Only the file name, shape and dtype are pickled when a SharedArray is
+    passed to a worker process. The worker maps the same file and therefore
+    reads and writes the same memory as the process that created it.
+
+    Attributes:
+        filename: str
+        shape: tuple
+        dtype: numpy dtype
+    """
+    def __init__(self, shape, dtype=float):
+        fd, self.filename = tempfile.mkstemp(prefix="ad_shared_", suffix=".dat", dir=get_shared_dir())
+        os.close(fd)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._owner = True
+        self._cleanup = register_cleanup(self, _remove_shared_file, self.filename, os.getpid())
+        self._array = None
+        if np.prod(self.shape) > 0:
+            self._array = np.memmap(self.filename, dtype=self.dtype, mode="w+", shape=self.shape)
+
+    @staticmethod
+    def from_array(a):
+        a = np.asarray(a)
+        shared = SharedArray(a.shape, dtype=a.dtype)
+        if shared._array is not None:
+            shared._array[:] = a
+        return shared
+
+    @property
+    def array(self):
+        if self._array is None:
+            if np.prod(self.shape) == 0:
+                return np.zeros(self.shape, dtype=self.dtype)
+            self._array = np.memmap(self.filename, dtype=self.dtype, mode="r+", shape=self.shape)
+        return self._array
+
+    def close(self):
+        """Releases the mapping; the file is deleted by the process which created it"""
+        self._array = None
+        if self._owner:
+            self._cleanup()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_owner"] = False
+        state["_cleanup"] = None
+        state["_array"] = None
+        return state
+
+
+class SharedObject(object):
+    """An object pickled once to a file and loaded lazily by the workers
+
+    Every worker process loads the object the first time it is needed and
+    reuses the loaded copy for all later tasks. Hence, large read-only
+    objects such as trees stay resident in the workers between calls.
+    """
+    def __init__(self, obj):
+        fd, self.filename = tempfile.mkstemp(prefix="ad_shared_", suffix=".pkl", dir=get_shared_dir())
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.obj = obj
+        self._owner = True
+        self._cleanup = register_cleanup(self, _remove_shared_file, self.filename, os.getpid())
+
+    def get(self):
+        if self.obj is not None:
+            return self.obj
+        obj = _worker_objects.get(self.filename)
+        if obj is None:
+            with open(self.filename, "rb") as f:
+                obj = pickle.load(f)
+            _worker_objects[self.filename] = obj
+            while len(_worker_objects) > _max_worker_objects:
+                _worker_objects.popitem(last=False)
+        return obj
+
+    def close(self):
+        self.obj = None
+        if self._owner:
+            self._cleanup()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_owner"] = False
+        state["_cleanup"] = None
+        state["obj"] = None
+        return state
+
+
+class WorkerPool(object):
+    """A multiprocessing.Pool which is started on first use and then reused
+
+    The pool is not pickled along with its owner; a copy restarts its own
+    pool when it is used next. After close(), the next map() restarts the
+    pool as well.
+    """
+    def __init__(self, n_jobs=1):
+        self.n_jobs = get_n_jobs(n_jobs)
+        self._pool = None
+        self._cleanup = None
+
+    def map(self, func, tasks):
+        if self._pool is None:
+            self._pool = Pool(self.n_jobs)
+            self._cleanup = register_cleanup(self, _shutdown_pool, self._pool)
+        return self._pool.map(func, tasks)
+
+    def close(self):
+        if self._pool is not None:
+            self._cleanup()
+            self._pool = None
+            self._cleanup = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        state["_cleanup"] = None
+        return state
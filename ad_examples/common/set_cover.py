@@ -0,0 +1,161 @@
+import logging
+import numpy as np
+
+
+__all__ = ["SET_COVER_GREEDY", "SET_COVER_LP", "SET_COVER_ILP", "set_cover_solvers",
+           "set_cover_greedy", "set_cover_lp", "set_cover_ilp", "solve_set_cover"]
+
+
+"""
+Solvers for the weighted set-cover problem:
+
+    minimize    sum_j costs[j] * z[j]
+    subject to  sum_j memberships[i, j] * z[j] >= 1  for every element i
+                z[j] in {0, 1}
+
+where memberships is a binary (elements x sets) matrix. The exact ILP can
+be expensive for large problems; the greedy and LP-rounding solvers are
+polynomial time approximations.
+"""
+
+
+logger = logging.getLogger(__name__)
+
+SET_COVER_GREEDY = "greedy"
+SET_COVER_LP = "lp"
+SET_COVER_ILP = "ilp"
+set_cover_solvers = [SET_COVER_GREEDY, SET_COVER_LP, SET_COVER_ILP]
+
+
+def _remove_redundant_sets(costs, memberships, selected):
+    """ Drops selected sets (costliest first) whose elements are all covered by other selected sets """
+    cover_counts = np.sum(memberships[:, selected], axis=1)
+    for j in selected[np.argsort(-costs[selected], kind="mergesort")]:
+        members = memberships[:, j]
+        if np.all(cover_counts[members] >= 2):
+            cover_counts[members] -= 1
+            selected = selected[selected != j]
+    return np.sort(selected)
+
+
+def set_cover_greedy(costs, memberships):
+    """ Weighted greedy set cover
+
+    Repeatedly selects the set with the least cost per newly covered
+    element. The total cost is within a factor H(k) = 1 + 1/2 + ... + 1/k
+    of the optimal, where k is the size of the largest set.
+
+    :param costs: np.array(float)
+    :param memberships: np.ndarray
+        binary (elements x sets) matrix
+    :return: np.array(int)
+        sorted indexes of the selected sets; None if some element is in no set
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    memberships = np.asarray(memberships) != 0
+    uncovered = np.ones(memberships.shape[0], dtype=bool)
+    selected = list()
+    while np.any(uncovered):
+        n_new = np.sum(memberships[uncovered], axis=0)
+        if np.max(n_new) == 0:
+            return None
+        ratios = np.full(len(costs), np.inf)
+        ratios[n_new > 0] = costs[n_new > 0] / n_new[n_new > 0]
+        j = int(np.argmin(ratios))
+        selected.append(j)
+        uncovered = np.logical_and(uncovered, ~memberships[:, j])
+    return _remove_redundant_sets(costs, memberships, np.array(selected, dtype=int))
+
+
+def set_cover_lp(costs, memberships):
+    """ LP relaxation followed by deterministic rounding
+
+    The relaxation (z >= 0) is solved with GLPK. Every set with
+    z[j] >= 1/f is selected, where f is the largest number of sets that
+    any element belongs to. This is a cover whose cost is within a factor
+    f of the optimal.
+
+    :return: np.array(int)
+        sorted indexes of the selected sets; None if the LP was not solved
+    """
+    import cvxopt
+    from cvxopt import glpk
+
+    costs = np.asarray(costs, dtype=np.float64)
+    memberships = np.asarray(memberships) != 0
+    n, m = memberships.shape
+    glpk.options['msg_lev'] = 'GLP_MSG_OFF'
+
+    # the constraints z <= 1 are left out since they are never active
+    # at the optimum when the costs are non-negative
+    rows, cols = np.nonzero(memberships)
+    G = cvxopt.spmatrix(np.append(-np.ones(len(rows)), -np.ones(m)).tolist(),
+                        np.append(rows, n + np.arange(m)).tolist(),
+                        np.append(cols, np.arange(m)).tolist(), size=(n + m, m), tc='d')
+    h = cvxopt.matrix(np.append(-np.ones(n), np.zeros(m)), tc='d')
+    status, soln, _ = glpk.lp(cvxopt.matrix(costs, tc='d'), G, h)
+    if soln is None:
+        logger.debug("LP set cover status: %s" % status)
+        return None
+    soln = np.reshape(np.array(soln), newshape=(m,))
+    f = np.max(np.sum(memberships, axis=1))
+    selected = np.where(soln >= (1. / f) - 1e-9)[0]
+    return _remove_redundant_sets(costs, memberships, selected)
+
+
+def set_cover_ilp(costs, memberships, time_limit=None):
+    """ Exact set cover with the GLPK integer solver
+
+    :param time_limit: float
+        maximum number of seconds for the solver; None for no limit
+    :return: np.array(int)
+        sorted indexes of the selected sets; None if no solution was found
+    """
+    import cvxopt
+    from cvxopt import glpk
+
+    memberships = np.asarray(memberships)
+    nvars = memberships.shape[1]
+    glpk.options['msg_lev'] = 'GLP_MSG_OFF'
+
+    c = cvxopt.matrix([float(v) for v in costs], tc='d')
+    G = cvxopt.matrix(-memberships, tc='d')
+    h = cvxopt.matrix([-1] * memberships.shape[0], tc='d')
+
+    bin_vars = [i for i in range(nvars)]
+    if time_limit is not None and time_limit > 0:
+        glpk.options['tm_lim'] = int(time_limit * 1000)  # milliseconds
+    try:
+        (status, soln) = glpk.ilp(c, G, h, B=set(bin_vars))
+    finally:
+        glpk.options.pop('tm_lim', None)
+    # logger.debug("ILP status: %s" % status)
+    if soln is None:
+        return None
+    soln = np.reshape(np.array(soln), newshape=(nvars,))
+    selected = np.where(soln == 1)[0]
+    if status != "optimal" and not np.all(np.sum(memberships[:, selected], axis=1) > 0):
+        # solver stopped (e.g., at the time limit) without a feasible solution
+        logger.debug("ILP set cover status: %s" % status)
+        return None
+    return selected
+
+
+def solve_set_cover(costs, memberships, solver=SET_COVER_ILP, time_limit=None):
+    """ Returns the sorted indexes of the sets selected by the solver
+
+    If the LP or the ILP (within time_limit seconds) find no solution,
+    the greedy solution is returned.
+    """
+    if solver == SET_COVER_GREEDY:
+        return set_cover_greedy(costs, memberships)
+    elif solver == SET_COVER_LP:
+        selected = set_cover_lp(costs, memberships)
+    elif solver == SET_COVER_ILP:
+        selected = set_cover_ilp(costs, memberships, time_limit=time_limit)
+    else:
+        raise ValueError("Invalid set cover solver: %s" % str(solver))
+    if selected is None:
+        logger.debug("%s set cover found no solution; using greedy" % solver)
+        selected = set_cover_greedy(costs, memberships)
+    return selected
@@ -16,6 +16,32 @@ def get_sgd_batch(x, y, i, batch_size, shuffled_idxs=None):
     return matrix(x[idxs, :], ncol=x.shape[1]), y[idxs]
 
 
+def get_fixed_sgd_batch(x, y, batch_size):
+    """Returns the only batch if all instances fit in one batch, else None
+
+    The same batch is then reused in every epoch instead of being copied again.
+    """
+    if get_num_batches(x.shape[0], batch_size) == 1:
+        return get_sgd_batch(x, y, 0, batch_size)
+    return None
+
+
+def get_sgd_loss(w, xi, yi, f, f_grad=None, reuse_grad=False):
+    """Returns the loss at w and the gradient at w if it can be reused
+
+    :param f_grad: function(w, x, y)
+        optional fused function which returns both the loss and the gradient
+        while evaluating the scores x.dot(w) only once
+    :param reuse_grad: boolean
+        True if the next sgd step will use the same batch (xi, yi) at w
+    :return: float, numpy.array
+        loss, and gradient (None if it cannot be reused)
+    """
+    if f_grad is None or not reuse_grad:
+        return f(w, xi, yi), None
+    return f_grad(w, xi, yi)
+
+
 def avg_loss_check(losses, epoch, n=20, eps=1e-6):
     if epoch < n + 1:
         return False
@@ -44,7 +70,7 @@ def debug_log_sgd_losses(sgd_type, losses, epoch, n=20, timer=None):
 
 
 def sgd(w0, x, y, f, grad, learning_rate=0.01,
-        batch_size=100, max_epochs=1000, eps=1e-6, shuffle=False, rng=None):
+        batch_size=100, max_epochs=1000, eps=1e-6, shuffle=False, rng=None, f_grad=None):
     tm = Timer()
     n = x.shape[0]
     n_batches = get_num_batches(n, batch_size)
@@ -63,15 +89,20 @@ def sgd(w0, x, y, f, grad, learning_rate=0.01,
             rng.shuffle(shuffled_idxs)
     else:
         shuffled_idxs = None
+    fixed_batch = get_fixed_sgd_batch(x, y, batch_size)
+    g_next = None  # gradient at current w for the next batch, if already known
     while epoch < max_epochs:
         losses = np.zeros(n_batches, dtype=float)
         for i in range(n_batches):
-            xi, yi = get_sgd_batch(x, y, i, batch_size, shuffled_idxs=shuffled_idxs)
+            if fixed_batch is not None:
+                xi, yi = fixed_batch
+            else:
+                xi, yi = get_sgd_batch(x, y, i, batch_size, shuffled_idxs=shuffled_idxs)
             if xi.shape[0] == 0:
                 raise ValueError("Batch size of 0")
-            g = grad(w, xi, yi)
+            g = grad(w, xi, yi) if g_next is None else g_next
             w -= learning_rate * g
-            losses[i] = f(w, xi, yi)
+            losses[i], g_next = get_sgd_loss(w, xi, yi, f, f_grad, reuse_grad=fixed_batch is not None)
             if False:
                 g_norm = g.dot(g)
                 if np.isnan(g_norm) or np.isinf(g_norm):
@@ -101,7 +132,7 @@ def sgd(w0, x, y, f, grad, learning_rate=0.01,
 
 def sgdRMSProp(w0, x, y, f, grad, learning_rate=0.01,
                batch_size=100, max_epochs=1000, delta=1e-6, ro=0.9, eps=1e-6,
-               shuffle=False, rng=None):
+               shuffle=False, rng=None, f_grad=None, avg_loss_window=20):
     tm = Timer()
     n = x.shape[0]
     n_batches = get_num_batches(n, batch_size)
@@ -123,16 +154,21 @@ def sgdRMSProp(w0, x, y, f, grad, learning_rate=0.01,
     else:
         shuffled_idxs = None
     prev_loss = np.inf
+    fixed_batch = get_fixed_sgd_batch(x, y, batch_size)
+    g_next = None  # gradient at current w for the next batch, if already known
     while epoch < max_epochs:
         losses = np.zeros(n_batches, dtype=float)
         for i in range(n_batches):
-            xi, yi = get_sgd_batch(x, y, i, batch_size, shuffled_idxs=shuffled_idxs)
-            g = grad(w, xi, yi)
+            if fixed_batch is not None:
+                xi, yi = fixed_batch
+            else:
+                xi, yi = get_sgd_batch(x, y, i, batch_size, shuffled_idxs=shuffled_idxs)
+            g = grad(w, xi, yi) if g_next is None else g_next
             r[:] = ro * r + (1 - ro) * np.multiply(g, g)
             dw_scale = (learning_rate / (np.sqrt(delta + r)))
             dw = np.multiply(dw_scale, g)
             w[:] = w - dw
-            losses[i] = f(w, xi, yi)
+            losses[i], g_next = get_sgd_loss(w, xi, yi, f, f_grad, reuse_grad=fixed_batch is not None)
         loss = np.mean(losses)
         if np.isnan(loss):
             logger.debug("loss is nan")
@@ -145,7 +181,7 @@ def sgdRMSProp(w0, x, y, f, grad, learning_rate=0.01,
             loss_best = loss
         epoch += 1
         if (loss < eps or np.abs(loss - prev_loss) < eps or
-            avg_loss_check(epoch_losses, epoch, n=20, eps=eps)):
+            avg_loss_check(epoch_losses, epoch, n=avg_loss_window, eps=eps)):
             break
         prev_loss = loss
     debug_log_sgd_losses("sgdRMSProp", epoch_losses, epoch, n=20, timer=tm)
@@ -159,7 +195,7 @@ def sgdRMSProp(w0, x, y, f, grad, learning_rate=0.01,
 def sgdMomentum(w0, x, y, f, grad, learning_rate=0.01,
                 batch_size=100, max_epochs=1000,
                 alpha=0.9, eps=1e-6,
-                shuffle=False, rng=None):
+                shuffle=False, rng=None, f_grad=None, avg_loss_window=20):
     tm = Timer()
     n = x.shape[0]
     n_batches = get_num_batches(n, batch_size)
@@ -181,14 +217,19 @@ def sgdMomentum(w0, x, y, f, grad, learning_rate=0.01,
     else:
         shuffled_idxs = None
     prev_loss = np.inf
+    fixed_batch = get_fixed_sgd_batch(x, y, batch_size)
+    g_next = None  # gradient at current w for the next batch, if already known
     while epoch < max_epochs:
         losses = np.zeros(n_batches, dtype=float)
         for i in range(n_batches):
-            xi, yi = get_sgd_batch(x, y, i, batch_size, shuffled_idxs=shuffled_idxs)
-            g = grad(w, xi, yi)
+            if fixed_batch is not None:
+                xi, yi = fixed_batch
+            else:
+                xi, yi = get_sgd_batch(x, y, i, batch_size, shuffled_idxs=shuffled_idxs)
+            g = grad(w, xi, yi) if g_next is None else g_next
             v[:] = alpha * v - learning_rate * g
             w[:] = w + v
-            losses[i] = f(w, xi, yi)
+            losses[i], g_next = get_sgd_loss(w, xi, yi, f, f_grad, reuse_grad=fixed_batch is not None)
         loss = np.mean(losses)
         if np.isnan(loss):
             logger.debug("loss is nan")
@@ -201,7 +242,7 @@ def sgdMomentum(w0, x, y, f, grad, learning_rate=0.01,
             loss_best = loss
         epoch += 1
         if (loss < eps or np.abs(loss - prev_loss) < eps or
-            avg_loss_check(epoch_losses, epoch, n=20, eps=eps)):
+            avg_loss_check(epoch_losses, epoch, n=avg_loss_window, eps=eps)):
             break
         prev_loss = loss
     debug_log_sgd_losses("sgdMomentum", epoch_losses, epoch, n=20, timer=tm)
@@ -215,7 +256,7 @@ def sgdMomentum(w0, x, y, f, grad, learning_rate=0.01,
 def sgdRMSPropNestorov(w0, x, y, f, grad, learning_rate=0.01,
                        batch_size=100, max_epochs=1000,
                        alpha=0.9, delta=1e-6, ro=0.9, eps=1e-6,
-                       shuffle=False, rng=None):
+                       shuffle=False, rng=None, avg_loss_window=20):
     tm = Timer()
     n = x.shape[0]
     n_batches = get_num_batches(n, batch_size)
@@ -261,7 +302,7 @@ def sgdRMSPropNestorov(w0, x, y, f, grad, learning_rate=0.01,
             loss_best = loss
         epoch += 1
         if (loss < eps or np.abs(loss - prev_loss) < eps or
-            avg_loss_check(epoch_losses, epoch, n=20, eps=eps)):
+            avg_loss_check(epoch_losses, epoch, n=avg_loss_window, eps=eps)):
             break
         prev_loss = loss
     debug_log_sgd_losses("sgdRMSPropNestorov", epoch_losses, epoch, n=20, timer=tm)
@@ -275,7 +316,7 @@ def sgdRMSPropNestorov(w0, x, y, f, grad, learning_rate=0.01,
 def sgdAdam(w0, x, y, f, grad, learning_rate=0.01,
             batch_size=100, max_epochs=1000, delta=1e-8,
             ro1=0.9, ro2=0.999, eps=1e-6,
-            shuffle=False, rng=None):
+            shuffle=False, rng=None, f_grad=None, avg_loss_window=20):
     tm = Timer()
     n = x.shape[0]
     n_batches = get_num_batches(n, batch_size)
@@ -301,11 +342,16 @@ def sgdAdam(w0, x, y, f, grad, learning_rate=0.01,
     else:
         shuffled_idxs = None
     prev_loss = np.inf
+    fixed_batch = get_fixed_sgd_batch(x, y, batch_size)
+    g_next = None  # gradient at current w for the next batch, if already known
     while epoch < max_epochs:
         losses = np.zeros(n_batches, dtype=float)
         for i in range(n_batches):
-            xi, yi = get_sgd_batch(x, y, i, batch_size, shuffled_idxs=shuffled_idxs)
-            g = grad(w, xi, yi)
+            if fixed_batch is not None:
+                xi, yi = fixed_batch
+            else:
+                xi, yi = get_sgd_batch(x, y, i, batch_size, shuffled_idxs=shuffled_idxs)
+            g = grad(w, xi, yi) if g_next is None else g_next
             t += 1
             s[:] = ro1 * s + (1 - ro1) * g
             r[:] = ro2 * r + (1 - ro2) * np.multiply(g, g)
@@ -316,7 +362,7 @@ def sgdAdam(w0, x, y, f, grad, learning_rate=0.01,
             dw_scale = (learning_rate / (np.sqrt(delta + r_hat)))
             dw = np.multiply(dw_scale, s_hat)
             w[:] = w - dw
-            losses[i] = f(w, xi, yi)
+            losses[i], g_next = get_sgd_loss(w, xi, yi, f, f_grad, reuse_grad=fixed_batch is not None)
         loss = np.mean(losses)
         if np.isnan(loss):
             logger.debug("loss is nan")
@@ -329,7 +375,7 @@ def sgdAdam(w0, x, y, f, grad, learning_rate=0.01,
             loss_best = loss
         epoch += 1
         if (loss < eps or np.abs(loss - prev_loss) < eps or
-            avg_loss_check(epoch_losses, epoch, n=20, eps=eps)):
+            avg_loss_check(epoch_losses, epoch, n=avg_loss_window, eps=eps)):
             break
         prev_loss = loss
     debug_log_sgd_losses("sgdAdam", epoch_losses, epoch, n=20, timer=tm)
@@ -279,8 +279,257 @@ class SetList(list):
         return self.__class__([item for item in self if item not in other])
 
 
+class CSRBuilder(object):
+    """ Builds a CSR matrix by appending blocks of rows in place
+
+    The data, indices and indptr arrays are preallocated for the expected
+    number of rows and non-zeros. Appending a block only copies that block
+    into the preallocated arrays, unlike scipy.sparse.vstack which copies
+    the entire matrix accumulated so far. If the capacity for non-zeros is
+    exceeded, it is grown to the number of non-zeros extrapolated from the
+    rows appended so far to the expected number of rows (max_rows), or
+    doubled once all expected rows have been appended.
+
+    Attributes:
+        n_cols: int
+        n_rows: int
+            number of rows appended so far
+        nnz: int
+            number of non-zeros appended so far
+        owns_buffers: bool
+            False if the arrays may be referenced outside the builder,
+            i.e., they were adopted by from_csr() or returned by tocsr()
+    """
+    def __init__(self, n_cols, max_rows=0, max_nnz=0, dtype=float):
+        self.n_cols = n_cols
+        self.n_rows = 0
+        self.nnz = 0
+        idx_dtype = self._get_index_dtype(max(max_nnz, n_cols))
+        self.data = np.zeros(max_nnz, dtype=dtype)
+        self.indices = np.zeros(max_nnz, dtype=idx_dtype)
+        self.indptr = np.zeros(max_rows + 1, dtype=idx_dtype)
+        self.owns_buffers = True
+
+    def __len__(self):
+        return self.n_rows
+
+    @staticmethod
+    def from_csr(x):
+        """ Returns a builder which starts with the rows of x
+
+        The arrays of x are adopted without a copy. Since they have no spare
+        capacity, the first append reallocates them and x is never modified.
+        """
+        x = csr_matrix(x)
+        builder = CSRBuilder(x.shape[1], dtype=x.dtype)
+        builder.data, builder.indices, builder.indptr = x.data, x.indices, x.indptr
+        builder.n_rows = x.shape[0]
+        builder.nnz = x.indptr[-1]
+        builder.owns_buffers = False
+        return builder
+
+    @staticmethod
+    def _get_index_dtype(maxval):
+        return np.int32 if maxval < np.iinfo(np.int32).max else np.int64
+
+    def _ensure_capacity(self, n_rows, nnz):
+        if n_rows + 1 > len(self.indptr):
+            capacity = max(n_rows + 1, 2 * len(self.indptr))
+            self.indptr = np.resize(self.indptr, capacity)
+        if nnz > len(self.data):
+            if 0 < n_rows < len(self.indptr) - 1:
+                # leave some slack such that small deviations from the
+                # average row density do not need another reallocation
+                capacity = int(1.1 * nnz * (len(self.indptr) - 1) / n_rows)
+            else:
+                capacity = 2 * len(self.data)
+            capacity = max(nnz, capacity)
+            idx_dtype = self._get_index_dtype(max(capacity, self.n_cols))
+            self.data = np.resize(self.data, capacity)
+            self.indices = np.resize(self.indices.astype(idx_dtype, copy=False), capacity)
+            self.indptr = self.indptr.astype(idx_dtype, copy=False)
+
+    def append(self, x):
+        """ Appends the rows of x at the end
+
+        :param x: scipy.sparse matrix or np.ndarray with n_cols columns
+        """
+        x = csr_matrix(x)
+        if x.shape[1] != self.n_cols:
+            raise ValueError("number of columns in x (%d) and builder (%d) are not same" %
+                             (x.shape[1], self.n_cols))
+        n_rows = self.n_rows + x.shape[0]
+        nnz = self.nnz + x.nnz
+        self._ensure_capacity(n_rows, nnz)
+        self.data[self.nnz:nnz] = x.data
+        self.indices[self.nnz:nnz] = x.indices
+        self.indptr[(self.n_rows + 1):(n_rows + 1)] = x.indptr[1:] + self.nnz
+        self.n_rows = n_rows
+        self.nnz = nnz
+
+    def tocsr(self, trim=False):
+        """ Returns the rows appended so far as a CSR matrix
+
+        :param trim: bool
+            If False, the returned matrix shares the underlying arrays with
+            the builder (no copy). If True, the unused capacity is released
+            and no more rows should be appended later. The arrays are shrunk
+            in place if no one else references them, else they are copied.
+        """
+        if trim:
+            self.data = self._trim(self.data, self.nnz)
+            self.indices = self._trim(self.indices, self.nnz)
+            self.indptr = self._trim(self.indptr, self.n_rows + 1)
+        data = self.data[0:self.nnz]
+        indices = self.indices[0:self.nnz]
+        indptr = self.indptr[0:(self.n_rows + 1)]
+        self.owns_buffers = False
+        return csr_matrix((data, indices, indptr), shape=(self.n_rows, self.n_cols), copy=False)
+
+    def take(self, indexes):
+        """ Returns a copy of the rows at indexes without exposing the builder's arrays """
+        x = csr_matrix((self.data[0:self.nnz], self.indices[0:self.nnz], self.indptr[0:(self.n_rows + 1)]),
+                       shape=(self.n_rows, self.n_cols), copy=False)
+        return x[indexes]
+
+    def compact(self, keep):
+        """ Retains only the rows where the boolean mask keep is True
+
+        The retained rows are moved to the front of the arrays in place if
+        the builder owns them, else they are copied to new arrays with the
+        same capacity.
+        """
+        if not self.owns_buffers:
+            x = self.take(keep)
+            builder = CSRBuilder(self.n_cols, max_rows=len(self.indptr) - 1,
+                                 max_nnz=len(self.data), dtype=self.data.dtype)
+            builder.append(x)
+            self.data, self.indices, self.indptr = builder.data, builder.indices, builder.indptr
+            self.n_rows, self.nnz, self.owns_buffers = builder.n_rows, builder.nnz, True
+            return
+        row_nnz = np.diff(self.indptr[0:(self.n_rows + 1)])
+        keep_nnz = np.repeat(keep, row_nnz)
+        nnz = int(np.sum(row_nnz[keep]))
+        self.data[0:nnz] = self.data[0:self.nnz][keep_nnz]
+        self.indices[0:nnz] = self.indices[0:self.nnz][keep_nnz]
+        n_rows = int(np.sum(keep))
+        np.cumsum(row_nnz[keep], out=self.indptr[1:(n_rows + 1)])
+        self.n_rows = n_rows
+        self.nnz = nnz
+
+    def _trim(self, arr, size):
+        if len(arr) == size:
+            return arr
+        if self.owns_buffers and arr.flags.owndata:
+            arr.resize(size, refcheck=False)
+            return arr
+        return arr[0:size].copy()
+
+
+class GrowableRows(object):
+    """ Rows of a dense array or a sparse matrix with spare capacity for appends
+
+    Appending rows copies only the new rows; the capacity is doubled when
+    it is exhausted. The array initially supplied is adopted without a copy
+    and is never modified (the first append reallocates).
+
+    Attributes:
+        n_rows: int
+        owns_data: bool
+            False if the dense array may be referenced outside, i.e., it was
+            supplied initially or a view of it was returned by get()
+    """
+    def __init__(self, data):
+        self.builder = None
+        self.data = None
+        self.owns_data = False
+        if scipy.sparse.issparse(data):
+            self.builder = CSRBuilder.from_csr(data)
+            self.n_rows = self.builder.n_rows
+        else:
+            self.data = np.asarray(data)
+            if self.data.ndim == 0:
+                self.data = self.data.reshape(1)
+            self.n_rows = self.data.shape[0]
+
+    def get(self):
+        """ Returns the rows as a view (no copy) """
+        if self.builder is not None:
+            return self.builder.tocsr()
+        self.owns_data = False
+        return self.data[0:self.n_rows]
+
+    def take(self, indexes):
+        """ Returns a copy of the rows at indexes """
+        if self.builder is not None:
+            return self.builder.take(indexes)
+        return self.data[0:self.n_rows][indexes]
+
+    def append(self, rows):
+        if self.builder is not None:
+            self.builder.append(rows)
+            self.n_rows = self.builder.n_rows
+            return
+        if scipy.sparse.issparse(rows):
+            rows = rows.toarray()
+        rows = np.asarray(rows)
+        if rows.ndim < self.data.ndim:
+            rows = rows.reshape((-1,) + self.data.shape[1:])
+        n_rows = self.n_rows + rows.shape[0]
+        dtype = np.result_type(self.data.dtype, rows.dtype)
+        if n_rows > self.data.shape[0] or dtype != self.data.dtype:
+            capacity = max(n_rows, 2 * self.data.shape[0])
+            data = np.empty((capacity,) + self.data.shape[1:], dtype=dtype)
+            data[0:self.n_rows] = self.data[0:self.n_rows]
+            self.data = data
+            self.owns_data = True
+        self.data[self.n_rows:n_rows] = rows
+        self.n_rows = n_rows
+
+    def compact(self, keep):
+        """ Retains only the rows where the boolean mask keep is True
+
+        The retained rows are moved to the front in place if the array is
+        owned, else they are copied to a new array with the same capacity.
+        """
+        if self.builder is not None:
+            self.builder.compact(keep)
+            self.n_rows = self.builder.n_rows
+            return
+        rows = self.data[0:self.n_rows][keep]
+        if not self.owns_data:
+            self.data = np.empty(self.data.shape, dtype=self.data.dtype)
+            self.owns_data = True
+        self.n_rows = rows.shape[0]
+        self.data[0:self.n_rows] = rows
+
+
 class InstanceList(object):
+    """ Instances with their labels, ids and transformed features
+
+    Each of x, y, ids and x_transformed is stored as GrowableRows so that
+    appending instances costs only the size of the new instances. Sparse
+    x_transformed blocks are appended to a CSRBuilder instead of vstack-ing
+    the whole matrix. Removed instances are only marked (tombstones) and
+    the reads are served through the positions of the remaining instances.
+    The storage is compacted in place once the fraction of removed
+    instances exceeds compact_threshold, or when a whole column is replaced.
+
+    The attributes x, y, ids and x_transformed return the current instances
+    and must be treated as read-only. Without pending removals they are
+    views of the storage, else copies that are reused until the next change.
+    """
+    _columns = ["x", "y", "ids", "x_transformed"]
+
+    # fraction of removed instances above which the storage is compacted
+    compact_threshold = 0.25
+
     def __init__(self, x=None, y=None, ids=None, x_transformed=None):
+        self._rows = dict()
+        self._removed = None  # tombstones over (a prefix of) the stored rows
+        self._n_removed = 0
+        self._live = None  # positions of the current instances among the stored rows
+        self._gathered = dict()  # columns gathered through _live
         self.x = x
         self.y = y
         self.ids = ids
@@ -291,10 +540,70 @@ class InstanceList(object):
                 raise ValueError("number of instances in x (%d) and x_transformed (%d) are not same" %
                                  (self.x.shape[0], self.x_transformed.shape[0]))
 
+    def _n_stored(self):
+        rows = self._rows.get("x")
+        return 0 if rows is None else rows.n_rows
+
+    def _get_live(self):
+        """ Returns the positions of the current instances among the stored rows """
+        if self._live is None:
+            n = self._n_stored()
+            self._live = append(np.where(~self._removed)[0], np.arange(len(self._removed), n))
+        return self._live
+
+    def _invalidate(self):
+        self._live = None
+        self._gathered = dict()
+
+    def _compact(self):
+        """ Drops the instances marked as removed """
+        if self._removed is None:
+            return
+        n = self._n_stored()
+        keep = np.ones(n, dtype=bool)
+        keep[0:len(self._removed)] = ~self._removed
+        self._removed = None
+        self._n_removed = 0
+        self._invalidate()
+        for rows in self._rows.values():
+            if rows is not None:
+                rows.compact(keep)
+
+    def _get_column(self, name):
+        rows = self._rows.get(name)
+        if rows is None:
+            return None
+        if self._removed is None:
+            return rows.get()
+        value = self._gathered.get(name)
+        if value is None:
+            value = rows.take(self._get_live())
+            self._gathered[name] = value
+        return value
+
+    def _set_column(self, name, value):
+        # the other columns have to be aligned with the new one
+        self._compact()
+        self._rows[name] = None if value is None else GrowableRows(value)
+
+    def _append_column(self, name, value):
+        """ Appends value if not None; starts the column if it does not exist yet """
+        if value is None:
+            return
+        rows = self._rows.get(name)
+        if rows is None:
+            self._rows[name] = GrowableRows(value)
+        else:
+            rows.append(value)
+
+    x = property(lambda self: self._get_column("x"), lambda self, v: self._set_column("x", v))
+    y = property(lambda self: self._get_column("y"), lambda self, v: self._set_column("y", v))
+    ids = property(lambda self: self._get_column("ids"), lambda self, v: self._set_column("ids", v))
+    x_transformed = property(lambda self: self._get_column("x_transformed"),
+                             lambda self, v: self._set_column("x_transformed", v))
+
     def __len__(self):
-        if self.x is not None:
-            return self.x.shape[0]
-        return 0
+        return self._n_stored() - self._n_removed
 
     def __repr__(self):
         return "instances(%s, %s, %s, %s)" % (
@@ -308,73 +617,67 @@ class InstanceList(object):
         return repr(self)
 
     def add_instances(self, x, y, ids=None, x_transformed=None):
-        if self.x is None:
-            self.x = x
-        else:
-            self.x = rbind(self.x, x)
-
-        if self.y is None:
-            self.y = y
-        elif y is not None:
-            self.y = append(self.y, y)
-
-        if self.ids is None:
-            self.ids = ids
-        elif ids is not None:
-            self.ids = append(self.ids, ids)
-
-        if self.x_transformed is None:
-            self.x_transformed = x_transformed
-        elif x_transformed is not None:
-            self.x_transformed = rbind(self.x_transformed, x_transformed)
+        self._invalidate()
+        self._append_column("x", x)
+        self._append_column("y", y)
+        self._append_column("ids", ids)
+        self._append_column("x_transformed", x_transformed)
 
     def get_instances_at(self, indexes):
-        insts_x = self.x[indexes, :]
+        if self._removed is not None:
+            indexes = self._get_live()[indexes]
+        insts_x = self._rows["x"].take(indexes)
         insts_y = None
         insts_id = None
         insts_transformed = None
-        if self.y is not None:
-            insts_y = self.y[indexes]
-        if self.ids is not None:
-            insts_id = self.ids[indexes]
-        if self.x_transformed is not None:
-            insts_transformed = self.x_transformed[indexes, :]
+        if self._rows.get("y") is not None:
+            insts_y = self._rows["y"].take(indexes)
+        if self._rows.get("ids") is not None:
+            insts_id = self._rows["ids"].take(indexes)
+        if self._rows.get("x_transformed") is not None:
+            insts_transformed = self._rows["x_transformed"].take(indexes)
         return insts_x, insts_y, insts_id, insts_transformed
 
     def add_instance(self, x, y=None, id=None, x_transformed=None):
-        if self.x is not None:
-            self.x = rbind(self.x, x)
-        else:
-            self.x = x
+        self._invalidate()
+        self._append_column("x", x)
         if y is not None:
-            if self.y is not None:
-                self.y = np.append(self.y, [y])
-            else:
-                self.y = np.array([y], dtype=int)
+            self._append_column("y", np.asarray(y, dtype=int).reshape(-1))
         if id is not None:
-            if self.ids is not None:
-                self.ids = np.append(self.ids, [id])
-            else:
-                self.ids = np.array([id], dtype=int)
-        if x_transformed is not None:
-            if self.x_transformed is not None:
-                self.x_transformed = rbind(self.x_transformed, x_transformed)
-            else:
-                self.x_transformed = x_transformed
+            self._append_column("ids", np.asarray(id, dtype=int).reshape(-1))
+        self._append_column("x_transformed", x_transformed)
 
     def retain_with_mask(self, mask):
-        self.x = self.x[mask]
-        if self.y is not None:
-            self.y = self.y[mask]
-        if self.ids is not None:
-            self.ids = self.ids[mask]
-        if self.x_transformed is not None:
-            self.x_transformed = self.x_transformed[mask]
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            # index array of instances to retain
+            retain = np.zeros(len(self), dtype=bool)
+            retain[mask] = True
+            mask = retain
+        self._mark_removed(~mask)
 
     def remove_instance_at(self, index):
-        mask = np.ones(self.x.shape[0], dtype=bool)
-        mask[index] = False
-        self.retain_with_mask(mask)
+        mask = np.zeros(len(self), dtype=bool)
+        mask[index] = True
+        self._mark_removed(mask)
+
+    def _mark_removed(self, mask):
+        """ Marks the instances (positions among current instances) in mask as removed """
+        n = self._n_stored()
+        if n == 0:
+            return
+        if self._removed is None:
+            removed = np.where(mask)[0]
+            self._removed = np.zeros(n, dtype=bool)
+        else:
+            removed = self._get_live()[mask]
+            if len(self._removed) < n:
+                self._removed = append(self._removed, np.zeros(n - len(self._removed), dtype=bool))
+        self._removed[removed] = True
+        self._n_removed += len(removed)
+        self._invalidate()
+        if self._n_removed > self.compact_threshold * n:
+            self._compact()
 
 
 def append_instance_lists(list1, list2):
@@ -495,17 +798,19 @@ class LogisticRegressionClassifier(SKLClassifier):
         return classifier
 
 
-def read_csv(file, header=None, sep=',', index_col=None, skiprows=None, usecols=None, encoding='utf8'):
+def read_csv(file, header=None, sep=',', index_col=None, skiprows=None, usecols=None, encoding='utf8',
+             chunksize=None):
     """Loads data from a CSV
 
     Returns:
-        DataFrame
+        DataFrame, or an iterator over DataFrames of chunksize rows if chunksize is not None
     """
 
     if header is not None and header:
         header = 0 # first row is header
 
-    data_df = pd.read_csv(file, header=header, sep=sep, index_col=index_col, skiprows=skiprows, usecols=usecols, encoding=encoding)
+    data_df = pd.read_csv(file, header=header, sep=sep, index_col=index_col, skiprows=skiprows, usecols=usecols,
+                          encoding=encoding, chunksize=chunksize)
 
     return data_df
 
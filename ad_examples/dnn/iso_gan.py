@@ -88,7 +88,7 @@ class GAN(object):
                  info_gan=False, info_gan_lambda=1.0,
                  conditional=False, n_classes=0, pvals=None, enable_ano_gan=False,
                  n_epochs=10, batch_size=25, shuffle=False, learning_rate=0.005,
-                 l2_lambda=0.001, listener=None, use_adam=False):
+                 l2_lambda=0.001, listener=None, use_adam=False, ano_gan_batch_size=256):
         """ Create the generator-discriminator networks
 
         :param data_dim: int
@@ -142,6 +142,8 @@ class GAN(object):
             call-back function that gets called at the end of each training epoch
         :param use_adam: bool
             whether to use ADAM. The default is GradientDescent
+        :param ano_gan_batch_size: int
+            number of instances whose AnoGAN latent representations are optimized in parallel
         """
         self.label_smoothing = label_smoothing
         self.smoothing_prob = smoothing_prob
@@ -155,6 +157,7 @@ class GAN(object):
         self.n_classes = n_classes
         self.pvals = pvals
         self.enable_ano_gan = enable_ano_gan
+        self.ano_gan_batch_size = ano_gan_batch_size
 
         self.n_epochs = n_epochs
         self.batch_size = batch_size
@@ -196,6 +199,12 @@ class GAN(object):
         self.ano_gan_loss_R = self.ano_gan_loss_D = self.ano_gan_info_loss = None
         self.ano_gan_q_network = None
 
+        # AnoGAN variables and losses for a batch of instances
+        self.ano_gan_batch_mask = self.ano_z_batch = None
+        self.ano_gan_batch_net_G = self.ano_gan_batch_net_D = None
+        self.ano_gan_batch_training_op = self.ano_gan_batch_loss = None
+        self.ano_gan_batch_loss_R = self.ano_gan_batch_loss_D = None
+
         # Tensoflow session object
         self.session = None
 
@@ -490,6 +499,43 @@ class GAN(object):
 
         self.ano_gan_training_op = self.training_op(self.ano_gan_loss, var_list=[self.ano_z], use_adam=self.use_adam)
 
+        self.init_ano_gan_batch()
+
+    def init_ano_gan_batch(self):
+        """ Prepare variables to optimize the latent z of a batch of instances in parallel
+
+        Every row of the batch has its own AnoGAN loss. The optimized loss is
+        the sum of the row losses; hence the gradient wrt the z of a row is the
+        same as when the row is optimized by itself. Rows whose mask is 0
+        (converged or padding) do not contribute to the loss.
+        """
+        self.ano_gan_batch_mask = tf.placeholder(tf.float32, shape=(self.ano_gan_batch_size,),
+                                                 name="ano_gan_batch_mask")
+        self.ano_z_batch = tf.Variable(initial_value=tf.zeros([self.ano_gan_batch_size, self.gen_input_dim]),
+                                       trainable=True, name="ano_z_batch")
+        with tf.variable_scope("GAN", reuse=True):
+            self.ano_gan_batch_net_G, self.ano_gan_batch_net_D = self.init_ano_gan_network(x=self.x, y=self.y,
+                                                                                           z=self.ano_z_batch)
+        ano_gan_G = get_nn_layer(self.ano_gan_batch_net_G, layer_from_top=1)
+        ano_gan_D = get_nn_layer(self.ano_gan_batch_net_D, layer_from_top=1)
+
+        # same as the AnoGAN losses, but per row
+        self.ano_gan_batch_loss_R = tf.reduce_sum(tf.abs(tf.subtract(self.x, ano_gan_G)), axis=1)
+        self.ano_gan_batch_loss_D = tf.reduce_sum(-tf.log(tf.nn.sigmoid(ano_gan_D)), axis=1)
+        if self.info_gan:
+            with tf.variable_scope("InfoGAN"):
+                q_network = self.init_info_gan_network(get_nn_layer(self.ano_gan_batch_net_D, layer_from_top=2),
+                                                       reuse=True)
+            q_c_x = get_nn_layer(q_network, layer_from_top=1)
+            # marginal_mutual_info() of each row
+            self.ano_gan_batch_loss_D += -tf.reduce_sum(tf.multiply(self.pvals, tf.log(q_c_x + TINY)), axis=1)
+
+        self.ano_gan_batch_loss = (1 - self.ano_gan_lambda) * self.ano_gan_batch_loss_R + \
+                                  self.ano_gan_lambda * self.ano_gan_batch_loss_D
+
+        self.ano_gan_batch_training_op = self.training_op(tf.reduce_sum(self.ano_gan_batch_mask * self.ano_gan_batch_loss),
+                                                          var_list=[self.ano_z_batch], use_adam=self.use_adam)
+
     def get_gen_input_samples(self, n=1, gen_y=False):
         if gen_y and self.pvals is None:
             raise ValueError("pvals is required")
@@ -761,10 +807,98 @@ class GAN(object):
 
         return gen_x, z, loss, loss_R, loss_D, trace
 
+    def get_anomaly_score_batch(self, x, y_one_hot=None, ano_gan_lambda=0.1, tol=1e-3, max_iters=100):
+        """ Computes the AnoGAN reconstructions of upto ano_gan_batch_size instances in parallel
+
+        Each row is optimized with the same steps and termination criteria
+        as get_anomaly_score_xy(). Rows stop contributing to the optimization
+        as soon as they converge.
+
+        :param x: np.ndarray
+        :param y_one_hot: np.ndarray
+            class membership of each row if self.conditional
+        :param tol: float
+        :param max_iters: int
+        :return: gen_x, z, loss, loss_R, loss_D, traces
+        """
+        if not self.enable_ano_gan:
+            raise RuntimeError("AnoGAN not enabled for this network")
+
+        tm = Timer()
+        n = x.shape[0]
+        b = self.ano_gan_batch_size
+        if n > b:
+            raise ValueError("At most %d instances allowed in an AnoGAN batch" % b)
+
+        # pad the inputs to the size of the batch
+        x_b = np.zeros(shape=(b, self.data_dim), dtype=np.float32)
+        x_b[:n, :] = x
+        feed_dict = {self.x: x_b, self.ano_gan_lambda: ano_gan_lambda}
+        if self.conditional:
+            y_b = np.zeros(shape=(b, self.n_classes), dtype=np.float32)
+            y_b[:n, :] = y_one_hot
+            feed_dict.update({self.y: y_b})
+
+        z, _ = self.get_gen_input_samples(n=b)
+        active = np.zeros(b, dtype=bool)
+        active[:n] = True
+        n_iters = np.zeros(n, dtype=int)
+        gen_x = np.zeros(shape=(n, self.data_dim), dtype=np.float32)
+        ano_z = np.zeros(shape=(n, self.gen_input_dim), dtype=np.float32)
+        loss = np.full(n, np.inf, dtype=np.float32)
+        loss_R = np.zeros(n, dtype=np.float32)
+        loss_D = np.zeros(n, dtype=np.float32)
+        all_gen_x = []
+        ano_gan_G = get_nn_layer(self.ano_gan_batch_net_G, layer_from_top=1)
+        i = 0
+        while np.any(active):
+            self.ano_z_batch.load(z, self.session)
+            feed_dict.update({self.ano_gan_batch_mask: active.astype(np.float32)})
+            self.session.run([self.ano_gan_batch_training_op], feed_dict=feed_dict)
+            rets = self.session.run([ano_gan_G, self.ano_gan_batch_loss, self.ano_z_batch,
+                                     self.ano_gan_batch_loss_R, self.ano_gan_batch_loss_D], feed_dict=feed_dict)
+
+            # make z values in [lo, hi]
+            z = self.clip(rets[2], lo=self.unif_lo, hi=self.unif_hi)
+
+            rows = np.where(active[:n])[0]
+            prev_loss = loss[rows]
+            gen_x[rows, :] = rets[0][rows, :]
+            ano_z[rows, :] = z[rows, :]
+            loss[rows] = rets[1][rows]
+            loss_R[rows] = rets[3][rows]
+            loss_D[rows] = rets[4][rows]
+            n_iters[rows] = i
+            all_gen_x.append(rets[0][:n, :])
+
+            # same termination criteria as get_anomaly_score_xy()
+            active[rows] = np.logical_and(i < max_iters, np.abs(loss[rows] - prev_loss) > tol)
+            i += 1
+        logger.debug(tm.message("AnoGAN batch of %d (max iters: %d)" % (n, i - 1)))
+
+        # the trace of a row excludes the initial reconstruction as in get_anomaly_score_xy()
+        all_gen_x = np.array(all_gen_x[1:]).reshape((-1, n, self.data_dim))
+        traces = [all_gen_x[:n_iters[j], j, :] for j in range(n)]
+        return gen_x, ano_z, loss, loss_R, loss_D, traces
+
+    def get_anomaly_score_xy_batch(self, x, y_one_hot=None, ano_gan_lambda=0.1, tol=1e-3, max_iters=100):
+        """ Computes the AnoGAN reconstructions of all instances in batches of ano_gan_batch_size """
+        rets = []
+        for i in range(0, x.shape[0], self.ano_gan_batch_size):
+            et = min(i + self.ano_gan_batch_size, x.shape[0])
+            rets.append(self.get_anomaly_score_batch(x[i:et], y_one_hot=None if y_one_hot is None else y_one_hot[i:et],
+                                                     ano_gan_lambda=ano_gan_lambda, tol=tol, max_iters=max_iters))
+        gen_x, z, loss, loss_R, loss_D = [np.concatenate([ret[k] for ret in rets], axis=0) for k in range(5)]
+        traces = [trace for ret in rets for trace in ret[5]]
+        return gen_x, z, loss, loss_R, loss_D, traces
+
     def get_anomaly_score(self, x, ano_gan_lambda=0.1, tol=1e-3, max_iters=100, use_loss=True, mode_avg=True):
-        """ Returns the anomaly score of test instance x
+        """ Returns the anomaly scores of test instances in x
 
-        :param x: np.ndarray (one row-vector)
+        The latent representations of ano_gan_batch_size instances (or
+        instance-label pairs) are optimized in parallel.
+
+        :param x: np.ndarray
         :param ano_gan_lambda: float
         :param tol: float
             loss tolerance to check for termination of back-propagation
@@ -777,20 +911,29 @@ class GAN(object):
             (applies only to conditional GAN, default: True)
         :return:
         """
-        losses = np.zeros(x.shape[0], dtype=np.float32)
-        losses_R = np.zeros(x.shape[0], dtype=np.float32)
-        losses_D = np.zeros(x.shape[0], dtype=np.float32)
-        traces = []
-        new_x = np.zeros(shape=x.shape, dtype=x.dtype)
-        for i in range(x.shape[0]):
-            gen_x, z, loss, loss_R, loss_D, trace = self.get_anomaly_score_x(x[[i]], ano_gan_lambda=ano_gan_lambda,
-                                                                             tol=tol, max_iters=max_iters,
-                                                                             use_loss=use_loss, mode_avg=mode_avg)
-            new_x[i, :] = gen_x[0, :]
-            losses[i] = loss
-            losses_R[i] = loss_R
-            losses_D[i] = loss_D
-            traces.append(trace)
+        n = x.shape[0]
+        if mode_avg or not self.conditional:
+            y_one_hot = None
+            if self.conditional:
+                y_one_hot = np.tile(np.array(self.pvals, dtype=np.float32).reshape((1, -1)), (n, 1))
+            gen_x, _, losses, losses_R, losses_D, traces = self.get_anomaly_score_xy_batch(x, y_one_hot=y_one_hot,
+                                                                                           ano_gan_lambda=ano_gan_lambda,
+                                                                                           tol=tol, max_iters=max_iters)
+        else:
+            # try each label for every instance and select the label with best metrics (loss or distance)
+            x_y = np.repeat(x, self.n_classes, axis=0)
+            y_one_hot = np.tile(np.eye(self.n_classes, dtype=np.float32), (n, 1))
+            gen_x, _, losses, losses_R, losses_D, traces = self.get_anomaly_score_xy_batch(x_y, y_one_hot=y_one_hot,
+                                                                                           ano_gan_lambda=ano_gan_lambda,
+                                                                                           tol=tol, max_iters=max_iters)
+            if use_loss:
+                metrics = losses
+            else:
+                metrics = np.sum(np.square(np.subtract(x_y, gen_x)), axis=1)
+            best = np.arange(n) * self.n_classes + np.argmin(metrics.reshape((n, self.n_classes)), axis=1)
+            gen_x, losses, losses_R, losses_D = gen_x[best], losses[best], losses_R[best], losses_D[best]
+            traces = [traces[i] for i in best]
+        new_x = np.asarray(gen_x, dtype=x.dtype)
         return new_x, losses, losses_R, losses_D, traces
 
     def save_session(self, file_path, overwrite=False):
@@ -811,8 +954,14 @@ class GAN(object):
             return False
         if self.session is None:
             self.session = tf.Session()
-        saver = tf.train.Saver()
+        saved = set([name for name, _ in tf.train.list_variables(file_path)])
+        saver = tf.train.Saver(var_list=[v for v in tf.global_variables() if v.op.name in saved])
         saver.restore(self.session, file_path)
+        missing = [v for v in tf.global_variables() if v.op.name not in saved]
+        if len(missing) > 0:
+            # checkpoints saved before the AnoGAN batch variables were added
+            logger.debug("Initializing %d variables not in checkpoint" % len(missing))
+            self.session.run(tf.variables_initializer(missing))
         logger.debug("Loaded saved session from path %s" % file_path)
         return True
 
@@ -166,16 +166,20 @@ def read_dataset(dataset, sub_sample=1.0, labeled_frac=1.0):
     return x, np.asarray(y, dtype=int), np.asarray(y_orig, dtype=int)
 
 
-def read_graph_dataset(dataset, sub_sample=1.0, labeled_frac=1.0, n_neighbors=5, euclidean=False):
+def read_graph_dataset(dataset, sub_sample=1.0, labeled_frac=1.0, n_neighbors=5, euclidean=False,
+                       sparse_adjacency=False):
     x, y, y_orig = read_dataset(dataset, sub_sample=sub_sample,
                                 labeled_frac=labeled_frac)
 
     if dataset == "face" or dataset == "face_top":
-        ga = GraphAdjacency(n_neighbors=n_neighbors, euclidean=euclidean, self_loops=True)
+        ga = GraphAdjacency(n_neighbors=n_neighbors, euclidean=euclidean, self_loops=True,
+                            sparse=sparse_adjacency)
         A = ga.build_adjacency(x)
     elif dataset == "synth_graph" or dataset == "synth_graph_small":
         A = get_synth_graph_adjacency(small=dataset == "synth_graph_small")
         A += np.eye(A.shape[0])  # add self-loops
+        if sparse_adjacency:
+            A = csr_matrix(A)
     else:
         raise ValueError("dataset '%s' not defined" % dataset)
     return x, y, y_orig, A
@@ -190,7 +194,8 @@ def read_datasets_for_illustration(opts):
     x, y, y_orig, A = read_graph_dataset(opts.dataset, sub_sample=sub_sample,
                                          labeled_frac=labeled_frac,
                                          n_neighbors=opts.n_neighbors,
-                                         euclidean=False)
+                                         euclidean=False,
+                                         sparse_adjacency=opts.sparse_adjacency)
     return x, y, y_orig, A
 
 
@@ -262,7 +267,7 @@ def plot_nodes(x, y, pl, dp, lbl_color_map=None,
 
 def plot_edges(x, A, pl):
     for i in range(x.shape[0]):
-        neighbors = np.where(A[i, :] > 0)[0]
+        neighbors = get_adjacent_nodes(A, i)
         for j in neighbors:
             pl.plot([x[i, 0], x[j, 0]], [x[i, 1], x[j, 1]], "-", color="gray", linewidth=0.5)
 
@@ -369,7 +374,7 @@ def test_edge_sample(opts):
     lbl_color_map = {-1: "grey", 0: "blue", 1: "red", 2: "green", 3: "orange"}
 
     # logger.debug("\n%s" % str(A))
-    ga = GraphAdjacency(opts.n_neighbors, self_loops=True)
+    ga = GraphAdjacency(opts.n_neighbors, self_loops=True, sparse=opts.sparse_adjacency)
 
     fsig = opts.get_opts_name_prefix()
     pdfpath = "%s/%s_edge_samples.pdf" % (opts.results_dir, fsig)
@@ -498,7 +503,7 @@ def test_neighbor_gradients(opts):
     f1 = gcn.get_f1_score(y_orig)
     logger.debug("f1 score: %f" % f1)
 
-    ga = GraphAdjacency(n_neighbors=opts.n_neighbors, self_loops=True)
+    ga = GraphAdjacency(n_neighbors=opts.n_neighbors, self_loops=True, sparse=opts.sparse_adjacency)
     attack_model = SimpleGCNAttack(gcn)
 
     test_nodes = attack_model.get_top_uncertain_nodes(opts.n_vulnerable)
@@ -506,7 +511,7 @@ def test_neighbor_gradients(opts):
 
     attack_model = SimpleGCNAttack(gcn=gcn)
 
-    neighbor_cache = dict()
+    neighbor_cache = NeighborIndex(gcn.fit_A)
     for i, test_node in enumerate(test_nodes):
         tm = Timer()
         neighbor_nodes = ga.sample_neighbors(test_node, gcn.fit_A, hops=opts.n_layers,
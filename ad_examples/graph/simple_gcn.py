@@ -1,5 +1,9 @@
+from collections import OrderedDict
 import numpy.random as rnd
 from sklearn.metrics import f1_score
+from sklearn.neighbors import NearestNeighbors
+from scipy import sparse
+from scipy.sparse import csr_matrix
 import tensorflow as tf
 from ..common.gen_samples import *
 
@@ -34,6 +38,151 @@ def sign(x):
     return -1. if x < 0 else 0. if x == 0 else 1.
 
 
+def get_adjacent_nodes(A, node):
+    """ Returns the sorted indexes of nodes with an edge from node
+
+    :param A: np.ndarray or scipy.sparse matrix
+    :param node: int
+    """
+    if sparse.issparse(A):
+        row = A.getrow(node)
+        return np.sort(row.indices[row.data > 0])
+    return np.where(A[node, :] > 0)[0]
+
+
+def get_normalized_adjacency(A):
+    """ Returns D^-1/2 A D^-1/2 where D is the diagonal matrix of node degrees
+
+    The scaling is applied to the nonzero values of A; hence the result is
+    sparse (CSR) if A is sparse.
+    """
+    D = np.asarray(A.sum(axis=1)).reshape(-1)
+    iDroot = np.sqrt(D) ** (-1)
+    if sparse.issparse(A):
+        A_hat = csr_matrix(A, dtype=float, copy=True)
+        rows = np.repeat(np.arange(A_hat.shape[0]), np.diff(A_hat.indptr))
+        A_hat.data *= iDroot[rows]
+        A_hat.data *= iDroot[A_hat.indices]
+        return A_hat
+    return (A * iDroot.reshape((-1, 1))) * iDroot.reshape((1, -1))
+
+
+def get_sparse_tensor_value(A):
+    """ Returns the tf.SparseTensorValue to feed a sparse matrix to a tf.sparse_placeholder """
+    coo = csr_matrix(A).tocoo()
+    indices = np.vstack([coo.row, coo.col]).T.astype(np.int64)
+    # the entries of a CSR matrix with sorted indices are in row-major order
+    order = np.lexsort((coo.col, coo.row))
+    return tf.SparseTensorValue(indices=indices[order], values=coo.data[order].astype(np.float32),
+                                dense_shape=np.array(coo.shape, dtype=np.int64))
+
+
+class NeighborIndex(object):
+    """ CSR index of the adjacency lists of a graph
+
+    The adjacent nodes of a node are a slice of the CSR indices. The nodes
+    within k hops are found for many nodes at once by expanding the frontiers
+    with sparse matrix products. Since these are reused across training
+    epochs, the k-hop neighbors of the most recently used nodes are retained
+    in a bounded LRU cache.
+
+    Attributes:
+        A: np.ndarray or scipy.sparse matrix
+            The adjacency matrix that was indexed
+        adjacency: scipy.sparse.csr_matrix
+            Binary adjacency matrix without self-loops
+        max_cache: int
+            Maximum number of (node, hops) entries in the cache
+        cache: OrderedDict
+            (node, hops) -> np.array of k-hop neighbors, least recently used first
+    """
+    def __init__(self, A, max_cache=10000):
+        self.A = A
+        coo = sparse.coo_matrix(A)
+        edges = np.logical_and(coo.data > 0, coo.row != coo.col)  # remove self-loops if any
+        adjacency = csr_matrix((np.ones(np.sum(edges), dtype=np.float32),
+                                (coo.row[edges], coo.col[edges])), shape=coo.shape)
+        adjacency.sort_indices()
+        self.adjacency = adjacency
+        self.max_cache = max_cache
+        self.cache = OrderedDict()
+
+    def get_adjacent_nodes(self, node):
+        """ Returns the sorted adjacent nodes of node (excluding itself) """
+        return self.adjacency.indices[self.adjacency.indptr[node]:self.adjacency.indptr[node + 1]]
+
+    def get_reachable(self, nodes, hops=1):
+        """ Returns the nodes within hops of each input node
+
+        :param nodes: np.array(int)
+        :param hops: int
+        :return: scipy.sparse.csr_matrix
+            (len(nodes) x n) binary matrix; row i is nonzero at the nodes
+            which can be reached from nodes[i] in at most hops steps
+        """
+        m, n = len(nodes), self.adjacency.shape[0]
+        reached = csr_matrix((np.ones(m, dtype=np.float32), (np.arange(m), nodes)), shape=(m, n))
+        for hop in range(hops):
+            expanded = reached + reached.dot(self.adjacency)
+            expanded.data[:] = 1
+            if expanded.nnz == reached.nnz:
+                break  # no new nodes reached
+            reached = expanded
+        reached.sort_indices()
+        return reached
+
+    def get_neighbors(self, nodes, hops=1):
+        """ Returns the list of sorted nodes within hops of each input node (excluding itself) """
+        if hops == 1:
+            return [self.get_adjacent_nodes(node) for node in nodes]
+        neighbors = [self.cache.pop((node, hops), None) for node in nodes]
+        for node, found in zip(nodes, neighbors):
+            if found is not None:
+                self.cache[(node, hops)] = found  # mark as most recently used
+        missing = [i for i, found in enumerate(neighbors) if found is None]
+        if len(missing) > 0:
+            missing_nodes = np.asarray(nodes)[missing]
+            reached = self.get_reachable(missing_nodes, hops=hops)
+            for i, node, start, end in zip(missing, missing_nodes, reached.indptr[:-1], reached.indptr[1:]):
+                found = reached.indices[start:end]
+                neighbors[i] = found[found != node]
+                self.cache[(node, hops)] = neighbors[i]
+            while len(self.cache) > self.max_cache:
+                self.cache.popitem(last=False)
+        return neighbors
+
+    def sample_neighbors(self, nodes, hops=1, n_neighbors=-1):
+        """ Returns a random sample of at most n_neighbors neighbors within hops of each node
+
+        All neighbors are returned if n_neighbors < 0.
+        """
+        neighbors = self.get_neighbors(nodes, hops=hops)
+        if n_neighbors < 0:
+            return neighbors
+        return sample_from_lists(neighbors, n_neighbors)
+
+
+def sample_from_lists(lists, n):
+    """ Samples at most n elements without replacement from each array in lists
+
+    The samples for all the arrays are drawn with a single sort of random keys.
+
+    :param lists: list of np.array
+    :param n: int
+    :return: list of np.array
+    """
+    lengths = np.array([len(l) for l in lists], dtype=int)
+    if np.sum(lengths) == 0:
+        return [np.array(l) for l in lists]
+    owners = np.repeat(np.arange(len(lists)), lengths)
+    values = np.concatenate(lists)
+    order = np.lexsort((np.random.rand(len(values)), owners))
+    ranks = np.arange(len(values)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    selected = order[ranks < n]  # ranks are of the sorted positions
+    counts = np.minimum(lengths, n)
+    return np.split(values[selected], np.cumsum(counts)[:-1])
+
+
 class GraphAdjacency(object):
     """ Encapsulates methods for computing the adjacency matrix with nearest neighbors
 
@@ -49,116 +198,124 @@ class GraphAdjacency(object):
         self_loops: bool
             True: set the diagonal elements to 1
             False: set diagonal elements to 0
+        sparse: bool
+            True: adjacency matrices are scipy.sparse.csr_matrix
+            False: adjacency matrices are dense np.ndarray
     """
 
-    def __init__(self, n_neighbors=10, euclidean=False, sig2=1.0, self_loops=True):
+    def __init__(self, n_neighbors=10, euclidean=False, sig2=1.0, self_loops=True, sparse=False):
         self.n_neighbors = n_neighbors
         self.euclidean = euclidean
         self.sig2 = sig2
         self.self_loops = self_loops
+        self.sparse = sparse
 
     def build_adjacency(self, x_in):
+        """ Returns the symmetric kNN adjacency matrix
+
+        The nearest neighbors are found with sklearn's NearestNeighbors, which
+        does not compute all pairwise distances; the edges are assembled in
+        CSR format. The memory required is O(n * n_neighbors) unless a dense
+        matrix is requested.
+        """
         n = nrow(x_in)
         x = normalize_and_center_by_feature_range(x_in)
-        dists = np.zeros(shape=(n, n), dtype=float)
-        for i in range(n):
-            for j in range(i, n):
-                dists[i, j] = euclidean_dist(x[i, :], x[j, :])
-                dists[j, i] = dists[i, j]
-
-        neighbors = np.zeros(shape=(n, self.n_neighbors), dtype=int)
-        for i in range(n):
-            neighbors[i, :] = np.argsort(dists[i, :])[0:self.n_neighbors]
-
-        A = np.zeros(shape=(n, n))
-        for i in range(n):
-            for j in neighbors[i, :]:
-                # ignore diagonal elements of W
-                if i != j:
-                    if self.euclidean:
-                        A[i, j] = np.exp(-(dists[i, j]**2) / self.sig2)
-                    else:
-                        A[i, j] = 1
-                    A[j, i] = A[i, j]  # undirected edge
+
+        nn = NearestNeighbors(n_neighbors=min(self.n_neighbors, n))
+        dists, neighbors = nn.fit(x).kneighbors(x)
+
+        rows = np.repeat(np.arange(n), neighbors.shape[1])
+        cols = neighbors.reshape(-1)
+        if self.euclidean:
+            vals = np.exp(-(dists.reshape(-1) ** 2) / self.sig2)
+        else:
+            vals = np.ones(len(cols), dtype=float)
+        keep = rows != cols  # ignore diagonal elements of W
+        A = csr_matrix((vals[keep], (rows[keep], cols[keep])), shape=(n, n))
+        A = A.maximum(A.T)  # undirected edge
 
         if self.self_loops:
-            A += np.eye(n)  # adding self-loops
+            A = A + sparse.identity(n, format="csr")  # adding self-loops
 
+        if not self.sparse:
+            return A.toarray()
+        A.sort_indices()
         return A
 
     def sample_edges(self, A, prob=1.0):
-        r, c = np.where(A > 0)  # row, column
-        # logger.debug("r:\n%s" % str(r))
-        # logger.debug("c:\n%s" % str(c))
+        """ Returns the adjacency matrix with a random fraction prob of the edges in A
+
+        The output is sparse if A is sparse.
+        """
+        if sparse.issparse(A):
+            coo = csr_matrix(A).tocoo()
+            # CSR entries are in row-major order, same as np.where() for dense
+            order = np.lexsort((coo.col, coo.row))
+            edges = order[coo.data[order] > 0]
+            r, c = coo.row[edges], coo.col[edges]
+        else:
+            r, c = np.where(A > 0)  # row, column
         # Assume that A is symmetric and get all edges in upper triangular
         # matrix excluding self-loops.
         upper_triangular_indexes = np.where(r < c)[0]
-        # logger.debug("r upper:\n%s" % str(r[upper_triangular_indexes]))
-        # logger.debug("c upper:\n%s" % str(c[upper_triangular_indexes]))
         all_upper = np.arange(len(upper_triangular_indexes), dtype=np.int32)
         np.random.shuffle(all_upper)
         all_upper = all_upper[0:int(prob*len(all_upper))]
         sampled_edges = upper_triangular_indexes[all_upper]
+        r, c = r[sampled_edges], c[sampled_edges]
+        n = A.shape[0]
+        if sparse.issparse(A):
+            A_new = csr_matrix((np.ones(2 * len(r), dtype=A.dtype), (np.append(r, c), np.append(c, r))),
+                               shape=A.shape)
+            if self.self_loops:
+                A_new = A_new + sparse.identity(n, dtype=A.dtype, format="csr")
+            A_new.sort_indices()
+            return A_new
         A_new = np.zeros(A.shape, dtype=A.dtype)
-        for i, j in zip(r[sampled_edges], c[sampled_edges]):
-            A_new[i, j] = 1
-            A_new[j, i] = 1  # symmetric matrix
+        A_new[r, c] = 1
+        A_new[c, r] = 1  # symmetric matrix
         if self.self_loops:
-            A_new += np.eye(A_new.shape[0])
+            A_new += np.eye(n)
         return A_new
 
-    def sample_adjacent_neighbors(self, node, A, n_neighbors=-1, neighbor_cache=None):
-        if neighbor_cache is not None and node in neighbor_cache:
-            all_neighbors = neighbor_cache[node]
-            # logger.debug("Node %d from cache: %s" % (node, str(list(all_neighbors))))
-        else:
-            all_neighbors = np.where(A[node, :] > 0)[0]
-            all_neighbors = all_neighbors[all_neighbors != node]  # remove self-loops if any
-            if neighbor_cache is not None:
-                neighbor_cache[node] = all_neighbors
+    def get_neighbor_index(self, A, neighbor_cache=None):
+        """ Returns neighbor_cache if it is a NeighborIndex, else a new NeighborIndex for A """
+        if isinstance(neighbor_cache, NeighborIndex):
+            return neighbor_cache
+        return NeighborIndex(A)
 
-        if n_neighbors < 0:
-            return all_neighbors
-        else:
-            n = len(all_neighbors)
-            indexes = np.arange(n)
-            np.random.shuffle(indexes)
-            return all_neighbors[:min(n_neighbors, n)]
+    def sample_adjacent_neighbors(self, node, A, n_neighbors=-1, neighbor_cache=None):
+        """ Returns a random sample of at most n_neighbors adjacent nodes (all if n_neighbors < 0)
 
-    def _all_neighbors(self, node, A, found, depth=0, max_depth=2, neighbor_cache=None):
-        if depth > max_depth:
-            return
-        found.add(node)
-        neighbors = self.sample_adjacent_neighbors(node, A, n_neighbors=-1,
-                                                   neighbor_cache=neighbor_cache)
-        # logger.debug("neighbors of %d (depth: %d): %s; found: %s" %
-        #              (node, depth, str(list(neighbors)), str(list(found))))
-        for neighbor in neighbors:
-            self._all_neighbors(neighbor, A, found, depth=depth+1, max_depth=max_depth,
-                                neighbor_cache=neighbor_cache)
+        :param neighbor_cache: NeighborIndex
+            Index of A which should be reused across calls
+        """
+        index = self.get_neighbor_index(A, neighbor_cache)
+        return index.sample_neighbors([node], hops=1, n_neighbors=n_neighbors)[0]
 
     def sample_neighbors(self, node, A, hops=1, n_neighbors=-1, neighbor_cache=None):
-        found = set()
-        self._all_neighbors(node, A, found, depth=0, max_depth=hops,
-                            neighbor_cache=neighbor_cache)
-        # logger.debug("final found: %s" % str(list(found)))
-        all_neighbors = np.array(list(found), dtype=np.int32)
-        all_neighbors = all_neighbors[all_neighbors != node]  # remove self-loops if any
-        if n_neighbors < 0:
-            return all_neighbors
-        else:
-            n = len(all_neighbors)
-            indexes = np.arange(n)
-            np.random.shuffle(indexes)
-            return all_neighbors[:min(n_neighbors, n)]
+        """ Returns a random sample of at most n_neighbors nodes within hops of node
+
+        :param neighbor_cache: NeighborIndex
+            Index of A which should be reused across calls
+        """
+        index = self.get_neighbor_index(A, neighbor_cache)
+        return np.asarray(index.sample_neighbors([node], hops=hops, n_neighbors=n_neighbors)[0],
+                          dtype=np.int32)
 
 
 class SampleUpdater(object):
     """ Class to introduce perturbations during training in order to improve robustness """
     def __init__(self, opts):
         self.opts = opts
-        self.ga = GraphAdjacency(n_neighbors=opts.n_neighbors, self_loops=True)
-        self.neighbor_cache = dict()
+        self.ga = GraphAdjacency(n_neighbors=opts.n_neighbors, self_loops=True, sparse=opts.sparse_adjacency)
+        self.neighbor_index = None
+
+    def get_neighbor_index(self, gcn):
+        """ Returns the NeighborIndex of the adjacency matrix the gcn was fit with """
+        if self.neighbor_index is None or self.neighbor_index.A is not gcn.fit_A:
+            self.neighbor_index = NeighborIndex(gcn.fit_A)
+        return self.neighbor_index
 
     def get_nodes_for_update(self, gcn):
         return None
@@ -209,19 +366,27 @@ class AdversarialUpdater(SampleUpdater):
         # tm = Timer()
         test_nodes = self.attack_model.get_top_uncertain_nodes(self.opts.n_vulnerable)
         update_nodes = dict()
+        # neighbors of all test nodes are sampled at once
+        all_neighbor_nodes = self.get_neighbor_index(gcn).sample_neighbors(test_nodes, hops=self.opts.n_layers,
+                                                                           n_neighbors=self.opts.n_sample_neighbors)
+        # the gradients do not change while selecting the updates; hence
+        # they are computed for all test nodes together
+        best_label, second_best_label = self.attack_model.get_top_two_predicted_label_probs()
+        all_attack_grads = self.attack_model.get_attack_gradients(test_nodes, all_neighbor_nodes,
+                                                                  best_label[test_nodes],
+                                                                  second_best_label[test_nodes])
         for i, test_node in enumerate(test_nodes):
-            neighbor_nodes = self.ga.sample_neighbors(test_node, gcn.fit_A, hops=self.opts.n_layers,
-                                                      n_neighbors=self.opts.n_sample_neighbors,
-                                                      neighbor_cache=self.neighbor_cache)
+            neighbor_nodes = np.asarray(all_neighbor_nodes[i], dtype=np.int32)
 
             """
             Remove all attack nodes which have already been added to update_nodes
             because we only apply at most one adversarial perturbation per attack node.
             """
-            neighbor_nodes = np.array([v for v in neighbor_nodes if v not in update_nodes], dtype=np.int32)
+            keep = np.array([v not in update_nodes for v in neighbor_nodes], dtype=bool)
 
-            best_attacks_for_each_target = self.attack_model.suggest_nodes([test_node], neighbor_nodes)
-            best, feature_grads = best_attacks_for_each_target[0]
+            best, feature_grads = self.attack_model.get_best_attack(test_node, best_label[test_node],
+                                                                    neighbor_nodes[keep],
+                                                                    all_attack_grads[i][keep])
             target_node, old_label, attack_node, feature, grads = best
             if attack_node is not None and attack_node not in update_nodes:
                 update_nodes[attack_node] = (attack_node, grads)
@@ -281,8 +446,6 @@ class SimpleGCN(object):
         self.y_labeled = None
         self.network = None
         self.A_hat = None
-        self.D = None
-        self.iDroot = None
 
         self.labeled_indexes = None
         self.z = None
@@ -293,10 +456,14 @@ class SimpleGCN(object):
         self.class_enc = np.eye(self.n_classes, dtype=np.float32)
 
         self.fit_x = self.fit_y = self.fit_labeled_indexes = self.fit_A = self.fit_A_hat = None
+        self.fit_A_hat_value = None
         self.target = self.label_1 = self.label_2 = None
         self.X_above_attack_node = self.X_attack_node = self.X_below_attack_node = self.X_attack = None
         self.attack_network = None
         self.attack_grad = None
+        self.targets = self.labels_1 = self.labels_2 = None
+        self.batch_attack_grad = None
+        self.A_hat_local = self.local_network = self.z_local = self.preds_local = None
 
         if self.graph is None:
             self.init_tf_graph()
@@ -316,7 +483,10 @@ class SimpleGCN(object):
             init = tf.truncated_normal((n_inputs, n_neurons), stddev=stddev)
             W = tf.get_variable("W", initializer=init)
             if is_gcn_layer_input:
-                Z = tf.matmul(A, tf.matmul(x, W))
+                if isinstance(A, tf.SparseTensor):
+                    Z = tf.sparse_tensor_dense_matmul(A, tf.matmul(x, W))
+                else:
+                    Z = tf.matmul(A, tf.matmul(x, W))
             else:
                 b = tf.get_variable("b", initializer=tf.zeros([n_neurons]))
                 Z = tf.matmul(x, W) + b
@@ -395,12 +565,24 @@ class SimpleGCN(object):
         self.y_labeled = y_labeled
 
         n = self.input_shape[0]
-        self.A_hat = tf.placeholder(tf.float32, shape=(n, n), name="%s_A" % self.name)
-        self.iDroot = tf.placeholder(tf.float32, shape=(n, n), name="%s_iD" % self.name)
+        if self.opts.sparse_adjacency:
+            self.A_hat = tf.sparse_placeholder(tf.float32, shape=(n, n), name="%s_A" % self.name)
+        else:
+            self.A_hat = tf.placeholder(tf.float32, shape=(n, n), name="%s_A" % self.name)
         self.layer_names = ['%s_layer_%d' % (self.name, i) for i, _ in enumerate(self.n_neurons)]
 
         self.network = self.build_gcn(self.X, reuse=False)
 
+        # the same network over a subgraph, such as the receptive field of a
+        # node, which only needs the adjacency matrix restricted to the subgraph
+        if self.opts.sparse_adjacency:
+            self.A_hat_local = tf.sparse_placeholder(tf.float32, name="%s_A_local" % self.name)
+        else:
+            self.A_hat_local = tf.placeholder(tf.float32, shape=(None, None), name="%s_A_local" % self.name)
+        self.local_network = self.build_gcn(self.X, A=self.A_hat_local, reuse=True)
+        self.z_local = get_nn_layer(self.local_network, layer_from_top=1)
+        self.preds_local = tf.nn.softmax(self.z_local)
+
         # loss
         self.labeled_indexes = tf.placeholder(tf.int32, shape=(None), name="li")
         self.z = get_nn_layer(self.network, layer_from_top=1)
@@ -483,6 +665,23 @@ class SimpleGCN(object):
                                   x_below_attack_node, x_attack)
         self.attack_network, self.attack_grad = self.setup_attack_gradient(self.X_attack, self.X_attack_node,
                                                                            self.target, self.label_1, self.label_2)
+        self.init_batch_attack_network()
+
+    def init_batch_attack_network(self):
+        """ Sets up the gradients of logit differences at many targets wrt all nodes
+
+        The gradient is computed for the sum of logit differences at all targets:
+            grad(sum_i target_logits_i[labels_1[i]] - target_logits_i[labels_2[i]]) wrt X
+        The row of an attacker therefore has the gradient for a single target
+        when the attacker is in the receptive field of only that target
+        (see SimpleGCNAttack.get_attack_gradients()).
+        """
+        self.targets = tf.placeholder(tf.int32, shape=(None,), name="%s_targets" % self.name)
+        self.labels_1 = tf.placeholder(tf.int32, shape=(None,), name="%s_labels_1" % self.name)
+        self.labels_2 = tf.placeholder(tf.int32, shape=(None,), name="%s_labels_2" % self.name)
+        logits_1 = tf.gather_nd(self.z, tf.stack([self.targets, self.labels_1], axis=1))
+        logits_2 = tf.gather_nd(self.z, tf.stack([self.targets, self.labels_2], axis=1))
+        self.batch_attack_grad = tf.gradients(tf.reduce_sum(logits_1 - logits_2), [self.X])[0]
 
     def setup_attack_gradient(self, x, x_attack_input, target_node, label_1, label_2):
         """ Sets up network for: grad(target_logits[label_1] - target_logits[label_2]) wrt attacker """
@@ -496,10 +695,14 @@ class SimpleGCN(object):
         attack_grad = tf.gradients(target_logits[label_1] - target_logits[label_2], [x_attack_input])
         return attack_network, attack_grad
 
-    def build_gcn(self, x, reuse=False):
-        """ Builds the Graph Convolution part of the network """
+    def build_gcn(self, x, A=None, reuse=False):
+        """ Builds the Graph Convolution part of the network
+
+        :param A: tf.Tensor
+            The adjacency placeholder; self.A_hat if None
+        """
         with tf.variable_scope("%s_GCN" % self.name, reuse=reuse):
-            gcn_network = self.dnn_construct(x, self.A_hat, self.n_neurons,
+            gcn_network = self.dnn_construct(x, self.A_hat if A is None else A, self.n_neurons,
                                              self.layer_names, self.activations, reuse=reuse)
             return gcn_network
 
@@ -539,11 +742,6 @@ class SimpleGCN(object):
         with self.graph.as_default():
             tf.set_random_seed(self.opts.randseed)
 
-    def get_iDroot(self, A):
-        D = A.sum(axis=1)
-        iDroot = np.diag(np.sqrt(D) ** (-1))
-        return D, iDroot
-
     def fit(self, x, y, A):
         with self.graph.as_default():
             self.session.run(tf.global_variables_initializer())
@@ -561,7 +759,24 @@ class SimpleGCN(object):
         The ensemble (see EnsembleGCN) can override this method to return
         map of adjacency matrices across members.
         """
-        return {self.A_hat: self.fit_A_hat}
+        return {self.A_hat: self.fit_A_hat_value}
+
+    def get_local_adjacency_variable_map(self, nodes):
+        """ Returns map of the local adjacency variables for the subgraph of nodes
+
+        :param nodes: np.array(int)
+            Sorted indexes of the nodes in the subgraph
+        """
+        A_local = self.fit_A_hat[nodes][:, nodes]
+        return {self.A_hat_local: self.get_adjacency_value(A_local)}
+
+    def get_adjacency_value(self, A_hat):
+        """ Returns the value to feed for the adjacency placeholder """
+        if self.opts.sparse_adjacency:
+            return get_sparse_tensor_value(A_hat)
+        if sparse.issparse(A_hat):
+            return A_hat.toarray()
+        return A_hat
 
     def if_perturb(self):
         """ Checks whether the sample should be perturbed
@@ -582,12 +797,12 @@ class SimpleGCN(object):
             By this point the default graph has already set to self.graph
             (see self.fit() above) and the computation graph has been fully created.
         """
-        D, iDroot = self.get_iDroot(A)
-        A_hat = np.dot(np.dot(iDroot, A), iDroot)
+        A_hat = get_normalized_adjacency(A)
         self.fit_x = x
         self.fit_y = y
         self.fit_A = A
         self.fit_A_hat = A_hat
+        self.fit_A_hat_value = self.get_adjacency_value(A_hat)
         labeled_indexes = np.where(self.fit_y >= 0)[0]
         y_labeled = np.asarray(self.fit_y[labeled_indexes], dtype=int)
         # logger.debug("y_labeled: %d\n%s" % (len(y_labeled), str(list(y_labeled))))
@@ -644,6 +859,22 @@ class SimpleGCN(object):
         preds = self.session.run([self.preds], feed_dict=feed_dict)[0]
         return preds
 
+    def decision_function_local(self, x_local, local_A_map):
+        """ Returns predicted probability per class per node of a subgraph
+
+        The predictions are exact only for the nodes whose receptive fields
+        (nodes within n_layers hops) are within the subgraph.
+
+        :param x_local: np.ndarray
+            Values of the nodes in the subgraph
+        :param local_A_map: dict
+            See get_local_adjacency_variable_map()
+        """
+        feed_dict = {self.X: x_local}
+        feed_dict.update(local_A_map)
+        preds = self.session.run([self.preds_local], feed_dict=feed_dict)[0]
+        return preds
+
     def predict(self):
         """ Returns best class prediction for each node """
         preds = self.decision_function()
@@ -720,6 +951,24 @@ class SimpleGCN(object):
         g_v = g_v[0][0]
         return g_v
 
+    def grad_logit_diffs_wrt_nodes(self, targets, labels_1, labels_2):
+        """ Computes the gradient of the sum of logit differences at targets wrt all node values
+
+        :param targets: np.array(int)
+        :param labels_1: np.array(int)
+        :param labels_2: np.array(int)
+        :return: np.ndarray
+            grad(sum_i target_logits_i[labels_1[i]] - target_logits_i[labels_2[i]]) wrt
+            every node; one row per node
+        """
+        feed_dict = {self.X: self.fit_x,
+                     self.targets: np.asarray(targets, dtype=np.int32),
+                     self.labels_1: np.asarray(labels_1, dtype=np.int32),
+                     self.labels_2: np.asarray(labels_2, dtype=np.int32)}
+        feed_dict.update(self.get_adjacency_variable_map())
+        g_v = self.session.run([self.batch_attack_grad], feed_dict=feed_dict)[0]
+        return g_v
+
     def best_feature_wrt_attacker(self, target, attacker, old_label, new_label):
         """ Returns index of the feature along which the logit difference at the target is highest
 
@@ -751,8 +1000,9 @@ class SimpleGCN(object):
         labeled_indexes = np.where(self.fit_y >= 0)[0]
         y_labeled = np.asarray(self.fit_y[labeled_indexes], dtype=int)
         y_labeled_enc = self.class_enc[y_labeled]
-        feed_dict = {self.X: self.fit_x, self.A_hat: self.fit_A_hat, self.y_labeled: y_labeled_enc,
+        feed_dict = {self.X: self.fit_x, self.y_labeled: y_labeled_enc,
                      self.labeled_indexes: labeled_indexes}
+        feed_dict.update(self.get_adjacency_variable_map())
         loss = self.session.run([self.xentropy_loss], feed_dict=feed_dict)[0]
         return loss
 
@@ -760,8 +1010,8 @@ class SimpleGCN(object):
         """ Use only for DEBUG """
         with self.graph.as_default():
             labeled_indexes = np.where(self.fit_y >= 0)[0]
-            feed_dict = {self.X: self.fit_x, self.A_hat: self.fit_A_hat,
-                         self.labeled_indexes: labeled_indexes}
+            feed_dict = {self.X: self.fit_x, self.labeled_indexes: labeled_indexes}
+            feed_dict.update(self.get_adjacency_variable_map())
             logits_tensor = tf.gather(self.z, self.labeled_indexes, axis=0)
             logits = self.session.run([logits_tensor], feed_dict=feed_dict)[0]
         return logits
@@ -800,7 +1050,7 @@ class EnsembleGCN(SimpleGCN):
                           opts=self.opts, init_network_now=False))
 
         # below will be used to sample edges of the adjacency matrix
-        self.ga = GraphAdjacency(self_loops=True)
+        self.ga = GraphAdjacency(self_loops=True, sparse=opts.sparse_adjacency)
 
         with self.graph.as_default():
             self.init_network()
@@ -824,6 +1074,9 @@ class EnsembleGCN(SimpleGCN):
         self.z = tf.reduce_mean(tf.stack(all_z, axis=2), axis=2)
         self.preds = tf.nn.softmax(self.z)
 
+        self.z_local = tf.reduce_mean(tf.stack([gcn.z_local for gcn in self.estimators], axis=2), axis=2)
+        self.preds_local = tf.nn.softmax(self.z_local)
+
         if init_attack_network_now:
             self.init_attack_network()
 
@@ -845,6 +1098,7 @@ class EnsembleGCN(SimpleGCN):
 
         self.attack_network, self.attack_grad = self.setup_attack_gradient(self.X_attack, self.X_attack_node,
                                                                            self.target, self.label_1, self.label_2)
+        self.init_batch_attack_network()
 
     def setup_attack_gradient(self, x, x_attack_input, target_node, label_1, label_2):
         all_attack_network = []
@@ -864,7 +1118,13 @@ class EnsembleGCN(SimpleGCN):
         return None, attack_grad
 
     def get_adjacency_variable_map(self):
-        A_map = {gcn.A_hat: gcn.fit_A_hat for gcn in self.estimators}
+        A_map = {gcn.A_hat: gcn.fit_A_hat_value for gcn in self.estimators}
+        return A_map
+
+    def get_local_adjacency_variable_map(self, nodes):
+        A_map = dict()
+        for gcn in self.estimators:
+            A_map.update(gcn.get_local_adjacency_variable_map(nodes))
         return A_map
 
     def _fit(self, x, y, A):
@@ -890,6 +1150,7 @@ class SimpleGCNAttack(object):
         self.min_prod = min_prod
         self.max_prod = max_prod
         self.max_iters = max_iters
+        self.neighbor_index = None
 
     def get_top_two_predicted_label_probs(self):
         probs = self.gcn.decision_function()
@@ -904,6 +1165,98 @@ class SimpleGCNAttack(object):
         s = np.argsort(probs_diff)
         return s[:n]
 
+    def get_receptive_fields(self, nodes):
+        """ Returns the nodes whose values influence the GCN output at each input node
+
+        The output at a node depends only on the nodes within n_layers hops.
+
+        :param nodes: np.array(int)
+        :return: scipy.sparse.csr_matrix
+            row i is nonzero at the (sorted) receptive field of nodes[i]
+        """
+        if self.neighbor_index is None or self.neighbor_index.A is not self.gcn.fit_A:
+            self.neighbor_index = NeighborIndex(self.gcn.fit_A)
+        return self.neighbor_index.get_reachable(np.asarray(nodes, dtype=int), hops=len(self.gcn.n_neurons))
+
+    def get_disjoint_batches(self, fields):
+        """ Greedily partitions the rows of fields into batches with pairwise disjoint rows
+
+        :param fields: scipy.sparse.csr_matrix
+        :return: list of lists of row indexes
+        """
+        batches = list()
+        covered = list()
+        for i in range(fields.shape[0]):
+            nodes = fields.indices[fields.indptr[i]:fields.indptr[i + 1]]
+            for b, mask in enumerate(covered):
+                if not np.any(mask[nodes]):
+                    break
+            else:
+                b = len(batches)
+                batches.append(list())
+                covered.append(np.zeros(fields.shape[1], dtype=bool))
+            batches[b].append(i)
+            covered[b][nodes] = True
+        return batches
+
+    def get_attack_gradients(self, target_nodes, attack_nodes, old_labels, new_labels):
+        """ Returns the gradients of logit differences at targets wrt their attack nodes
+
+        The gradient at a target is zero for attack nodes outside its receptive
+        field. Hence, the gradients for all targets whose receptive fields do not
+        overlap are computed together with a single pass over the network.
+
+        :param target_nodes: np.array(int)
+        :param attack_nodes: list of np.array(int)
+            attack_nodes[i] are the attack nodes for target_nodes[i]
+        :param old_labels: np.array(int)
+        :param new_labels: np.array(int)
+        :return: list of np.ndarray
+            i-th element has one row per attack node with the gradient of
+            (target_logits[new_labels[i]] - target_logits[old_labels[i]])
+        """
+        target_nodes = np.asarray(target_nodes, dtype=int)
+        old_labels = np.asarray(old_labels, dtype=int)
+        new_labels = np.asarray(new_labels, dtype=int)
+        fields = self.get_receptive_fields(target_nodes)
+        all_grads = [None] * len(target_nodes)
+        for batch in self.get_disjoint_batches(fields):
+            grads = self.gcn.grad_logit_diffs_wrt_nodes(targets=target_nodes[batch],
+                                                        labels_1=new_labels[batch],
+                                                        labels_2=old_labels[batch])
+            for i in batch:
+                attackers = np.asarray(attack_nodes[i], dtype=int)
+                in_field = np.in1d(attackers, fields.indices[fields.indptr[i]:fields.indptr[i + 1]])
+                all_grads[i] = np.zeros((len(attackers), grads.shape[1]), dtype=grads.dtype)
+                all_grads[i][in_field] = grads[attackers[in_field]]
+        return all_grads
+
+    def get_best_attack(self, target_node, old_label, attack_nodes, attack_grads):
+        """ Returns the attack node and feature with the largest gradient magnitude
+
+        :param target_node: int
+        :param old_label: int
+        :param attack_nodes: np.array(int)
+        :param attack_grads: np.ndarray
+            gradients wrt attack nodes (see get_attack_gradients())
+        :return: tuple, list
+        """
+        best_grad = 0.0
+
+        # initially, no attack node found for the target node...
+        best_attack_node_details = (target_node, old_label, None, None, None)
+
+        all_attack_node_gradients = []
+        for attack_node, feature_grads in zip(attack_nodes, attack_grads):
+            best_feature = np.argmax(np.abs(feature_grads))
+            all_attack_node_gradients.append((attack_node, best_feature, feature_grads))
+            # logger.debug("\nattack_node: %d, old_label: %d; best_feature: %d; feature_grads: %s" %
+            #              (attack_node, old_label, best_feature, str(list(feature_grads))))
+            if np.abs(feature_grads[best_feature]) > best_grad:
+                best_grad = np.abs(feature_grads[best_feature])
+                best_attack_node_details = (target_node, old_label, attack_node, best_feature, feature_grads)
+        return best_attack_node_details, all_attack_node_gradients
+
     def suggest_node_feature(self, target_node, attack_node, old_label, new_label):
         """
         Suggest best feature of attacker node that can be modified such that
@@ -937,31 +1290,21 @@ class SimpleGCNAttack(object):
             best_label, second_best_label = self.get_top_two_predicted_label_probs()
             old_label = best_label[target_node]
             new_label = second_best_label[target_node]
-        best_grad = 0.0
-
-        # initially, no attack node found for the target node...
-        best_attack_node_details = (target_node, old_label, None, None, None)
-
-        all_attack_node_gradients = []
-        for attack_node in attack_nodes:
-            best_feature, feature_grads = self.suggest_node_feature(target_node, attack_node, old_label, new_label)
-            all_attack_node_gradients.append((attack_node, best_feature, feature_grads))
-            # logger.debug("\nattack_node: %d, old_label: %d; new_label: %d; best_feature: %d; feature_grads: %s" %
-            #              (attack_node, old_label, new_label, best_feature, str(list(feature_grads))))
-            if np.abs(feature_grads[best_feature]) > best_grad:
-                best_grad = np.abs(feature_grads[best_feature])
-                best_attack_node_details = (target_node, old_label, attack_node, best_feature, feature_grads)
-        return best_attack_node_details, all_attack_node_gradients
+        attack_grads = self.get_attack_gradients([target_node], [attack_nodes], [old_label], [new_label])[0]
+        return self.get_best_attack(target_node, old_label, attack_nodes, attack_grads)
 
     def suggest_nodes(self, target_nodes, attack_nodes):
         best_label, second_best_label = self.get_top_two_predicted_label_probs()
+        # current predicted best and second-best labels for target nodes
+        old_labels = best_label[target_nodes]
+        new_labels = second_best_label[target_nodes]
+        all_attack_grads = self.get_attack_gradients(target_nodes, [attack_nodes] * len(target_nodes),
+                                                     old_labels, new_labels)
         best_attack_for_each_target = []
-        for target_node in target_nodes:
-            old_label = best_label[target_node]  # current predicted best label for target node
-            new_label = second_best_label[target_node]  # second-best predicted label for target node
-            best_attack_node_details, all_attack_node_gradients = self.suggest_node(target_node, attack_nodes,
-                                                                                    old_label=old_label,
-                                                                                    new_label=new_label)
+        for i, target_node in enumerate(target_nodes):
+            best_attack_node_details, all_attack_node_gradients = self.get_best_attack(target_node, old_labels[i],
+                                                                                       attack_nodes,
+                                                                                       all_attack_grads[i])
             best_attack_for_each_target.append((best_attack_node_details, all_attack_node_gradients))
         return best_attack_for_each_target
 
@@ -1022,10 +1365,21 @@ class SimpleGCNAttack(object):
         prod = 0.5  # just an initial value ... will be updated
         orig_val = np.copy(self.gcn.fit_x[mod_node, :])
         mod_val = None
+
+        # The prediction for target node depends only on its receptive field.
+        # Hence the search predicts with the subgraph of the receptive field
+        # instead of modifying the node and predicting for the full graph.
+        nodes = self.get_receptive_fields([target_node]).indices
+        local_A_map = self.gcn.get_local_adjacency_variable_map(nodes)
+        x_local = np.copy(self.gcn.fit_x[nodes, :])
+        target_pos = np.searchsorted(nodes, target_node)
+        mod_pos = np.where(nodes == mod_node)[0]  # empty if mod_node is outside the receptive field
+
         for i in range(self.max_iters):
             node_val = orig_val + prod * search_direction
-            y_hat = self.modify_gcn_and_predict(node=mod_node, node_val=node_val, retrain=False)
-            if y_hat[target_node] != old_label:
+            x_local[mod_pos, :] = node_val
+            probs = self.gcn.decision_function_local(x_local, local_A_map)
+            if np.argmax(probs[target_pos]) != old_label:
                 mod_val = node_val
                 if max_prod - prod < 1e-2 and mod_val is not None:
                     break
@@ -1118,6 +1472,8 @@ def get_gcn_option_list():
                         help="Number of members in ensemble for EnsembleGCN")
     parser.add_argument("--n_neighbors", type=int, default=5, required=False,
                         help="Number of nearest neighbors to use for preparing graph")
+    parser.add_argument("--sparse_adjacency", action="store_true", default=False,
+                        help="Whether to store the graph adjacency matrix as a sparse matrix")
     parser.add_argument("--adversarial_train", action="store_true", default=False,
                         help="Whether to employ adversarial perturbations during training")
     parser.add_argument("--perturb_prob", action="store", type=float, default=0.1,
@@ -1156,6 +1512,7 @@ class GcnOpts(object):
         self.edge_sample_prob = args.edge_sample_prob
         self.n_estimators = args.n_estimators
         self.n_neighbors = args.n_neighbors
+        self.sparse_adjacency = args.sparse_adjacency
         self.adversarial_train = args.adversarial_train
         self.perturb_prob = args.perturb_prob
         self.perturb_epsilon = args.perturb_epsilon
@@ -1,14 +1,24 @@
 import numpy as np
 from ..common.utils import *
+from ..common.parallel_utils import *
 
 
 """
 A non-streaming implementation of LODA. Please refer to:
     Tomas Pevny, Loda: Lightweight on-line detector of anomalies, Machine Learning 2015.
     http://webdav.agents.fel.cvut.cz/data/projects/stegodata/pdfs/Pev15-Loda.pdf
+
+The histograms of a fitted model can be updated from a stream with
+StreamingHistogramDensities; the projection vectors remain fixed.
 """
 
 
+# Types of update of histogram counts from the stream buffer. These have
+# the same values and semantics as TREE_UPD_OVERWRITE/TREE_UPD_INCREMENTAL.
+HIST_UPD_OVERWRITE = 0
+HIST_UPD_INCREMENTAL = 1
+
+
 class HistogramR(object):
     def __init__(self, counts, density, breaks):
         self.counts = counts
@@ -41,6 +51,23 @@ class LodaModel(object):
         self.k = k
         self.pvh = pvh
         self.sigs = sigs
+        self.densities = None
+
+    def compile(self):
+        """ Stores all histograms in one padded density matrix for fast lookup
+
+        Must be called again if the histograms in pvh are replaced.
+        """
+        self.densities = HistogramDensities(self.pvh.hists)
+        return self
+
+    def get_all_hist_pdfs(self, a):
+        if self.densities is None:
+            self.compile()
+        return self.densities.get_pdfs(a.dot(self.pvh.w))
+
+    def get_neg_ll_all_hist(self, a, inf_replace=np.nan):
+        return get_neg_ll_from_pdfs(self.get_all_hist_pdfs(a), inf_replace=inf_replace)
 
 
 class LodaResult(object):
@@ -57,6 +84,102 @@ class LodaResult(object):
         self.pvh = pvh
 
 
+def get_equal_bin_edges(y):
+    """ Returns the range (first, last) of the bin edges as in np.histogram
+
+    :param y: np.array
+        sorted values
+    """
+    first, last = float(y[0]), float(y[len(y) - 1])
+    if first == last:
+        first -= 0.5
+        last += 0.5
+    return first, last
+
+
+def get_equal_bin_counts(y, d_list, first, last):
+    """ Counts of regular histograms with d bins for every d in d_list
+
+    The counts are the same as np.histogram(y, bins=d) and are obtained
+    by binary search of the bin edges in the sorted values; hence, the
+    data is not scanned again for every d.
+
+    :param y: np.array
+        sorted values
+    :param d_list: np.array(int)
+        number of bins of each histogram
+    :param first: float
+    :param last: float
+        range of the bin edges
+    :return: np.array(float), np.array(int)
+        counts of all histograms concatenated, and the start offset
+        of each histogram in the concatenated array
+    """
+    d_list = np.asarray(d_list, dtype=int)
+    n = len(y)
+    # the interior edges are computed the same way as by np.linspace()
+    d_rep = np.repeat(d_list, d_list - 1)
+    starts = np.cumsum(d_list - 1) - (d_list - 1)
+    k = np.arange(len(d_rep)) - np.repeat(starts, d_list - 1) + 1
+    edges = k * ((last - first) / d_rep) + first
+    # np.histogram puts values equal to an interior edge in the right bin
+    pos = np.searchsorted(y, edges, side='left')
+
+    # insert 0 and n around the interior positions of each histogram
+    offsets = np.cumsum(d_list + 1) - (d_list + 1)
+    bounds = np.zeros(np.sum(d_list + 1), dtype=int)
+    bounds[offsets + d_list] = n
+    interior = np.ones(len(bounds), dtype=bool)
+    interior[offsets] = False
+    interior[offsets + d_list] = False
+    bounds[interior] = pos
+    counts = np.diff(bounds)
+    # drop the differences which span two histograms
+    counts = np.delete(counts, (offsets + d_list)[:-1])
+    return np.asarray(counts, dtype=float), np.cumsum(d_list) - d_list
+
+
+def get_birge_likelihoods(y, d_list, max_edges=1000000):
+    """ Log-likelihoods of regular histograms with d bins for every d in d_list
+
+    :param y: np.array
+        sorted values
+    :param max_edges: int
+        histograms are evaluated in chunks of at most these many bins
+    :return: np.array(float)
+    """
+    n = len(y)
+    first, last = get_equal_bin_edges(y)
+    d_list = np.asarray(d_list, dtype=int)
+    likelihood = np.zeros(len(d_list), dtype=np.float64)
+    start = 0
+    while start < len(d_list):
+        end = start + max(1, np.searchsorted(np.cumsum(d_list[start:]), max_edges, side='right'))
+        d_chunk = d_list[start:end]
+        counts, offsets = get_equal_bin_counts(y, d_chunk, first, last)
+        # width of the first bin as in (breaks[1] - breaks[0])
+        widths = ((last - first) / d_chunk + first) - first
+        density = counts / (n * np.repeat(widths, d_chunk))
+        like = np.zeros(len(counts), dtype=float)
+        nonzero = counts > 0
+        like[nonzero] = np.log(density[nonzero])
+        like[~np.isfinite(like)] = 0.
+        likelihood[start:end] = np.add.reduceat(counts * like, offsets)
+        start = end
+    return likelihood
+
+
+def get_regular_histogram(y, d):
+    """ Returns HistogramR with d regular bins for the sorted values y """
+    n = len(y)
+    first, last = get_equal_bin_edges(y)
+    counts, _ = get_equal_bin_counts(y, [d], first, last)
+    breaks = np.linspace(first, last, d + 1, endpoint=True)
+    density = counts / (n * (breaks[1] - breaks[0]))
+    return HistogramR(counts=np.array(counts, float), density=np.array(density, float),
+                      breaks=np.array(breaks, dtype=float))
+
+
 def histogram_r(x, g1=1., g2=1., g3=-1., verbose=False):
     """Construct histograms that mimic behavior of R histogram package
 
@@ -69,39 +192,20 @@ def histogram_r(x, g1=1., g2=1., g3=-1., verbose=False):
     nbinsmax = int(g1 * (n ** g2) * (np.log(n) ** g3))
     if verbose:
         logger.debug("max bins: %d" % (nbinsmax,))
-    # density, breaks = np.histogram(x, bins=nbinsmax, density=True)
 
     # the below implements Birge technique that recomputes the bin sizes...
-    # y = np.sort(x)
-    likelihood = np.zeros(nbinsmax, dtype=float)
-    pen = np.arange(1, nbinsmax + 1, dtype=float) + ((np.log(np.arange(1, nbinsmax + 1, dtype=float))) ** 2.5)
-
-    for d in range(1, nbinsmax + 1):
-        #counts, breaks = np.histogram(x, bins=(y[0] + (np.arange(0, d+1, dtype=float)/d) * (y[n-1]-y[0])),
-        #                              density=False)
-        counts, breaks = np.histogram(x, bins=d, density=False)
-        density = counts / (n * (breaks[1] - breaks[0]))
-        like = np.zeros(d, dtype=float)
-        like2 = np.zeros(d, dtype=float)
-        tmp = np.where(counts > 0)[0]
-        if len(tmp) > 0:
-            like2[tmp] = np.log(density[tmp])
-        finite_map = np.isfinite(like2)
-        like[finite_map] = like2[finite_map]
-        likelihood[d-1] = np.sum(counts * like)
-        if np.min(counts) < 0:
-            likelihood[d-1] = -np.Inf
+    # The data is sorted once and the likelihoods for all bin counts
+    # 1...nbinsmax are computed from the positions of the bin edges.
+    y = np.sort(x)
+    d_list = np.arange(1, nbinsmax + 1)
+    likelihood = get_birge_likelihoods(y, d_list)
+    pen = d_list + (np.log(d_list) ** 2.5)
     penlike = likelihood - pen
     optd = np.argmax(penlike)
     if verbose:
         logger.debug("optimal num bins: %d" % (int(optd)+1,))
 
-    counts, breaks = np.histogram(x, bins=optd+1, density=False)
-    density = counts / (n * (breaks[1] - breaks[0]))
-
-    hist = HistogramR(counts=np.array(counts, float), density=np.array(density, float),
-                      breaks=np.array(breaks, dtype=float))
-    return hist
+    return get_regular_histogram(y, optd+1)
 
 
 def histogram_r_mod(x, g1=1., g2=1., g3=-1., max_tries=500, verbose=False):
@@ -117,12 +221,6 @@ def histogram_r_mod(x, g1=1., g2=1., g3=-1., max_tries=500, verbose=False):
     nbinsmax = int(g1 * (n ** g2) * (np.log(n) ** g3))
     if verbose:
         logger.debug("max bins: %d" % (nbinsmax,))
-    # density, breaks = np.histogram(x, bins=nbinsmax, density=True)
-
-    # the below implements Birge technique that recomputes the bin sizes...
-    # y = np.sort(x)
-    # likelihood = np.zeros(nbinsmax, dtype=float)
-    # pen = np.arange(1, nbinsmax + 1, dtype=float) + ((np.log(np.arange(1, nbinsmax + 1, dtype=float))) ** 2.5)
 
     # instead of trying each bin size 1...nbinsmax, we will only try a few
     # as determined by the parameter max_tries.
@@ -132,44 +230,18 @@ def histogram_r_mod(x, g1=1., g2=1., g3=-1., max_tries=500, verbose=False):
         step_size = int(nbinsmax * 1. / max_tries)
     if verbose:
         logger.debug("nbinsmax: %d, max_tries: %d, step_size: %d" % (nbinsmax, max_tries, step_size))
-    d_list = list()
-    likelihood = list()
-    pen = list()
-    for d in range(1, nbinsmax + 1, step_size):
-        #counts, breaks = np.histogram(x, bins=(y[0] + (np.arange(0, d+1, dtype=float)/d) * (y[n-1]-y[0])),
-        #                              density=False)
-        counts, breaks = np.histogram(x, bins=d, density=False)
-        density = counts / (n * (breaks[1] - breaks[0]))
-        like = np.zeros(d, dtype=float)
-        like2 = np.zeros(d, dtype=float)
-        tmp = np.where(counts > 0)[0]
-        if len(tmp) > 0:
-            like2[tmp] = np.log(density[tmp])
-        finite_map = np.isfinite(like2)
-        like[finite_map] = like2[finite_map]
-        # The below commented code is original. It is expensive.
-        # likelihood[d-1] = np.sum(counts * like)
-        # if np.min(counts) < 0:
-        #     likelihood[d-1] = -np.Inf
-        if np.min(counts) < 0:
-            likelihood.append(-np.Inf)
-        else:
-            likelihood.append(np.sum(counts * like))
-        pen.append(d + np.log(d)**2.5)
-        d_list.append(d)
-    likelihood = np.array(likelihood, dtype=np.float64)
-    pen = np.array(pen, dtype=np.float64)
+
+    y = np.sort(x)
+    d_list = np.arange(1, nbinsmax + 1, step_size)
+    likelihood = get_birge_likelihoods(y, d_list)
+    pen = d_list + np.log(d_list)**2.5
     penlike = likelihood - pen
-    d_list = np.array(d_list, dtype=int)
     optd = d_list[np.argmax(penlike)]
     if verbose:
         logger.debug("optimal num bins: %d" % (int(optd)+1,))
 
-    counts, breaks = np.histogram(x, bins=optd+1, density=False)
-    density = counts / (n * (breaks[1] - breaks[0]))
-
-    hist = HistogramR(counts=np.array(counts, float), density=np.array(density, float),
-                      breaks=np.array(breaks, dtype=float))
+    # Note: the final histogram has one bin more than the best candidate
+    hist = get_regular_histogram(y, optd+1)
     if verbose:
         logger.debug(tm.message("histogram_r():"))
     return hist
@@ -184,36 +256,244 @@ def get_bin_for_equal_hist(breaks, x):
     return int(i)
 
 
+def get_bins_for_equal_hist(start, width, nbins, x):
+    """ Vectorized bin lookup in regular histograms
+
+    Values outside the histogram range are assigned to the first/last bin.
+    start, width and nbins may be scalars or arrays which broadcast with x.
+
+    :return: np.array(int)
+    """
+    i = np.trunc((x - start) / width)  # get integral value
+    return np.asarray(np.clip(i, 0, nbins - 1), dtype=int)
+
+
 def pdf_hist_equal_bins(x, h, minpdf=1e-8):
     # here we are assuming a regular histogram where
     # h.breaks[1] - h.breaks[0] would return the width of the bin
-    p = (x - h.breaks[0]) / (h.breaks[1] - h.breaks[0])
-    ndensity = len(h.density)
-    p = np.array([min(int(np.trunc(v)), ndensity-1) for v in p])
-    d = h.density[p]
+    i = get_bins_for_equal_hist(h.breaks[0], h.breaks[1] - h.breaks[0], len(h.density), x)
     # quick hack to make sure d is never 0
-    d = np.array([max(v, minpdf) for v in d])
-    return d
+    return np.maximum(h.density[i], minpdf)
 
 
 def pdf_hist(x, h, minpdf=1e-8):
-    n = len(x)
-    pd = np.zeros(n)
-    for j in range(n):
-        # use simple index lookup in case the histograms are equal width
-        # this returns the lower index
-        i = get_bin_for_equal_hist(h.breaks, x[j])
-        if i >= len(h.density):
-            i = len(h.density)-1  # maybe something else should be done here
-        # i might be 0 if the value does not lie within the
-        # histogram range. We will assume for now that it cannot happen.
-
-        # More accurately, we should also multiply by diff(h$breaks)[i];
-        # however, all breaks are equal in length in this algorithm,
-        # hence, ignoring that for now.
-        # also, hack to make sure that density is not zero
-        pd[j] = max(h.density[i], minpdf)
-    return pd
+    # All breaks are equal in length in this algorithm; hence, the bin
+    # is a simple index lookup. Values outside the histogram range are
+    # assigned to the first/last bin. Also, hack to make sure that
+    # density is not zero.
+    return pdf_hist_equal_bins(x, h, minpdf=minpdf)
+
+
+class HistogramDensities(object):
+    """ All histograms of a LODA model in one padded density matrix
+
+    Attributes:
+        starts: np.array(float)
+            left-most break of each histogram
+        widths: np.array(float)
+            bin width of each histogram
+        nbins: np.array(int)
+            number of bins in each histogram
+        density: np.ndarray(float)
+            (#histograms x max(nbins)) matrix; row i has the densities of
+            the i-th histogram padded with zeros on the right
+    """
+    def __init__(self, hists):
+        k = len(hists)
+        self.starts = np.array([h.breaks[0] for h in hists], dtype=float)
+        self.widths = np.array([h.breaks[1] - h.breaks[0] for h in hists], dtype=float)
+        self.nbins = np.array([len(h.density) for h in hists], dtype=int)
+        self.density = np.zeros(shape=(k, np.max(self.nbins) if k > 0 else 0), dtype=float)
+        for i, h in enumerate(hists):
+            self.density[i, 0:self.nbins[i]] = h.density
+
+    def get_pdfs(self, x, minpdf=1e-8):
+        """ Returns the densities of the projected values
+
+        :param x: np.ndarray
+            (n x #histograms) values projected on each projection vector
+        :return: np.ndarray
+        """
+        bins = get_bins_for_equal_hist(self.starts, self.widths, self.nbins, x)
+        pdfs = self.density[np.arange(len(self.nbins)).reshape((1, -1)), bins]
+        return np.maximum(pdfs, minpdf)
+
+
+class StreamingHistogramDensities(HistogramDensities):
+    """ Histogram densities which are updated with instances from a stream
+
+    Every histogram retains its number of bins. The (projected) values
+    added to the stream buffer are retained until update_from_buffer().
+    With HIST_UPD_OVERWRITE and adaptive bins, the bins are then rebuilt
+    over the range of the buffered values and the counts are replaced. Else,
+    the buffered values are counted in the current bins. Values added with
+    current=True are counted in the current bins right away.
+
+    With adaptive bins, a histogram whose range does not contain a new value
+    doubles its range by merging adjacent bins (the old breaks remain
+    breaks); else the value is counted in the first/last bin. A range is
+    doubled at most max_expansions times since the histogram was fit or
+    rebuilt, and a rebuilt range is clipped to the ranges these doublings
+    could reach; values beyond are counted in the first/last bin. Hence, a
+    few outliers cannot widen the bins without bound. The densities used for
+    scoring change only when the buffer is moved to the current counts with
+    update_from_buffer() or when samples are added with current=True.
+
+    Attributes:
+        update_type: int
+            HIST_UPD_OVERWRITE: buffer counts replace the current counts
+            HIST_UPD_INCREMENTAL: current counts are exponentially decayed
+                (1 - incremental_update_weight) * counts + incremental_update_weight * buffer
+        incremental_update_weight: float
+        adaptive: bool
+        max_expansions: int
+        bin_starts: np.array(float)
+        bin_ends: np.array(float)
+        bin_widths: np.array(float)
+            range of the bins in which counts are accumulated
+        ref_starts: np.array(float)
+        ref_ends: np.array(float)
+            range of each histogram when it was fit or last rebuilt
+        n_expansions: np.array(int)
+            number of times each range was doubled since then
+        counts: np.ndarray(float)
+            (#histograms x max(nbins)) padded counts
+        buffer_values: list of np.ndarray
+            values added to the stream buffer
+    """
+    # relative tolerance of the range check
+    range_tol = 1e-8
+
+    def __init__(self, hists, update_type=HIST_UPD_OVERWRITE, incremental_update_weight=0.5, adaptive=True,
+                 max_expansions=2):
+        HistogramDensities.__init__(self, hists)
+        self.update_type = update_type
+        self.incremental_update_weight = incremental_update_weight
+        self.adaptive = adaptive
+        self.max_expansions = max_expansions
+        self.bin_starts = np.copy(self.starts)
+        self.bin_ends = np.array([h.breaks[len(h.breaks) - 1] for h in hists], dtype=float)
+        self.bin_widths = np.copy(self.widths)
+        self.ref_starts = np.copy(self.bin_starts)
+        self.ref_ends = np.copy(self.bin_ends)
+        self.n_expansions = np.zeros(len(hists), dtype=int)
+        self.counts = np.zeros(self.density.shape, dtype=float)
+        for i, h in enumerate(hists):
+            self.counts[i, 0:self.nbins[i]] = h.counts
+        self.buffer_values = list()
+
+    def _expand_bins(self, i, left):
+        """ Doubles the range of i-th histogram by merging adjacent bins """
+        nb = self.nbins[i]
+        # old bin j lies within the new bin (offset + j) // 2
+        offset = nb if left else 0
+        new_bins = (offset + np.arange(nb)) // 2
+        self.counts[i, 0:nb] = np.bincount(new_bins, weights=self.counts[i, 0:nb], minlength=nb)
+        span = self.bin_ends[i] - self.bin_starts[i]
+        if left:
+            self.bin_starts[i] -= span
+        else:
+            self.bin_ends[i] += span
+        self.bin_widths[i] *= 2
+        self.n_expansions[i] += 1
+
+    def _expand_to_include(self, x):
+        finite = np.isfinite(x)
+        mins = np.min(np.where(finite, x, np.inf), axis=0)
+        maxs = np.max(np.where(finite, x, -np.inf), axis=0)
+        # the projections of the same instance may differ in the last bits
+        # depending on how the dot product was computed; values just outside
+        # the range are counted in the first/last bin.
+        tol = self.range_tol * (self.bin_ends - self.bin_starts)
+        mins += tol
+        maxs -= tol
+        for i in np.where(np.logical_or(mins < self.bin_starts, maxs > self.bin_ends))[0]:
+            while mins[i] < self.bin_starts[i] and self.n_expansions[i] < self.max_expansions:
+                self._expand_bins(i, left=True)
+            while maxs[i] > self.bin_ends[i] and self.n_expansions[i] < self.max_expansions:
+                self._expand_bins(i, left=False)
+
+    def _rebuild_bins(self, x):
+        """ Fits the range of every histogram to the values x
+
+        The range is clipped to [ref_end - g, ref_start + g] where g is the
+        width of the reference range after max_expansions doublings. The
+        range of a histogram is retained if nothing remains after clipping.
+        """
+        finite = np.isfinite(x)
+        mins = np.min(np.where(finite, x, np.inf), axis=0)
+        maxs = np.max(np.where(finite, x, -np.inf), axis=0)
+        growth = (2 ** self.max_expansions) * (self.ref_ends - self.ref_starts)
+        lo = np.clip(mins, self.ref_ends - growth, self.ref_starts + growth)
+        hi = np.clip(maxs, self.ref_ends - growth, self.ref_starts + growth)
+        fit = hi > lo
+        self.bin_starts[fit] = lo[fit]
+        self.bin_ends[fit] = hi[fit]
+        self.bin_widths[fit] = (hi[fit] - lo[fit]) / self.nbins[fit]
+        self.ref_starts[fit] = lo[fit]
+        self.ref_ends[fit] = hi[fit]
+        self.n_expansions[fit] = 0
+
+    def _get_counts(self, x):
+        bins = get_bins_for_equal_hist(self.bin_starts, self.bin_widths, self.nbins, x)
+        k, max_bins = self.counts.shape
+        flat_bins = (bins + (np.arange(k) * max_bins).reshape((1, -1))).reshape(-1)
+        return np.bincount(flat_bins, minlength=k * max_bins).reshape((k, max_bins))
+
+    def _update_densities(self):
+        totals = np.sum(self.counts, axis=1)
+        valid = totals > 0
+        self.starts[valid] = self.bin_starts[valid]
+        self.widths[valid] = self.bin_widths[valid]
+        self.density[valid, :] = self.counts[valid, :] / (totals[valid] * self.widths[valid]).reshape((-1, 1))
+
+    def add_samples(self, x, current=False):
+        """ Counts the projected values x in the current counts or adds them to the buffer
+
+        :param x: np.ndarray
+            (n x #histograms) values projected on each projection vector
+        :param current: bool
+            whether to update the current counts (and densities) directly
+        """
+        if current:
+            if self.adaptive:
+                self._expand_to_include(x)
+            self.counts += self._get_counts(x)
+            self._update_densities()
+        else:
+            self.buffer_values.append(np.array(x, dtype=float))
+
+    def update_from_buffer(self):
+        """ Moves the buffer counts to the current counts and recomputes the densities """
+        if self.update_type not in [HIST_UPD_OVERWRITE, HIST_UPD_INCREMENTAL]:
+            raise ValueError("Invalid histogram update type: %d" % self.update_type)
+        x = None
+        if len(self.buffer_values) > 0:
+            x = np.vstack(self.buffer_values)
+        self.buffer_values = list()
+        if x is not None and self.adaptive:
+            if self.update_type == HIST_UPD_OVERWRITE:
+                self._rebuild_bins(x)
+            else:
+                self._expand_to_include(x)
+        buffer_counts = np.zeros(self.counts.shape, dtype=float) if x is None else self._get_counts(x)
+        if self.update_type == HIST_UPD_OVERWRITE:
+            np.copyto(self.counts, buffer_counts)
+        else:
+            self.counts *= (1. - self.incremental_update_weight)
+            self.counts += (self.incremental_update_weight * buffer_counts)
+        self._update_densities()
+
+    def get_histograms(self):
+        """ Returns the current histograms as a list of HistogramR """
+        hists = []
+        for i in range(len(self.nbins)):
+            nb = self.nbins[i]
+            breaks = self.starts[i] + np.arange(nb + 1) * self.widths[i]
+            hists.append(HistogramR(counts=np.array(self.counts[i, 0:nb]),
+                                    density=np.array(self.density[i, 0:nb]),
+                                    breaks=breaks))
+        return hists
 
 
 # Get the random projections
@@ -249,14 +529,37 @@ def get_random_proj(nproj, d, sp, keep=None, exclude=None):
 
 
 # Build histogram for each projection
-def build_proj_hist(a, w, verbose=False):
-    d = ncol(w)  # number of columns
+def build_proj_hist(a, w, verbose=False, pool=None):
     x = a.dot(w)
-    hists = []
-    for j in range(d):
-        hists_j = histogram_r_mod(x[:, j], verbose=verbose)
-        hists.append(hists_j)
-    return hists
+    return build_hists_for_values(x, verbose=verbose, pool=pool)
+
+
+def build_hists_for_values(x, verbose=False, pool=None):
+    """ Builds one histogram for each column of the projected values x
+
+    :param pool: WorkerPool
+        If not None, the columns are histogrammed in the worker processes
+    :return: list of HistogramR
+    """
+    d = ncol(x)  # number of columns
+    if pool is None or d == 1:
+        return [histogram_r_mod(x[:, j], verbose=verbose) for j in range(d)]
+    x_shared = SharedArray.from_array(x)
+    try:
+        blocks = pool.map(build_hists_for_columns,
+                          [(x_shared, start, end, verbose)
+                           for start, end in get_row_blocks(d, pool.n_jobs, min_rows=1, max_rows=d)])
+    finally:
+        x_shared.close()
+    return [hist for block in blocks for hist in block]
+
+
+def build_hists_for_columns(args):
+    """ Histograms for the columns [start, end) of x; x might be a SharedArray """
+    x, start, end, verbose = args
+    if isinstance(x, SharedArray):
+        x = x.array
+    return [histogram_r_mod(np.array(x[:, j]), verbose=verbose) for j in range(start, end)]
 
 
 # a - (n x d) matrix
@@ -264,38 +567,42 @@ def build_proj_hist(a, w, verbose=False):
 def get_neg_ll(a, w, hist, inf_replace=np.nan):
     x = a.dot(w)
     pdfs = np.zeros(shape=(len(x), 1), dtype=float)
-    pdfs[:, 0] = pdf_hist_equal_bins(x, hist)
-    pdfs[:, 0] = np.log(pdfs)[:, 0]
+    pdfs[:, 0] = np.log(pdf_hist_equal_bins(x.reshape(-1), hist))
     if inf_replace is not np.nan:
-        pdfs[:, 0] = [max(v, inf_replace) for v in pdfs[:, 0]]
+        pdfs[:, 0] = np.maximum(pdfs[:, 0], inf_replace)
     return -pdfs  # neg. log-lik of pdf
 
 
 # get all pdfs from individual histograms.
 def get_all_hist_pdfs(a, w, hists):
     x = a.dot(w)
-    hpdfs = np.zeros(shape=(len(x), len(hists)), dtype=float)
-    for i in range(len(hists)):
-        hpdfs[:, i] = pdf_hist(x[:, i], hists[i])
-    return hpdfs
+    return HistogramDensities(hists).get_pdfs(x)
 
 
-# Compute negative log-likelihood using random projections and histograms
-def get_neg_ll_all_hist(a, w, hists, inf_replace=np.nan):
-    pds = get_all_hist_pdfs(a, w, hists)
+def get_neg_ll_from_pdfs(pds, inf_replace=np.nan):
     pds = np.log(pds)
     if inf_replace is not np.nan:
-        vfunc = np.vectorize(max)
-        pds = vfunc(pds, 1.0 * inf_replace) # [max(v, inf_replace) for v in pds[:, i]]
+        pds = np.maximum(pds, 1.0 * inf_replace)
     ll = -np.mean(pds, axis=1)  # neg. log-lik
     return ll
 
 
+# Compute negative log-likelihood using random projections and histograms
+def get_neg_ll_all_hist(a, w, hists, inf_replace=np.nan):
+    return get_neg_ll_from_pdfs(get_all_hist_pdfs(a, w, hists), inf_replace=inf_replace)
+
+
 # Determine k - no. of dimensions
 # sp=1 - 1 / np.sqrt(ncol(a)),
-def get_best_proj(a, mink=1, maxk=10, sp=0.0, keep=None, exclude=None, verbose=False):
+def get_best_proj(a, mink=1, maxk=10, sp=0.0, keep=None, exclude=None, verbose=False, n_jobs=1):
     """ Computes random projections and histogram pdfs along each projection
 
+    Projections are added one at a time until the mean change in the
+    average negative log-likelihood converges. With n_jobs != 1, the
+    projections are generated in batches of one per worker and their
+    histograms are built in parallel; the projections are the same as
+    when they are generated one at a time.
+
     Args:
         a: numpy.ndarray
         mink: int
@@ -310,50 +617,67 @@ def get_best_proj(a, mink=1, maxk=10, sp=0.0, keep=None, exclude=None, verbose=F
             columns of original feature space which must be excluded
         verbose:
             whether to output detail execution logs when building projections
+        n_jobs: int
+            number of processes for building histograms
 
     """
     t = 0.01
     n = nrow(a)
     d = ncol(a)
 
+    pool = None
+    batch_size = 1
+    if get_n_jobs(n_jobs) > 1:
+        pool = WorkerPool(n_jobs)
+        batch_size = pool.n_jobs
+
     w = np.zeros(shape=(d, maxk + 1), dtype=float)
     hists = []
-    fx_k = np.zeros(shape=(n, 1), dtype=float)
-    fx_k1 = np.zeros(shape=(n, 1), dtype=float)
-
-    w_ = get_random_proj(nproj=1, d=d, sp=sp, keep=keep, exclude=exclude)
-    w[:, 0] = w_[:, 0]
-    hists.append(build_proj_hist(a, w_, verbose=verbose)[0])
-    fx_k[:, 0] = get_neg_ll(a, w_, hists[0])[:, 0]
-
-    sigs = np.ones(maxk) * np.Inf
-    k = 0
-    # logger.debug("mink: %d, maxk: %d" % (mink, maxk))
-    while k < maxk:
-        w_ = get_random_proj(nproj=1, d=d, sp=sp, keep=keep, exclude=exclude)
-        w[:, k+1] = w_[:, 0]
-        hists.append(build_proj_hist(a, w_, verbose=verbose)[0])
-
-        ll = get_neg_ll(a, w[:, k+1], hists[k+1])
-
-        fx_k1[:, 0] = fx_k[:, 0] + ll[:, 0]
-
-        diff_ll = abs(fx_k1 / (k+2.0) - fx_k / (k+1.0))
-        # logger.debug(diff_ll)
-        diff_ll = diff_ll[np.isfinite(diff_ll)]
-        if len(diff_ll) > 0:
-            sigs[k] = np.mean(diff_ll)
-        else:
-            raise(ValueError("Log-likelihood was invalid for all instances"))
-        tt = sigs[k] / sigs[0]
-        if tt < t and k >= mink:
-            break
-
-        fx_k[:, 0] = fx_k1[:, 0]
-
-        # if (debug) print(paste("k =",k,"; length(sigs)",length(sigs),"; sigs_k=",tt))
-
-        k += 1
+    # nll has the neg. log-likelihoods along the projections [nll_start, len(hists))
+    nll_start = 0
+
+    def add_projections():
+        nproj = min(batch_size, maxk + 1 - len(hists))
+        w_ = get_random_proj(nproj=nproj, d=d, sp=sp, keep=keep, exclude=exclude)
+        w[:, len(hists):(len(hists) + nproj)] = w_
+        x = a.dot(w_)  # project once for both histograms and likelihoods
+        hists_ = build_hists_for_values(x, verbose=verbose, pool=pool)
+        hists.extend(hists_)
+        return -np.log(HistogramDensities(hists_).get_pdfs(x))
+
+    try:
+        nll = add_projections()
+        fx_k = np.array(nll[:, 0])
+
+        sigs = np.ones(maxk) * np.Inf
+        k = 0
+        # logger.debug("mink: %d, maxk: %d" % (mink, maxk))
+        while k < maxk:
+            if len(hists) < k + 2:
+                nll_start = len(hists)
+                nll = add_projections()
+
+            fx_k1 = fx_k + nll[:, k + 1 - nll_start]
+
+            diff_ll = abs(fx_k1 / (k+2.0) - fx_k / (k+1.0))
+            # logger.debug(diff_ll)
+            diff_ll = diff_ll[np.isfinite(diff_ll)]
+            if len(diff_ll) > 0:
+                sigs[k] = np.mean(diff_ll)
+            else:
+                raise(ValueError("Log-likelihood was invalid for all instances"))
+            tt = sigs[k] / sigs[0]
+            if tt < t and k >= mink:
+                break
+
+            fx_k = fx_k1
+
+            # if (debug) print(paste("k =",k,"; length(sigs)",length(sigs),"; sigs_k=",tt))
+
+            k += 1
+    finally:
+        if pool is not None:
+            pool.close()
 
     bestk = np.where(sigs == np.min(sigs))[0][0]  # np.where returns tuple of arrays
     if bestk < mink:
@@ -382,7 +706,8 @@ def get_original_proj(a, maxk=10, sp=0, keep=None, exclude=None):
     return LodaModel(k=k, pvh=ProjectionVectorsHistograms(w=w, hists=hists), sigs=None)
 
 
-def loda(a, sparsity=np.nan, mink=1, maxk=0, keep=None, exclude=None, original_dims=False, verbose=False):
+def loda(a, sparsity=np.nan, mink=1, maxk=0, keep=None, exclude=None, original_dims=False, verbose=False,
+         n_jobs=1):
     l = nrow(a)
     d = ncol(a)
 
@@ -399,11 +724,12 @@ def loda(a, sparsity=np.nan, mink=1, maxk=0, keep=None, exclude=None, original_d
     if original_dims:
         pvh = get_original_proj(a, maxk=maxk, sp=sp, keep=keep, exclude=exclude)
     else:
-        pvh = get_best_proj(a, mink=mink, maxk=maxk, sp=sp, keep=keep, exclude=exclude, verbose=verbose)
+        pvh = get_best_proj(a, mink=mink, maxk=maxk, sp=sp, keep=keep, exclude=exclude, verbose=verbose,
+                            n_jobs=n_jobs)
 
     logger.debug(tm.message("loda: sparsity: %f:" % (sp,)))
 
-    nll = get_neg_ll_all_hist(a, pvh.pvh.w, pvh.pvh.hists, inf_replace=np.nan)
+    nll = pvh.compile().get_neg_ll_all_hist(a, inf_replace=np.nan)
 
     anomranks = np.arange(l)
     anomranks = anomranks[order(-nll)]
@@ -412,7 +738,7 @@ def loda(a, sparsity=np.nan, mink=1, maxk=0, keep=None, exclude=None, original_d
 
 
 class Loda(object):
-    def __init__(self, sparsity=np.nan, mink=1, maxk=0, random_state=None, verbose=False):
+    def __init__(self, sparsity=np.nan, mink=1, maxk=0, random_state=None, verbose=False, n_jobs=1):
         self.sparsity = sparsity
         self.mink = mink
         self.maxk = maxk
@@ -420,6 +746,7 @@ class Loda(object):
         self.loda_model = None
         self.m = None  # number of projections
         self.verbose = verbose
+        self.n_jobs = n_jobs
 
     def get_projections(self):
         if self.loda_model is None:
@@ -427,14 +754,15 @@ class Loda(object):
         return self.loda_model.pvh.pvh.w
 
     def fit(self, x):
-        self.loda_model = loda(x, self.sparsity, mink=self.mink, maxk=self.maxk, verbose=self.verbose)
+        self.loda_model = loda(x, self.sparsity, mink=self.mink, maxk=self.maxk, verbose=self.verbose,
+                               n_jobs=self.n_jobs)
         self.m = self.loda_model.pvh.pvh.w.shape[1]
 
     def get_projection_scores(self, x):
         """ Smaller values mean more anomalous """
         if self.loda_model is None:
             raise RuntimeError("Loda model not initialized")
-        hpdfs = get_all_hist_pdfs(x, self.loda_model.pvh.pvh.w, self.loda_model.pvh.pvh.hists)
+        hpdfs = self.loda_model.pvh.get_all_hist_pdfs(x)
         nlls = np.log(hpdfs)
         return nlls
 